@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+'''Concurrent conversation loop.
+
+The blocking repl() listens, recognizes, asks OpenAI and speaks strictly in turn, so the
+microphone is deaf while Bonejangles talks. Here each of those runs as its own asyncio stage,
+connected by small bounded queues:
+
+    capture -> [audio queue] -> recognize -> [text queue] -> respond (OpenAI stream + TTS)
+
+Capture (audio_capture.StreamingCapture) keeps listening while a response is playing. If the visitor starts talking over the
+skeleton, the response is cancelled (barge-in) and the new utterance is answered instead.
+'''
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+IDLE = object() #nobody spoke before the listen timeout
+
+class AsyncRepl:
+    '''Runs the conversation as concurrent stages.
+    source needs a blocking listen() which returns recorded audio or None, and may call
+    on_speech_start() from its thread when it hears the visitor begin to talk.'''
+    def __init__(self, controller, voice_pipeline, source, recognize=None, barge_in=True, queue_size=1, idle_limit=5):
+        self.controller = controller
+        self.voice_pipeline = voice_pipeline
+        self.source = source
+        self.recognize = recognize or voice_pipeline.recognize
+        self.barge_in = barge_in
+        self.queue_size = queue_size
+        self.idle_limit = idle_limit
+        self.speaking = False
+        self.cancel_event = threading.Event()
+        self.barge_ins = 0
+        self.stopped = False
+
+    def run(self):
+        try:
+            asyncio.run(self._main())
+        except KeyboardInterrupt:
+            print('\n>>> Goodbye!')
+
+    async def _main(self):
+        loop = asyncio.get_running_loop()
+        self.audio_queue = asyncio.Queue(self.queue_size)
+        self.text_queue = asyncio.Queue(self.queue_size)
+        #One thread per stage, so a slow stage can't hold up the others
+        self.capture_pool = ThreadPoolExecutor(1, thread_name_prefix="capture")
+        self.recognize_pool = ThreadPoolExecutor(1, thread_name_prefix="recognize")
+        self.respond_pool = ThreadPoolExecutor(1, thread_name_prefix="respond")
+        self.source.on_speech_start = self._on_speech_start
+
+        stages = [asyncio.create_task(self._capture(loop)), asyncio.create_task(self._recognize(loop))]
+        try:
+            await self._respond(loop)
+        finally:
+            self.stopped = True
+            for stage in stages:
+                stage.cancel()
+            await asyncio.gather(*stages, return_exceptions=True)
+            for pool in (self.capture_pool, self.recognize_pool, self.respond_pool):
+                pool.shutdown(wait=False)
+
+    async def _capture(self, loop):
+        while not self.stopped:
+            audio = await loop.run_in_executor(self.capture_pool, self.source.listen)
+            if audio is None:
+                if self.speaking:
+                    continue #not idle, we're the ones talking
+                audio = IDLE
+            await self.audio_queue.put(audio)
+
+    async def _recognize(self, loop):
+        while not self.stopped:
+            audio = await self.audio_queue.get()
+            if audio is IDLE:
+                await self.text_queue.put(IDLE)
+                continue
+            turn = self.voice_pipeline.begin_turn(audio)
+            #Carried along with the text, as the respond stage may still be answering the utterance before this one
+            speech_end = getattr(audio, 'speech_end', None)
+            text = await loop.run_in_executor(self.recognize_pool, self.recognize, audio)
+            if turn:
+                turn.mark('stt_result')
+            if text is None:
+                self.voice_pipeline.end_turn('unrecognized', turn)
+                continue
+            await self.text_queue.put((text, turn, speech_end))
+
+    async def _respond(self, loop):
+        consecutive_idles = 0
+        while True:
+            user_input = await self.text_queue.get()
+            if user_input is IDLE:
+                if consecutive_idles >= self.idle_limit:
+                    print("Conversation Timeout.")
+                    self.controller.reset()
+                    self.voice_pipeline.reset()
+                    consecutive_idles = 0
+                else:
+                    consecutive_idles = consecutive_idles+1
+                continue
+            consecutive_idles = 0
+            user_input, turn, speech_end = user_input
+
+            if user_input == "clear":
+                self.controller.reset()
+                self.voice_pipeline.end_turn('command', turn)
+                print("Cleared conversation.")
+                continue
+
+            if user_input in ('quit', 'exit'):
+                self.voice_pipeline.end_turn('command', turn)
+                print("\n>>> Goodbye!")
+                return
+
+            self.controller.conversation.add_user_message(user_input)
+            self.cancel_event = threading.Event()
+            self.speaking = True
+            self.voice_pipeline.respond_to(turn)
+            try:
+                await loop.run_in_executor(self.respond_pool, self._speak, self.cancel_event, speech_end)
+            finally:
+                self.speaking = False
+                self.voice_pipeline.end_turn('barged_in' if self.cancel_event.is_set() else 'spoken', turn)
+            print()
+
+    def _speak(self, cancel_event, speech_end):
+        self.controller.stream_completion(self.voice_pipeline, cancel_event, speech_end)
+        if cancel_event.is_set():
+            self.voice_pipeline.cancel()
+
+    def _on_speech_start(self):
+        #Called from the capture thread. Silence the skeleton now, the respond thread cleans up after itself.
+        if self.barge_in and self.speaking and not self.cancel_event.is_set():
+            print(" (barge-in)")
+            self.barge_ins += 1
+            self.cancel_event.set()
+            self.voice_pipeline.tts.cancel()
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+'''Always-open audio capture with voice activity detection.
+
+The microphone is opened once and read continuously, a frame at a time, on its own thread:
+
+    input -> frames -> VAD -> [pre-roll ring buffer] -> utterances -> listen()
+
+While nobody is talking the last few hundred milliseconds are kept in a ring buffer, so when the
+VAD hears speech start the utterance begins a little before it and the first syllable isn't lost.
+An utterance ends after a pause, and is handed to whoever calls listen() as an Utterance, ready for
+the STT provider. The VAD's threshold follows the background noise between utterances.
+
+If a streaming recognizer is attached, each utterance's frames are fed to it as they're captured.
+
+The microphone also hears the skeleton. If playing_until is set, it returns when everything the
+skeleton has said or played so far will have been heard (see VoicePipeline.playing_until), and until then,
+plus echo_tail_ms for the room to quiet down, only speech barge_in_factor times louder than the
+threshold can start an utterance. A factor of 0 doesn't let anything through.
+
+Input can come from a WAV file instead of a microphone, for testing without hardware.
+'''
+
+import io
+import time
+import wave
+import threading
+from collections import deque
+
+import numpy as np
+
+class MicrophoneInput:
+    '''Reads fixed size frames from a microphone kept open for the life of the capture.
+    Talks to pyaudio directly, which is all speech_recognition's Microphone does, without importing
+    speech_recognition (and requests with it) for STT providers that don't need it.'''
+    def __init__(self, device_index=None, sample_rate=16000, frame_ms=30):
+        self.device_index = device_index
+        self.sample_rate = sample_rate
+        self.sample_width = 2
+        self.frame_samples = int(sample_rate * frame_ms / 1000)
+        self.audio = None
+        self.stream = None
+
+    def open(self):
+        import pyaudio
+        self.audio = pyaudio.PyAudio()
+        try:
+            self.stream = self.audio.open(input_device_index=self.device_index, channels=1, format=pyaudio.paInt16,
+                                          rate=self.sample_rate, frames_per_buffer=self.frame_samples, input=True)
+        except Exception:
+            self.audio.terminate()
+            self.audio = None
+            raise
+        self.sample_width = pyaudio.get_sample_size(pyaudio.paInt16)
+
+    def read(self):
+        return self.stream.read(self.frame_samples, exception_on_overflow=False)
+
+    def close(self):
+        if not self.audio:
+            return
+        try:
+            #Closing a stream that hasn't been stopped sometimes throws
+            if not self.stream.is_stopped():
+                self.stream.stop_stream()
+            self.stream.close()
+        finally:
+            self.stream = None
+            self.audio.terminate()
+            self.audio = None
+
+class WavFileInput:
+    '''Reads frames from a mono 16 bit WAV file instead of a microphone.
+    realtime paces the reads like a live microphone, otherwise the file is read as fast as it can be processed.'''
+    def __init__(self, path, frame_ms=30, realtime=True):
+        self.path = path
+        self.frame_ms = frame_ms
+        self.realtime = realtime
+        self.file = None
+
+    def open(self):
+        self.file = wave.open(self.path, 'rb')
+        if self.file.getnchannels() != 1 or self.file.getsampwidth() != 2:
+            raise ValueError("{} must be mono 16 bit".format(self.path))
+        self.sample_rate = self.file.getframerate()
+        self.sample_width = 2
+        self.frame_samples = int(self.sample_rate * self.frame_ms / 1000)
+        self.frames_read = 0
+        self.start = time.monotonic()
+
+    def read(self):
+        '''Returns the next frame, or None at the end of the file'''
+        data = self.file.readframes(self.frame_samples)
+        if len(data) < self.frame_samples * self.sample_width:
+            return None
+        self.frames_read += 1
+        if self.realtime:
+            wait = self.start + self.frames_read * self.frame_samples / self.sample_rate - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+        return data
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+def frame_energy(frame):
+    '''RMS of a frame of s16le samples, in the same units as speech_recognition's Recognizer.energy_threshold'''
+    samples = np.frombuffer(frame, dtype='<i2').astype(np.float64)
+    return float(np.sqrt(np.mean(samples * samples))) if len(samples) else 0.0
+
+class EnergyVAD:
+    '''Frame level voice activity detection against an adaptive noise floor.
+    A frame is speech if its energy is more than ratio times the noise floor (and at least min_energy).
+    The floor follows the energy of frames which aren't speech, adapt being how quickly.'''
+    def __init__(self, ratio=3.0, min_energy=300, adapt=0.05):
+        self.ratio = ratio
+        self.min_energy = min_energy
+        self.adapt = adapt
+        self.noise_floor = min_energy / ratio
+
+    @property
+    def threshold(self):
+        return max(self.min_energy, self.noise_floor * self.ratio)
+
+    def is_speech(self, energy):
+        return energy > self.threshold
+
+    def update(self, energy):
+        '''Track the background level with a frame which wasn't speech'''
+        self.noise_floor += (energy - self.noise_floor) * self.adapt
+
+    def calibrate(self, energies):
+        '''Set the floor straight from a stretch of frames known to be background noise'''
+        if energies:
+            self.noise_floor = float(np.mean(energies))
+
+class Utterance:
+    '''Recorded audio, with its streaming_stt.Transcript if it was recognized while it was captured.
+    speech_end and ended_at are when the visitor stopped talking and when the pause after it ended the utterance.
+    audio_data() converts it for speech_recognition's recognizers.'''
+    def __init__(self, frame_data, sample_rate, sample_width, transcript=None, speech_end=None, ended_at=None):
+        self.frame_data = frame_data
+        self.sample_rate = sample_rate
+        self.sample_width = sample_width
+        self.transcript = transcript
+        self.speech_end = speech_end
+        self.ended_at = ended_at
+
+    def get_raw_data(self, convert_width=None):
+        if convert_width is None or convert_width == self.sample_width:
+            return self.frame_data
+        return self.audio_data().get_raw_data(convert_width=convert_width)
+
+    def get_wav_data(self):
+        with io.BytesIO() as f:
+            with wave.open(f, 'wb') as w:
+                w.setnchannels(1)
+                w.setsampwidth(self.sample_width)
+                w.setframerate(self.sample_rate)
+                w.writeframes(self.frame_data)
+            return f.getvalue()
+
+    def audio_data(self):
+        import speech_recognition as sr
+        return sr.AudioData(self.frame_data, self.sample_rate, self.sample_width)
+
+class StreamingCapture:
+    '''Records utterances from an input which stays open, on a background thread.
+    on_speech_start, if set, is called from the capture thread as soon as speech is detected.
+    recognizer, if set, is a streaming_stt.StreamingRecognizer which hears each utterance as it's captured.
+    playing_until, if set, returns the time.monotonic() at which the skeleton will have stopped talking.'''
+    def __init__(self, input, vad=None, preroll_ms=300, pause_ms=600, onset_ms=60, min_phrase_ms=200, max_phrase_secs=5, max_queued=4,
+                 echo_tail_ms=300, barge_in_factor=4.0):
+        self.input = input
+        self.vad = vad or EnergyVAD()
+        self.preroll_ms = preroll_ms
+        self.pause_ms = pause_ms
+        self.onset_ms = onset_ms
+        self.min_phrase_ms = min_phrase_ms
+        self.max_phrase_secs = max_phrase_secs
+        self.echo_tail_ms = echo_tail_ms
+        self.barge_in_factor = barge_in_factor
+        self.utterances = deque(maxlen=max_queued)
+        self.condition = threading.Condition()
+        self.on_speech_start = None
+        self.recognizer = None
+        self.playing_until = None
+        self.in_phrase = False
+        self.finished = False
+        self.frames_read = 0
+        self.phrase_start = 0
+        self.phrase_started_at = 0.0
+        self.dropped = 0
+        self.echoes = 0
+        self._thread = None
+        self._stopping = False
+        self._calibration = None
+        self._drop_phrase = False
+
+    def start(self):
+        if self._thread:
+            return self
+        self.input.open()
+        frame_ms = 1000 * self.input.frame_samples / self.input.sample_rate
+        def frames(ms):
+            return max(int(round(ms / frame_ms)), 1)
+        self.frame_secs = frame_ms / 1000
+        self.preroll_frames = frames(self.preroll_ms)
+        self.pause_frames = frames(self.pause_ms)
+        self.onset_frames = frames(self.onset_ms)
+        self.min_phrase_frames = frames(self.min_phrase_ms)
+        self.max_phrase_frames = frames(self.max_phrase_secs * 1000)
+        self.ring = deque(maxlen=self.preroll_frames + self.onset_frames)
+        self._thread = threading.Thread(target=self._run, name="capture", daemon=True)
+        self._thread.start()
+        return self
+
+    def calibrate(self, seconds=0.5):
+        '''Measure the background noise for a moment. Whoever is around should be quiet.'''
+        done = threading.Event()
+        with self.condition:
+            self._calibration = ([], int(seconds / self.frame_secs), done)
+        done.wait(seconds + 2.0)
+        print("Speech threshold: {:.0f}".format(self.vad.threshold))
+
+    def listen(self, timeout=3):
+        '''Wait for the next utterance. Returns None if nobody started talking within timeout seconds.'''
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while not self.utterances:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 and not self.in_phrase:
+                    return None
+                #Once a phrase has started, wait for it to finish however long that takes
+                self.condition.wait(remaining if remaining > 0 else 0.1)
+            frames, transcript, speech_end, ended_at = self.utterances.popleft()
+        return Utterance(b''.join(frames), self.input.sample_rate, self.input.sample_width, transcript, speech_end, ended_at)
+
+    def discard(self):
+        '''Drop finished utterances nobody has listened to yet, e.g. the skeleton hearing itself.
+        An utterance still in progress is dropped too if it started while the skeleton could be heard.'''
+        with self.condition:
+            self.dropped += len(self.utterances)
+            self.utterances.clear()
+            if self.in_phrase and self.phrase_started_at < self.echo_until():
+                self._drop_phrase = True
+
+    def echo_until(self):
+        '''Until when the microphone may be hearing the skeleton'''
+        if not self.playing_until:
+            return 0.0
+        return self.playing_until() + self.echo_tail_ms / 1000
+
+    def close(self):
+        self._stopping = True
+        if self._thread:
+            self._thread.join(1.0)
+            self._thread = None
+        self.input.close()
+
+    def _run(self):
+        phrase = []
+        transcript = None
+        onset = 0
+        silence = 0
+        while not self._stopping:
+            frame = self.input.read()
+            if frame is None:
+                break
+            self.frames_read += 1
+            energy = frame_energy(frame)
+            if self._calibration:
+                self._calibrate(energy)
+                continue
+            speech = self.vad.is_speech(energy)
+
+            if not self.in_phrase:
+                self.ring.append(frame)
+                if speech and time.monotonic() < self.echo_until():
+                    #Most likely the skeleton, unless it's loud enough to be somebody talking over it
+                    speech = self.barge_in_factor > 0 and energy > self.vad.threshold * self.barge_in_factor
+                    if not speech:
+                        self.echoes += 1
+                        onset = 0
+                        continue #and don't let the skeleton raise the noise floor
+                if not speech:
+                    onset = 0
+                    self.vad.update(energy)
+                    continue
+                onset += 1
+                if onset < self.onset_frames:
+                    continue
+                #Start the utterance with the pre-roll, which includes the frames that confirmed the onset
+                phrase = list(self.ring)
+                self.ring.clear()
+                self.phrase_start = self.frames_read - len(phrase)
+                self.phrase_started_at = time.monotonic() - len(phrase) * self.frame_secs
+                silence = 0
+                recognizer = self.recognizer
+                if recognizer:
+                    transcript = recognizer.begin(self.input.sample_rate, self.input.frame_samples)
+                    for f in phrase:
+                        recognizer.feed(f)
+                with self.condition:
+                    self.in_phrase = True
+                if self.on_speech_start:
+                    self.on_speech_start()
+                continue
+
+            phrase.append(frame)
+            if transcript:
+                recognizer.feed(frame)
+            silence = 0 if speech else silence + 1
+            if silence >= self.pause_frames or len(phrase) >= self.max_phrase_frames:
+                self._end_phrase(phrase, silence, transcript)
+                phrase = []
+                transcript = None
+                onset = 0
+
+        if self.in_phrase:
+            self._end_phrase(phrase, silence, transcript)
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+
+    def _end_phrase(self, phrase, silence, transcript):
+        ended_at = time.monotonic()
+        #Keep as much trailing silence as there was pre-roll
+        trim = max(silence - self.preroll_frames, 0)
+        if trim:
+            phrase = phrase[:-trim]
+        speech_frames = len(phrase) - self.preroll_frames - min(silence, self.preroll_frames)
+        if transcript:
+            self.recognizer.end()
+        with self.condition:
+            self.in_phrase = False
+            if self._drop_phrase:
+                self._drop_phrase = False
+                self.dropped += 1
+            elif speech_frames >= self.min_phrase_frames:
+                self.utterances.append((phrase, transcript, ended_at - silence * self.frame_secs, ended_at))
+            self.condition.notify_all()
+
+    def _calibrate(self, energy):
+        energies, count, done = self._calibration
+        energies.append(energy)
+        if len(energies) >= count:
+            self.vad.calibrate(energies)
+            self._calibration = None
+            done.set()
+
+def capture_from_config(config, input_file=None, device_index=None):
+    '''Build the capture from the [Capture] section of .config.
+    Reads from input_file (a WAV file) if given, otherwise from the microphone, device_index if given.'''
+    section = config['Capture'] if config.has_section('Capture') else {}
+    def get(key, default):
+        return float(section.get(key, default))
+    frame_ms = get('FrameMs', 30)
+    if input_file:
+        source = WavFileInput(input_file, frame_ms)
+    else:
+        if device_index is None:
+            device_index = section.get('DeviceIndex', '').strip()
+        source = MicrophoneInput(int(device_index) if device_index != '' else None, int(get('SampleRate', 16000)), frame_ms)
+    vad = EnergyVAD(get('ThresholdRatio', 3.0), get('MinEnergy', 300), get('Adapt', 0.05))
+    return StreamingCapture(source, vad,
+                            preroll_ms=get('PreRollMs', 300),
+                            pause_ms=get('PauseMs', 600),
+                            max_phrase_secs=get('MaxPhraseSecs', 5),
+                            echo_tail_ms=get('EchoTailMs', 300),
+                            barge_in_factor=get('BargeInFactor', 4.0))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+'''Runs the --async conversation loop against fakes and checks that barge-in works.
+
+    python bench/async_harness.py
+
+A scripted visitor says hello, talks over the first reply, waits for the second reply to
+finish and then says quit. Exits non-zero if the loop misbehaves or a turn goes untraced.
+'''
+
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+from boneGPT import OpenAIController, VoicePipeline, Conversation
+from async_pipeline import AsyncRepl
+from turn_trace import TurnTracer, summarize
+from fakes import FakeSpeechSource, FakeLLM, CountingSink, fake_recognize
+
+FAKE_PIPER = os.path.join(BENCH_DIR, 'fake_piper.py')
+
+def main():
+    controller = OpenAIController("fake-key", None)
+    controller.set_prompt(Conversation([{"role": "system", "content": "You are a skeleton."}]))
+    llm = FakeLLM(["Welcome, mortal! I have a very long story to tell you about my bones. It goes on and on. And on.",
+                   "Fine, fine. Off to the door with you!"])
+    controller.create_completion = llm
+
+    sink = CountingSink()
+    voice_pipeline = VoicePipeline(FAKE_PIPER, "fake.onnx", "fake", sink=sink)
+    tracer = TurnTracer()
+    controller.tracer = tracer
+    voice_pipeline.set_tracer(tracer)
+    source = FakeSpeechSource([(0.0, "hello"), (1.5, "stop talking"), (9.0, "quit")])
+    repl = AsyncRepl(controller, voice_pipeline, source, recognize=fake_recognize)
+
+    start = time.monotonic()
+    try:
+        repl.run()
+    finally:
+        voice_pipeline.shutdown()
+    elapsed = time.monotonic() - start
+
+    failures = []
+    if repl.barge_ins != 1:
+        failures.append("expected 1 barge-in, got {}".format(repl.barge_ins))
+    if sink.cancels < 1:
+        failures.append("playback was never cancelled")
+    if llm.requests != 2:
+        failures.append("expected 2 LLM requests, got {}".format(llm.requests))
+    outcomes = [r["outcome"] for r in tracer.records]
+    if outcomes != ["barged_in", "spoken", "command"]:
+        failures.append("expected turns barged_in, spoken, command, got {}".format(outcomes))
+    elif not all(mark in tracer.records[1]["marks"] for mark in ("stt_result", "first_token", "first_sentence", "first_audio", "playback_end")):
+        failures.append("spoken turn is missing marks: {}".format(tracer.records[1]["marks"]))
+    if elapsed > 15:
+        failures.append("took {:.1f}s".format(elapsed))
+
+    print("\n{:.2f}s, {} barge-in(s), {} LLM request(s), {} frames played".format(elapsed, repl.barge_ins, llm.requests, sink.frames_written))
+    summarize(tracer.records)
+    for failure in failures:
+        print("FAIL: " + failure)
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+'''Checks the always-open capture and its voice activity detection on a synthetic recording.
+
+    python bench/bench_capture.py [--wav out.wav]
+
+Builds a recording of background noise with speech-like bursts in it, where the noise gets louder
+halfway through, and runs it through StreamingCapture from a WAV file. Checks that:
+
+  - every burst comes out as exactly one utterance, and nothing else does
+  - each utterance starts before its burst does, so the pre-roll caught the first syllable
+  - speech is detected within a few frames of starting
+  - the threshold rose with the noise
+  - a burst while the skeleton is talking (ECHO) is ignored, and doesn't raise the threshold,
+    unless it's loud enough to be the visitor talking over it
+
+Reports the VAD's cost per frame. Exits non-zero if a check fails.
+'''
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+from audio_capture import StreamingCapture, WavFileInput, EnergyVAD, frame_energy
+from make_fixtures import synth_voice, write_wav
+
+SAMPLE_RATE = 16000
+#(start, seconds) of each burst of speech
+BURSTS = [(1.0, 1.2), (3.5, 0.6), (5.0, 2.0), (9.0, 1.5), (12.0, 0.8)]
+LENGTH_SECS = 14.0
+NOISE_STEP_SECS = 7.5
+#(start, end) of the skeleton talking, around the second burst
+ECHO = (3.2, 4.3)
+
+def recording(seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(LENGTH_SECS * SAMPLE_RATE)) / SAMPLE_RATE
+    #Fog machine comes on halfway through
+    noise = rng.standard_normal(len(t)) * np.where(t < NOISE_STEP_SECS, 60, 250)
+    signal = noise
+    for i, (start, seconds) in enumerate(BURSTS):
+        voice = synth_voice(seconds, pitch=110 + 20 * i, seed=i, sample_rate=SAMPLE_RATE).astype(np.float64)
+        begin = int(start * SAMPLE_RATE)
+        signal[begin:begin + len(voice)] += voice
+    return np.clip(signal, -32768, 32767).astype('<i2')
+
+def run_capture(path, talking=None, **kwargs):
+    '''Capture everything in the WAV file at path, with the skeleton talking from talking[0] to talking[1] seconds into it.
+    Returns the capture, its onsets and its utterances.'''
+    capture = StreamingCapture(WavFileInput(path, realtime=False), EnergyVAD(), **kwargs)
+    if talking:
+        #The file is read faster than real time, so whether the skeleton is talking goes by position in the file
+        def playing_until():
+            position = capture.frames_read * capture.frame_secs
+            return time.monotonic() + 1 if talking[0] <= position < talking[1] else 0.0
+        capture.playing_until = playing_until
+    onsets = []
+    capture.on_speech_start = lambda: onsets.append((capture.phrase_start, capture.frames_read, capture.vad.threshold))
+    capture.start()
+    utterances = []
+    while True:
+        audio = capture.listen(timeout=0.5)
+        if audio is None and capture.finished:
+            break
+        if audio is not None:
+            utterances.append(audio)
+    capture.close()
+    return capture, onsets, utterances
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the streaming capture and VAD')
+    parser.add_argument('--wav', help='also keep the generated recording here')
+    args = parser.parse_args()
+
+    path = args.wav or os.path.join(tempfile.mkdtemp(), 'capture.wav')
+    write_wav(path, recording(), SAMPLE_RATE)
+
+    capture, onsets, utterances = run_capture(path)
+
+    frame_secs = capture.frame_secs
+    failures = []
+    if len(utterances) != len(BURSTS) or len(onsets) != len(BURSTS):
+        failures.append("expected {} utterances, got {} ({} onsets)".format(len(BURSTS), len(utterances), len(onsets)))
+    for (burst_start, seconds), (phrase_start, detected, threshold), audio in zip(BURSTS, onsets, utterances):
+        starts = phrase_start * frame_secs
+        delay = detected * frame_secs - burst_start
+        length = len(audio.frame_data) / 2 / SAMPLE_RATE
+        print("burst at {:.2f}s: utterance from {:.2f}s, {:.2f}s long, detected after {:.0f}ms, threshold {:.0f}".format(
+            burst_start, starts, length, 1000 * delay, threshold))
+        if starts > burst_start:
+            failures.append("utterance at {:.2f}s starts after its burst".format(burst_start))
+        if delay > 0.25:
+            failures.append("burst at {:.2f}s detected {:.0f}ms late".format(burst_start, 1000 * delay))
+        if length < seconds:
+            failures.append("burst at {:.2f}s cut short".format(burst_start))
+    quiet = [t for (start, _), (_, _, t) in zip(BURSTS, onsets) if start < NOISE_STEP_SECS]
+    loud = [t for (start, _), (_, _, t) in zip(BURSTS, onsets) if start > NOISE_STEP_SECS]
+    if quiet and loud and max(loud) <= max(quiet):
+        failures.append("threshold didn't follow the noise")
+
+    echo, echo_onsets, echo_utterances = run_capture(path, ECHO, echo_tail_ms=0, barge_in_factor=0)
+    print("skeleton talking from {:.2f}s to {:.2f}s: {} utterances, {} echo frames ignored".format(*ECHO, len(echo_utterances), echo.echoes))
+    if len(echo_utterances) != len(BURSTS) - 1 or not echo.echoes:
+        failures.append("expected the burst while the skeleton talked to be ignored, got {} utterances".format(len(echo_utterances)))
+    elif echo_onsets[1][2] > onsets[2][2] * 1.05:
+        failures.append("the skeleton raised the threshold to {:.0f}".format(echo_onsets[1][2]))
+    _, _, barge_ins = run_capture(path, ECHO, echo_tail_ms=0, barge_in_factor=1.5)
+    if len(barge_ins) != len(BURSTS):
+        failures.append("a visitor loud enough to talk over the skeleton was ignored")
+
+    samples = recording()
+    frames = [samples[i:i + 480].tobytes() for i in range(0, len(samples) - 479, 480)]
+    vad = EnergyVAD()
+    start = time.perf_counter()
+    for frame in frames:
+        vad.is_speech(frame_energy(frame))
+    elapsed = time.perf_counter() - start
+    print("VAD: {:.1f}us per 30ms frame".format(1e6 * elapsed / len(frames)))
+    for failure in failures:
+        print("FAIL: " + failure)
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+'''Checks that effects fire on their word, and that playback is known to end when it really does.
+
+    python bench/bench_effect_timing.py [--rounds 3] [--tolerance-ms 15]
+
+Runs a TTSWorker with fake piper into a PipeSink (see fakes.py), which plays in real time and blocks
+writes the way the pipe into ffplay does once the player's buffer is full. Each round says a long line,
+marks an effect, says a short one, marks another and ends the utterance, the way VoicePipeline does for
+"... {lightning} ..." in a reply. The frame each effect belongs to is known from fake piper's audio
+length, and the sink knows when that frame was really heard.
+
+Reports how far each effect fired from its word, and how far end_utterance(wait=True) (which
+close_pipeline and the capture's echo gate rely on) returned from the end of the audio. Exits non-zero
+if either is off by more than --tolerance-ms.
+'''
+
+import os
+import sys
+import time
+import argparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+from tts_worker import TTSWorker, SAMPLE_RATE
+from fakes import PipeSink
+
+FAKE_PIPER = os.path.join(BENCH_DIR, 'fake_piper.py')
+SECS_PER_CHAR = 0.06 #fake piper's default
+#Long enough to block on the pipe for seconds, and without sentence breaks so fake piper's length is exact
+LINES = ["Come closer mortal and listen to the rattle of my old bones in the cold night air",
+         "BOO"]
+
+def frames_of(line):
+    return int(len(line) * SECS_PER_CHAR * SAMPLE_RATE)
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that effects fire on their word')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--buffer-secs', type=float, default=0.5, help="how much audio the player's pipe holds")
+    parser.add_argument('--tolerance-ms', type=float, default=15)
+    args = parser.parse_args()
+
+    sink = PipeSink(args.buffer_secs)
+    worker = TTSWorker(FAKE_PIPER, "fake-model", sink)
+    worker.start()
+    errors = []
+    drain_errors = []
+    try:
+        for i in range(args.rounds):
+            time.sleep(0.5) #idle in between, as with a new visitor
+            fired = []
+            start_frame = sink.frames_written
+            worker.begin_utterance()
+            frame = start_frame
+            for line in LINES:
+                worker.say(line)
+                frame += frames_of(line)
+                worker.mark(lambda frame=frame: fired.append((frame, time.monotonic())))
+            worker.end_utterance(wait=True)
+            ended = time.monotonic()
+            time.sleep(0.05) #let the last mark's callback run
+            for frame, at in fired:
+                errors.append(1000 * (at - sink.heard_at(frame)))
+            drain_errors.append(1000 * (ended - sink.heard_at(frame)))
+            print("round {}: effects {} ms from their words, playback end {:+.1f}ms, writes blocked {:.2f}s so far".format(
+                i + 1, ", ".join("{:+.1f}".format(e) for e in errors[-len(fired):]), drain_errors[-1], sink.blocked_secs))
+            if len(fired) != len(LINES):
+                errors.append(float('inf'))
+    finally:
+        worker.stop()
+
+    failures = []
+    if max(abs(e) for e in errors) > args.tolerance_ms:
+        failures.append("an effect fired {:.1f}ms away from its word".format(max(errors, key=abs)))
+    if max(abs(e) for e in drain_errors) > args.tolerance_ms:
+        failures.append("playback was taken to end {:.1f}ms away from when it did".format(max(drain_errors, key=abs)))
+    for failure in failures:
+        print("FAIL: " + failure)
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
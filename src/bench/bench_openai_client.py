@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+'''Checks the OpenAI client's pooling, retries, deadlines, hedging and fallback against the fake server.
+
+    python bench/bench_openai_client.py [--requests 20]
+
+Each scenario gets a fresh client and fake server:
+
+    pooled     sequential replies all go over one kept-alive connection
+    flaky      the first two requests get 503s and are retried
+    stalls     every third request stalls before its first token. With hedging a second request wins;
+               without it the stalled ones fall back to a canned reply
+    down       nothing is listening, so a canned reply is spoken, quickly
+    slow       a reply which takes longer than the total deadline is cut off
+    whisper    a transcription goes through the same pool
+
+Reports the time to first token and the client's counters for each, and exits non-zero if any of
+them misbehaves.
+'''
+
+import os
+import sys
+import time
+import socket
+import argparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+from openai_client import OpenAIClient
+from turn_trace import percentiles
+from fake_openai_server import FakeOpenAIServer
+from bench_pipeline import UTTERANCE
+
+MESSAGES = [{"role": "system", "content": "You are a skeleton."}, {"role": "user", "content": "trick or treat"}]
+
+def ask(client):
+    '''Stream one reply. Returns the seconds to its first words, the reply and its finish_reason.'''
+    start = time.monotonic()
+    first_token = None
+    reply = ""
+    finish_reason = None
+    for chunk in client.chat_stream(MESSAGES, "gpt-3.5-turbo"):
+        choice = chunk.choices[0]
+        if choice.delta.get("content"):
+            if first_token is None:
+                first_token = time.monotonic() - start
+            reply += choice.delta.content
+        finish_reason = choice.get("finish_reason") or finish_reason
+    return first_token, reply, finish_reason
+
+def scenario(name, requests, server=None, **client_args):
+    api_base = server.start_in_thread() if server else "http://127.0.0.1:{}/v1".format(unused_port())
+    client = OpenAIClient("fake-key", api_base=api_base, **client_args)
+    start = time.monotonic()
+    results = [ask(client) for _ in range(requests)]
+    elapsed = time.monotonic() - start
+    client.close()
+    first_tokens = [1000 * r[0] for r in results if r[0] is not None]
+    p50, p95 = percentiles(first_tokens, (50, 95)) if first_tokens else (0, 0)
+    print("{:8} {:>3} replies in {:5.1f}s, first token p50 {:>5.0f}ms p95 {:>5.0f}ms max {:>5.0f}ms  {}".format(
+        name, requests, elapsed, p50, p95, max(first_tokens, default=0), client.stats()))
+    return client.stats(), results
+
+def unused_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the OpenAI client against the fake server')
+    parser.add_argument('--requests', type=int, default=20)
+    args = parser.parse_args()
+    n = args.requests
+    failures = []
+    def expect(condition, message):
+        if not condition:
+            failures.append(message)
+
+    stats, results = scenario("pooled", n, FakeOpenAIServer(first_token_secs=0.05, chunk_secs=0.005))
+    expect(stats["connections_opened"] == 1, "pooled: opened {} connections".format(stats["connections_opened"]))
+    expect(stats["connections_reused"] >= n - 1, "pooled: reused only {} connections".format(stats["connections_reused"]))
+    expect(all(r[2] == "stop" for r in results), "pooled: not every reply finished")
+
+    stats, results = scenario("flaky", 1, FakeOpenAIServer(first_token_secs=0.05, fail_first=2), backoff_secs=0.05)
+    expect(stats["retries"] == 2 and results[0][2] == "stop", "flaky: {} retries, finished {}".format(stats["retries"], results[0][2]))
+
+    stats, results = scenario("stalls", n, FakeOpenAIServer(first_token_secs=0.1, chunk_secs=0.005, stall_every=3), first_token_secs=0.5)
+    expect(stats["hedges"] == stats["hedge_wins"] > 0, "stalls: {} hedges, {} won".format(stats["hedges"], stats["hedge_wins"]))
+    expect(stats["fallbacks"] == 0, "stalls: fell back {} times with hedging on".format(stats["fallbacks"]))
+    expect(max(r[0] for r in results) < 1.0, "stalls: a hedged reply still took {:.2f}s".format(max(r[0] for r in results)))
+    stats, results = scenario("no-hedge", n, FakeOpenAIServer(first_token_secs=0.1, chunk_secs=0.005, stall_every=3), first_token_secs=0.5, hedge=False)
+    expect(stats["fallbacks"] == n // 3, "no-hedge: expected {} fallbacks, got {}".format(n // 3, stats["fallbacks"]))
+
+    stats, results = scenario("down", 1, connect_secs=0.5, backoff_secs=0.05)
+    expect(results[0][2] == "fallback" and results[0][1], "down: no canned reply")
+    expect(results[0][0] < 1.0, "down: the canned reply took {:.2f}s".format(results[0][0]))
+
+    stats, results = scenario("slow", 1, FakeOpenAIServer(first_token_secs=0.05, chunk_secs=0.2), total_secs=1.0)
+    expect(stats["cut_off"] == 1 and results[0][2] == "length", "slow: not cut off")
+
+    server = FakeOpenAIServer()
+    client = OpenAIClient("fake-key", api_base=server.start_in_thread())
+    with open(UTTERANCE, 'rb') as f:
+        text = client.transcribe(f.read())
+    print("whisper  transcribed {!r}  {}".format(text, client.stats()))
+    expect(text == server.transcript, "whisper: got {!r}".format(text))
+    client.close()
+
+    for failure in failures:
+        print("FAIL: " + failure)
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
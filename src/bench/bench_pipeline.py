@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+'''Offline replay benchmark for the whole voice pipeline.
+
+    python bench/bench_pipeline.py [--conversations 4] [--turns 3] [--realtime] [--output replies.wav] [--filler-ms 1000]
+
+Runs back-to-back conversations through VoicePipeline and OpenAIController with nothing real attached:
+
+  - visitors are fixtures/utterance.wav, run through the capture and its VAD, and recognized from a
+    script of visitor lines (or with --stt sphinx-stream, locally by pocketsphinx)
+  - OpenAI is bench/fake_openai_server.py on localhost, replaying the recorded token streams in
+    fixtures/token_streams.jsonl as server-sent events, reached through openai_client.py
+  - piper is bench/fake_piper.py, and the voice effects run in-process as usual
+  - audio goes to a NullSink, or to a WAV file with --output
+  - with --filler-ms, a filler clip is played when a reply hasn't started that long after the
+    visitor stopped talking (see filler.py). Try it with a slow --first-token-ms.
+
+Every turn is traced (see turn_trace.py) along with the CPU time used by this process and by piper,
+and the resident memory of both. Reports time to first audio (and to first sound, filler or reply),
+turn time, CPU and RSS per turn and the throughput of the whole run, and exits non-zero if any of them is worse than the limits in
+--thresholds (max_<result> or min_<result>, see pipeline_thresholds.json, which is set for a desktop
+and may need loosening on a Pi). Needs no network, audio device or display. Linux only, as CPU and
+memory are read from /proc.
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(BENCH_DIR, '..')
+sys.path.insert(0, SRC_DIR)
+from boneGPT import OpenAIController, VoicePipeline, Conversation
+from tts_worker import NullSink, WavFileSink
+from voice_fx import VoiceFXChain
+from audio_capture import StreamingCapture, WavFileInput
+from turn_trace import TurnTracer, percentiles, summarize
+from fake_openai_server import FakeOpenAIServer
+from filler import FillerScheduler
+
+FAKE_PIPER = os.path.join(BENCH_DIR, 'fake_piper.py')
+UTTERANCE = os.path.join(BENCH_DIR, 'fixtures', 'utterance.wav')
+TOKEN_STREAMS = os.path.join(BENCH_DIR, 'fixtures', 'token_streams.jsonl')
+PROMPT = os.path.join(SRC_DIR, 'openai_prompt.json')
+THRESHOLDS = os.path.join(BENCH_DIR, 'pipeline_thresholds.json')
+
+VISITOR_LINES = ["trick or treat", "are you real", "tell me a joke", "you don't scare me", "happy halloween", "what's your name"]
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+def process_cpu_secs(pid):
+    '''User plus system CPU time of a process, from /proc'''
+    with open('/proc/{}/stat'.format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+def process_rss_mb(pid):
+    with open('/proc/{}/statm'.format(pid)) as f:
+        return int(f.read().split()[1]) * PAGE_SIZE / 2**20
+
+class Usage:
+    '''CPU and memory of this process plus piper'''
+    def __init__(self, voice_pipeline):
+        self.voice_pipeline = voice_pipeline
+
+    def pids(self):
+        return [os.getpid()] + self.voice_pipeline.tts.piper.pids()
+
+    def cpu_secs(self):
+        return sum(process_cpu_secs(pid) for pid in self.pids())
+
+    def rss_mb(self):
+        return sum(process_rss_mb(pid) for pid in self.pids())
+
+def capture_utterance(voice_pipeline, path):
+    '''Run a recording through the capture and its VAD, like a visitor speaking into the microphone'''
+    capture = StreamingCapture(WavFileInput(path, realtime=False))
+    capture.recognizer = voice_pipeline.streaming_stt
+    capture.start()
+    audio = capture.listen(timeout=5)
+    capture.close()
+    return audio
+
+def run(args):
+    with open(TOKEN_STREAMS) as f:
+        streams = [json.loads(line)["deltas"] for line in f if line.strip()]
+    server = FakeOpenAIServer(first_token_secs=args.first_token_ms / 1000, chunk_secs=args.chunk_ms / 1000, streams=streams)
+    api_base = server.start_in_thread()
+
+    controller = OpenAIController("fake-key", None, api_base)
+    with open(PROMPT) as f:
+        controller.set_prompt(Conversation(json.load(f)))
+    sink = WavFileSink(args.output, realtime=args.realtime) if args.output else NullSink(realtime=args.realtime)
+    fillers = FillerScheduler(deadline_secs=args.filler_ms / 1000) if args.filler_ms else None
+    voice_pipeline = VoicePipeline(FAKE_PIPER, "fake.onnx", args.stt, sink=sink, fx_chain=None if args.no_fx else VoiceFXChain(),
+                                   fillers=fillers)
+    voice_pipeline.prepare_fillers()
+    if args.stt == 'fixture':
+        lines = itertools.cycle(VISITOR_LINES)
+        voice_pipeline.recognize = lambda audio: next(lines)
+    tracer = TurnTracer(args.trace)
+    controller.tracer = tracer
+    voice_pipeline.set_tracer(tracer)
+    usage = Usage(voice_pipeline)
+
+    def turn():
+        audio = capture_utterance(voice_pipeline, UTTERANCE)
+        cpu = usage.cpu_secs()
+        trace = voice_pipeline.begin_turn(audio)
+        text = voice_pipeline.recognize(audio)
+        trace.mark('stt_result')
+        voice_pipeline.respond_to(trace)
+        controller.conversation.add_user_message(text or "...")
+        controller.stream_completion(voice_pipeline, speech_end=audio.speech_end)
+        tracer.note('cpu_ms', round(1000 * (usage.cpu_secs() - cpu), 1))
+        tracer.note('rss_mb', round(usage.rss_mb(), 1))
+        voice_pipeline.end_turn('spoken')
+
+    try:
+        for _ in range(args.warmup):
+            turn()
+        warm = len(tracer.records)
+        start = time.monotonic()
+        for _ in range(args.conversations):
+            controller.reset()
+            voice_pipeline.reset()
+            for _ in range(args.turns):
+                turn()
+        elapsed = time.monotonic() - start
+    finally:
+        voice_pipeline.shutdown()
+        sink.close()
+        tracer.close()
+        controller.client.close()
+    return tracer.records[warm:], elapsed
+
+def results_of(records, elapsed, conversations):
+    def p95(values):
+        return percentiles(values, (95,))[0]
+    ttfa = [r["stages"]["time_to_first_audio"] for r in records]
+    ttfs = [r["stages"]["time_to_first_sound"] for r in records]
+    turns = [r["stages"]["turn"] for r in records]
+    cpu = [r["notes"]["cpu_ms"] for r in records]
+    rss = [r["notes"]["rss_mb"] for r in records]
+    return {
+        "turns": len(records),
+        "time_to_first_audio_p50_ms": percentiles(ttfa, (50,))[0],
+        "time_to_first_audio_p95_ms": p95(ttfa),
+        "time_to_first_sound_p50_ms": percentiles(ttfs, (50,))[0],
+        "time_to_first_sound_p95_ms": p95(ttfs),
+        "fillers": sum(1 for r in records if "filler" in r["marks"]),
+        "turn_p50_ms": percentiles(turns, (50,))[0],
+        "turn_p95_ms": p95(turns),
+        "cpu_per_turn_ms": round(sum(cpu) / len(cpu), 1),
+        "cpu_per_turn_p95_ms": p95(cpu),
+        "rss_max_mb": max(rss),
+        "rss_growth_mb": round(rss[-1] - rss[0], 1),
+        "turns_per_min": round(60 * len(records) / elapsed, 1),
+        "conversations_per_min": round(60 * conversations / elapsed, 2),
+    }
+
+def check(results, thresholds):
+    '''Limits named max_<result> or min_<result>. Returns the ones that were broken.'''
+    failures = []
+    for name, limit in thresholds.items():
+        kind, _, key = name.partition('_')
+        value = results.get(key)
+        if value is None:
+            failures.append("unknown limit {}".format(name))
+            continue
+        if (kind == 'max' and value > limit) or (kind == 'min' and value < limit):
+            failures.append("{} is {}, limit {}".format(key, value, limit))
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline replay benchmark for the voice pipeline')
+    parser.add_argument('--conversations', type=int, default=4)
+    parser.add_argument('--turns', type=int, default=3, help='turns per conversation')
+    parser.add_argument('--warmup', type=int, default=1, help='turns to run before measuring')
+    parser.add_argument('--first-token-ms', type=float, default=300)
+    parser.add_argument('--chunk-ms', type=float, default=20)
+    parser.add_argument('--stt', default='fixture', choices=['fixture', 'sphinx-stream'])
+    parser.add_argument('--no-fx', action='store_true', help='skip the in-process voice effects')
+    parser.add_argument('--filler-ms', type=float, help='play a filler when a reply is this late')
+    parser.add_argument('--realtime', action='store_true', help='play replies in real time instead of as fast as they are made')
+    parser.add_argument('--output', help='write the replies to this WAV file instead of discarding them')
+    parser.add_argument('--trace', help='also append the turns to this JSONL file')
+    parser.add_argument('--results', help='write the results to this JSON file')
+    parser.add_argument('--thresholds', default=THRESHOLDS, help='JSON file of regression limits')
+    args = parser.parse_args()
+
+    records, elapsed = run(args)
+    print()
+    summarize(records)
+    results = results_of(records, elapsed, args.conversations)
+    for key, value in results.items():
+        print("{:28} {}".format(key, value))
+    if args.results:
+        with open(args.results, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    with open(args.thresholds) as f:
+        failures = check(results, json.load(f))
+    for failure in failures:
+        print("FAIL: " + failure)
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
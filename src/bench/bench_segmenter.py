@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+'''Micro-benchmark and property checks for the stream segmenter.
+
+    python bench/bench_segmenter.py [--repeat 2000] [--trials 500]
+
+Replays the recorded token streams in fixtures/token_streams.jsonl through StreamSegmenter and reports
+the cost per delta and how many deltas arrive before the first sentence can go to TTS. Then it checks,
+on randomly generated responses split into random deltas, that:
+
+  - the events are the same however the text is split into deltas
+  - every letter and digit ends up in exactly one event, and spoken text keeps its order
+  - spoken text never contains braces or asterisks
+  - effect word offsets fall inside the sentence they belong to
+
+Exits non-zero if any property fails.
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+from stream_segmenter import StreamSegmenter, Speak, Sfx, Discard
+
+TOKEN_STREAMS = os.path.join(BENCH_DIR, 'fixtures', 'token_streams.jsonl')
+
+VOCAB = ["trick", "or", "treat", "dear", "mortal", "bones", "3", "5", "206", "boo", "mwahaha", "don't", "candy", "door", "ghost"]
+PUNCTUATION = [".", "!", "?", ",", ";", ":", "...", "?!", "\n", "\"", ")"]
+
+def load_streams(path):
+    with open(path) as f:
+        return [json.loads(line)["deltas"] for line in f if line.strip()]
+
+def run(deltas, **kwargs):
+    segmenter = StreamSegmenter(**kwargs)
+    events = []
+    for delta in deltas:
+        events += segmenter.feed(delta)
+    return events + segmenter.finish()
+
+def deltas_to_first_speak(deltas, **kwargs):
+    segmenter = StreamSegmenter(**kwargs)
+    for i, delta in enumerate(deltas):
+        if any(isinstance(e, Speak) for e in segmenter.feed(delta)):
+            return i + 1
+    return len(deltas)
+
+def bench(streams, repeat):
+    deltas = sum(len(s) for s in streams)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for stream in streams:
+            run(stream)
+    elapsed = time.perf_counter() - start
+    print("{} streams, {} deltas: {:.2f}us per delta, {:.0f} deltas/s".format(
+        len(streams), deltas, 1e6 * elapsed / (deltas * repeat), deltas * repeat / elapsed))
+    for comma_flush in ('never', 'first'):
+        firsts = [deltas_to_first_speak(s, comma_flush=comma_flush) for s in streams]
+        print("comma_flush={}: deltas before first sentence {}".format(comma_flush, firsts))
+
+def random_text(rng):
+    parts = []
+    for _ in range(rng.randint(1, 40)):
+        roll = rng.random()
+        if roll < 0.6:
+            parts.append(rng.choice(VOCAB))
+        elif roll < 0.8:
+            parts.append(rng.choice(PUNCTUATION))
+        elif roll < 0.9:
+            parts.append("{" + rng.choice(["blackout", "lightning", " Lightning "]) + ("}" if rng.random() < 0.9 else ""))
+        else:
+            parts.append("*" + rng.choice(VOCAB) + ("*" if rng.random() < 0.9 else ""))
+        parts.append(rng.choice([" ", " ", "", "  "]))
+    return "".join(parts)
+
+def random_split(rng, text):
+    cuts = sorted(rng.sample(range(1, len(text)), min(len(text) - 1, rng.randint(0, 20)))) if len(text) > 1 else []
+    bounds = [0] + cuts + [len(text)]
+    return [text[a:b] for a, b in zip(bounds, bounds[1:])]
+
+def alnum(text):
+    return "".join(c for c in text if c.isalnum())
+
+def check(trials, seed):
+    rng = random.Random(seed)
+    failures = []
+    for trial in range(trials):
+        text = random_text(rng)
+        whole = run([text])
+        def fail(reason):
+            failures.append("{}: {!r} -> {}".format(reason, text, whole))
+
+        if run(random_split(rng, text)) != whole or run(list(text)) != whole:
+            fail("depends on how deltas are split")
+        spoken = "".join(e.text for e in whole if isinstance(e, Speak))
+        other = "".join(e.text if isinstance(e, Discard) else e.name for e in whole if not isinstance(e, Speak))
+        if len(alnum(spoken)) + len(alnum(other)) != len(alnum(text)):
+            fail("letters lost or duplicated")
+        it = iter(alnum(text))
+        if not all(c in it for c in alnum(spoken)):
+            fail("spoken text out of order")
+        if any(c in spoken for c in "{}*"):
+            fail("braces or asterisks spoken")
+        for i, event in enumerate(whole):
+            if isinstance(event, Sfx):
+                following = next((e for e in whole[i:] if isinstance(e, Speak)), None)
+                if following and event.word_offset > len(following.text.split()):
+                    fail("effect offset past the end of its sentence")
+    for failure in failures[:10]:
+        print("FAIL " + failure)
+    print("{} random responses checked, {} failures".format(trials, len(failures)))
+    return not failures
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark and check the stream segmenter')
+    parser.add_argument('--streams', default=TOKEN_STREAMS, help='JSONL file of recorded token streams')
+    parser.add_argument('--repeat', type=int, default=2000)
+    parser.add_argument('--trials', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    bench(load_streams(args.streams), args.repeat)
+    sys.exit(0 if check(args.trials, args.seed) else 1)
+
+if __name__ == "__main__":
+    main()
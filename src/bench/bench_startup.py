@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+'''Startup time, from launching python to ready for the first visitor, broken down by phase.
+
+    python bench/bench_startup.py [--stt sphinx-stream] [--rounds 3] [--piper-load-secs 1.0]
+
+Starts a station the way boneGPT.py does, in a fresh process each time, with the same fakes as
+bench_pipeline.py: the fake OpenAI server (run here, so the station process imports what it would
+for real), fake piper (taking --piper-load-secs to load its model), fixtures/utterance.wav in place of
+the microphone and a NullSink. Each run reports readiness on a ReadinessSocket, which is polled from
+here, as a supervisor would.
+
+Startup is run both ways, serially and as --daemon does with its phases in parallel, and each of
+those with the TTS cache empty (a fresh install) and filled by an earlier boot (every boot after that).
+Reports the median of --rounds runs of each, and every phase: the python interpreter, imports, setup
+(config and building the pipeline), and then per station calibrate, stt and render, and openai.
+Exits non-zero if the parallel startup isn't faster than the serial one with the cache filled. With it
+empty, both are mostly waiting on piper to load its model and render, so parallel only has to be no
+more than --slack slower.
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+import configparser
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(BENCH_DIR, '..')
+sys.path.insert(0, SRC_DIR)
+from startup import Startup, ReadinessSocket, wait_until_ready
+
+FAKE_PIPER = os.path.join(BENCH_DIR, 'fake_piper.py')
+UTTERANCE = os.path.join(BENCH_DIR, 'fixtures', 'utterance.wav')
+PROMPT = os.path.join(SRC_DIR, 'openai_prompt.json')
+
+def start_station(args):
+    '''In the station process: start up and report readiness, then wait to be told to stop'''
+    imports_started = time.monotonic()
+    from boneGPT import StationManager
+    from tts_worker import NullSink
+    setup_started = time.monotonic()
+
+    startup = Startup(parallel=args.only == 'daemon', started=args.spawned)
+    startup.record("python", args.spawned, imports_started)
+    startup.record("imports", imports_started, setup_started)
+    config = configparser.ConfigParser()
+    config.read_dict({
+        'OpenAI': {'TokenBudget': '2000'},
+        'TTSCache': {'Directory': args.cache_dir},
+    })
+    manager = StationManager(config, FAKE_PIPER, "fake-key", None, args.api_base)
+    manager.add("bonejangles", PROMPT, args.stt, input_file=UTTERANCE, sink=NullSink(realtime=True))
+    startup.record("setup", setup_started)
+
+    ready_socket = ReadinessSocket(args.socket, startup)
+    ready_socket.start()
+    try:
+        manager.start_up(startup)
+        sys.stdin.read()
+    finally:
+        ready_socket.close()
+        manager.shutdown()
+    print(json.dumps(startup.status()))
+
+def boot(args, mode, cache_dir, socket_path):
+    '''Launch a station process. Returns the startup status it reported, with the time we saw it ready.'''
+    spawned = time.monotonic()
+    command = [sys.executable, os.path.abspath(__file__), '--only', mode, '--spawned', repr(spawned), '--stt', args.stt,
+               '--cache-dir', cache_dir, '--socket', socket_path, '--api-base', args.api_base]
+    env = dict(os.environ, FAKE_PIPER_LOAD_SECS=str(args.piper_load_secs))
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, env=env)
+    status = wait_until_ready(socket_path, args.timeout)
+    seen = time.monotonic() - spawned
+    process.stdin.close()
+    output = process.stdout.read()
+    process.wait()
+    if not status or not status["ready"]:
+        raise RuntimeError("{} startup never became ready".format(mode))
+    status = json.loads(output.splitlines()[-1])
+    status["seen_ms"] = round(1000 * seen, 1)
+    return status
+
+def median_status(statuses):
+    phases = {}
+    for status in statuses:
+        for name, phase in status["phases"].items():
+            phases.setdefault(name, []).append(phase)
+    return {"ready_ms": statistics.median(s["ready_ms"] for s in statuses),
+            "seen_ms": statistics.median(s["seen_ms"] for s in statuses),
+            "phases": {name: {key: statistics.median(p[key] for p in values) for key in ("start_ms", "ms")} for name, values in phases.items()}}
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup time by phase, serial and parallel')
+    parser.add_argument('--stt', default='sphinx-stream', choices=['google', 'openai', 'sphinx', 'sphinx-stream'])
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--piper-load-secs', type=float, default=1.0, help="how long the fake piper takes to load its model")
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--slack', type=float, default=0.1, help='how much slower parallel may be with the TTS cache empty')
+    parser.add_argument('--only', choices=['serial', 'daemon'], help=argparse.SUPPRESS)
+    parser.add_argument('--spawned', type=float, help=argparse.SUPPRESS)
+    parser.add_argument('--cache-dir', help=argparse.SUPPRESS)
+    parser.add_argument('--socket', help=argparse.SUPPRESS)
+    parser.add_argument('--api-base', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.only:
+        start_station(args)
+        return
+
+    from fake_openai_server import FakeOpenAIServer
+    args.api_base = FakeOpenAIServer().start_in_thread()
+    work_dir = tempfile.mkdtemp(prefix="bench_startup")
+    socket_path = os.path.join(work_dir, "ready.sock")
+    results = {}
+    try:
+        for cache in ("empty", "filled"):
+            for mode in ("serial", "daemon"):
+                statuses = []
+                for i in range(args.rounds):
+                    cache_dir = os.path.join(work_dir, "{}-{}-{}".format(mode, cache, i))
+                    if cache == "filled":
+                        boot(args, mode, cache_dir, socket_path)
+                    statuses.append(boot(args, mode, cache_dir, socket_path))
+                results[(mode, cache)] = median_status(statuses)
+    finally:
+        shutil.rmtree(work_dir)
+
+    for (mode, cache), result in results.items():
+        print("{} startup, TTS cache {}: ready in {:.0f}ms (seen on the socket at {:.0f}ms)".format(mode, cache, result["ready_ms"], result["seen_ms"]))
+        for name, phase in result["phases"].items():
+            print("  {:24} at {:>6.0f}ms  {:>6.0f}ms".format(name, phase["start_ms"], phase["ms"]))
+
+    failures = []
+    for cache in ("empty", "filled"):
+        serial, daemon = results[("serial", cache)]["ready_ms"], results[("daemon", cache)]["ready_ms"]
+        print("TTS cache {}: parallel startup {:.0f}ms faster ({:.0%})".format(cache, serial - daemon, 1 - daemon / serial))
+        if daemon > serial * (1 + args.slack if cache == "empty" else 1):
+            failures.append("with the TTS cache {}, parallel startup took {:.0f}ms, serial {:.0f}ms".format(cache, daemon, serial))
+    for failure in failures:
+        print("FAIL: " + failure)
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
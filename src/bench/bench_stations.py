@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+'''Checks that stations sharing one process share its models fairly and cheaply.
+
+    python bench/bench_stations.py [--stations 4] [--turns 4] [--piper-workers 1] [--rtf 0.2]
+
+Runs one station, then --stations of them at once, each in a fresh process, through StationManager
+with the same fakes as bench_pipeline.py: the fake OpenAI server, fake piper (slowed down to --rtf so
+the stations really do compete for it) and a PipeSink for each station, which plays in real time and
+blocks writes like the pipe into ffplay. Every station talks to its own visitor, all of them at the same
+time, with a random pause of up to --pause-ms between turns so the stations don't fall into step (in
+lockstep, the same station can land behind the same long line every turn).
+
+Reports each station's time to first audio, how far apart the stations are (the slowest station's mean
+over the fastest's; on any one turn somebody has to be last in line for piper) and what each extra station costs in memory, counting piper. Exits non-zero if the
+stations are treated unfairly, if an extra station costs more than --max-station-share of a whole
+single station process, or if more piper processes were started than --piper-workers.
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import itertools
+import threading
+import subprocess
+import configparser
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(BENCH_DIR, '..')
+sys.path.insert(0, SRC_DIR)
+from boneGPT import StationManager
+from turn_trace import percentiles
+from fake_openai_server import FakeOpenAIServer
+from bench_pipeline import FAKE_PIPER, UTTERANCE, TOKEN_STREAMS, PROMPT, VISITOR_LINES, process_rss_mb, capture_utterance
+from fakes import PipeSink
+
+def make_config(piper_workers):
+    config = configparser.ConfigParser()
+    config.read_dict({
+        'OpenAI': {'TokenBudget': '2000'},
+        #Every reply has to come from OpenAI and piper, or there'd be nothing to share
+        'ResponseCache': {'Enabled': 'no'},
+        'TTSCache': {'Enabled': 'no'},
+        'Stations': {'PiperWorkers': str(piper_workers), 'Model': 'fake.onnx'},
+    })
+    return config
+
+def talk(station, turns, pause_secs, seed):
+    '''A visitor talking to station for turns turns'''
+    voice_pipeline = station.voice_pipeline
+    controller = station.controller
+    lines = itertools.cycle(VISITOR_LINES)
+    voice_pipeline.recognize = lambda audio: next(lines)
+    pauses = random.Random(seed)
+    for _ in range(turns):
+        time.sleep(pauses.uniform(0, pause_secs))
+        audio = capture_utterance(voice_pipeline, UTTERANCE)
+        trace = voice_pipeline.begin_turn(audio)
+        text = voice_pipeline.recognize(audio)
+        trace.mark('stt_result')
+        voice_pipeline.respond_to(trace)
+        controller.conversation.add_user_message(text)
+        controller.stream_completion(voice_pipeline, speech_end=audio.speech_end)
+        voice_pipeline.end_turn('spoken')
+
+def run(args):
+    '''Run args.only stations at once in this process'''
+    os.environ['FAKE_PIPER_RTF'] = str(args.rtf)
+    with open(TOKEN_STREAMS) as f:
+        streams = [json.loads(line)["deltas"] for line in f if line.strip()]
+    server = FakeOpenAIServer(first_token_secs=args.first_token_ms / 1000, streams=streams)
+    api_base = server.start_in_thread()
+
+    manager = StationManager(make_config(args.piper_workers), FAKE_PIPER, "fake-key", None, api_base)
+    for i in range(args.only):
+        manager.add("station{}".format(i), PROMPT, 'fake', sink=PipeSink())
+
+    threads = [threading.Thread(target=talk, args=(station, args.turns, args.pause_ms / 1000, i)) for i, station in enumerate(manager.stations)]
+    start = time.monotonic()
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+        pids = [pid for piper in manager.pipers.values() for pid in piper.pids()]
+        rss = process_rss_mb(os.getpid()) + sum(process_rss_mb(pid) for pid in pids)
+    finally:
+        manager.shutdown()
+
+    ttfa = {station.name: [r["stages"]["time_to_first_audio"] for r in station.tracer.records] for station in manager.stations}
+    return {"stations": args.only, "elapsed_secs": round(elapsed, 2), "rss_mb": round(rss, 1), "piper_processes": len(pids),
+            "ttfa_mean_ms": {name: round(sum(values) / len(values), 1) for name, values in ttfa.items()},
+            "ttfa_p50_ms": {name: percentiles(values, (50,))[0] for name, values in ttfa.items()},
+            "ttfa_p95_ms": {name: percentiles(values, (95,))[0] for name, values in ttfa.items()}}
+
+def run_in_subprocess(args, stations):
+    '''Each size runs in a fresh process, so its memory isn't flattered by the one before'''
+    command = [sys.executable, os.path.abspath(__file__), '--only', str(stations), '--turns', str(args.turns),
+               '--piper-workers', str(args.piper_workers), '--rtf', str(args.rtf), '--first-token-ms', str(args.first_token_ms),
+               '--pause-ms', str(args.pause_ms)]
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description='Fairness and memory of several stations in one process')
+    parser.add_argument('--stations', type=int, default=4)
+    parser.add_argument('--turns', type=int, default=4, help='turns per station')
+    parser.add_argument('--piper-workers', type=int, default=1)
+    parser.add_argument('--rtf', type=float, default=0.2, help='real-time factor of the fake piper')
+    parser.add_argument('--first-token-ms', type=float, default=300)
+    parser.add_argument('--pause-ms', type=float, default=1000, help="longest pause between a visitor's turns")
+    parser.add_argument('--max-spread', type=float, default=1.5, help="slowest station's mean time to first audio over the fastest's")
+    parser.add_argument('--max-station-share', type=float, default=0.5, help='memory of each extra station as a share of a single station process')
+    parser.add_argument('--only', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.only:
+        results = run(args)
+        print(json.dumps(results))
+        return
+
+    single = run_in_subprocess(args, 1)
+    many = run_in_subprocess(args, args.stations)
+    failures = []
+    for results in (single, many):
+        print("{} station(s): {:.1f}s, {} piper process(es), {:.1f} MB".format(results["stations"], results["elapsed_secs"], results["piper_processes"], results["rss_mb"]))
+        for name, p95 in results["ttfa_p95_ms"].items():
+            print("  {:10} time to first audio mean {:>6.0f}ms p50 {:>6.0f}ms p95 {:>6.0f}ms".format(
+                name, results["ttfa_mean_ms"][name], results["ttfa_p50_ms"][name], p95))
+        if results["piper_processes"] > args.piper_workers:
+            failures.append("{} stations started {} piper processes".format(results["stations"], results["piper_processes"]))
+
+    means = many["ttfa_mean_ms"].values()
+    spread = max(means) / min(means)
+    per_station_mb = (many["rss_mb"] - single["rss_mb"]) / max(args.stations - 1, 1)
+    print("spread {:.2f}, each extra station {:.1f} MB ({:.0%} of one station)".format(spread, per_station_mb, per_station_mb / single["rss_mb"]))
+    if spread > args.max_spread:
+        failures.append("spread is {:.2f}, limit {}".format(spread, args.max_spread))
+    if per_station_mb > args.max_station_share * single["rss_mb"]:
+        failures.append("each extra station costs {:.1f} MB, limit {:.1f}".format(per_station_mb, args.max_station_share * single["rss_mb"]))
+    for failure in failures:
+        print("FAIL: " + failure)
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
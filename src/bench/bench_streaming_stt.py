@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+'''Measures what streaming recognition and speculative requests save on each turn.
+
+    python bench/bench_streaming_stt.py [--first-token-ms 500]
+
+Plays the synthetic recording from bench_capture.py in real time through the capture and the
+pocketsphinx streaming recognizer, and answers every utterance with a fake OpenAI, twice: once
+waiting for the final transcript before asking, once asking as soon as the transcript is stable.
+Reports how long before the end of each utterance its transcript settled, how long the final
+transcript took after it, and the time from the end of the utterance to the first word of the reply.
+Exits non-zero if speculation never paid off.
+'''
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+from boneGPT import OpenAIController, Conversation
+from audio_capture import StreamingCapture, WavFileInput
+from streaming_stt import SphinxStreamingRecognizer
+from make_fixtures import write_wav
+from bench_capture import recording, SAMPLE_RATE
+from fakes import FakeLLM
+
+class FirstWord:
+    '''Stands in for the voice pipeline and notes when the reply starts'''
+    def __init__(self):
+        self.at = None
+
+    def handle_stream_start(self, speech_end=None):
+        pass
+
+    def handle_stream_content(self, content):
+        if self.at is None:
+            self.at = time.monotonic()
+
+    def handle_stream_stop(self):
+        pass
+
+def run(path, speculate, first_token_secs):
+    controller = OpenAIController("fake-key", None)
+    controller.set_prompt(Conversation([{"role": "system", "content": "You are a skeleton."}]))
+    llm = FakeLLM(["Boo!"], first_token_secs=first_token_secs)
+    controller.create_completion = llm
+
+    stable_at = {}
+    def on_stable(transcript, text):
+        stable_at[id(transcript)] = time.monotonic()
+        if speculate:
+            controller.speculate(text)
+    recognizer = SphinxStreamingRecognizer(on_stable=on_stable)
+    capture = StreamingCapture(WavFileInput(path))
+    capture.recognizer = recognizer
+    capture.start()
+
+    turns = []
+    while True:
+        audio = capture.listen(timeout=0.5)
+        if audio is None:
+            if capture.finished:
+                break
+            continue
+        ended = time.monotonic()
+        text = audio.transcript.wait(5)
+        final_at = time.monotonic()
+        controller.conversation.add_user_message(text or "...")
+        reply = FirstWord()
+        controller.stream_completion(reply)
+        stable = stable_at.get(id(audio.transcript))
+        turns.append((text, audio.transcript.stable, ended - stable if stable else None, final_at - ended, reply.at - ended))
+    capture.close()
+    recognizer.close()
+    return turns, llm.requests, llm.closed
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure streaming STT and speculative requests')
+    parser.add_argument('--first-token-ms', type=float, default=500)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'capture.wav')
+    write_wav(path, recording(), SAMPLE_RATE)
+
+    results = {}
+    for speculate in (False, True):
+        turns, requests, closed = run(path, speculate, args.first_token_ms / 1000)
+        print("speculate={}: {} turns, {} requests, {} closed early".format(speculate, len(turns), requests, closed))
+        for text, stable, lead, final_latency, first_word in turns:
+            print("  {!r:24} stable {:>6} before the end, final {:.0f}ms after, first word {:.0f}ms after{}".format(
+                text, "{:.0f}ms".format(1000 * lead) if lead is not None else "never", 1000 * final_latency, 1000 * first_word,
+                "" if stable in (None, text) else " (guessed {!r})".format(stable)))
+        results[speculate] = [t[4] for t in turns]
+
+    baseline = sum(results[False]) / len(results[False])
+    speculative = sum(results[True]) / len(results[True])
+    print("mean time to first word: {:.0f}ms waiting for the transcript, {:.0f}ms speculating".format(1000 * baseline, 1000 * speculative))
+    if speculative >= baseline:
+        print("FAIL: speculation didn't help")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+'''Offline benchmark of the in-process voice effects chain against the ffmpeg filter graph.
+
+    python bench/bench_voice_fx.py [--wav bench/fixtures/utterance.wav] [--block 1024] [--repeat 5]
+
+Reports throughput (seconds of audio per second) for both, and how long each block takes to come out
+the other end. For the numpy chain that's the time to process it. ffmpeg is fed the fixture a block at a
+time in real time from a writer thread, the way piper's audio reaches it while playing, and a block has
+come out once as much output as it accounts for (allowing for atempo) has been read. For ffmpeg this also
+reports what every response used to pay, process start to first output.
+'''
+
+import os
+import sys
+import time
+import wave
+import shutil
+import argparse
+import threading
+import statistics
+from subprocess import Popen, PIPE, DEVNULL
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tts_worker import SAMPLE_RATE, SAMPLE_WIDTH, VOICE_FILTER, VOICE_FILTER_TEMPO
+from voice_fx import VoiceFXChain
+
+DEFAULT_WAV = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'utterance.wav')
+#The same as FfplaySink runs it
+FFMPEG_ARGS = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-nostats", "-fflags", "nobuffer", "-f", "s16le", "-ar", str(SAMPLE_RATE), "-i", "-",
+               "-filter_complex", VOICE_FILTER, "-flush_packets", "1", "-f", "s16le", "pipe:1"]
+
+def read_wav(path):
+    with wave.open(path, 'rb') as f:
+        if f.getnchannels() != 1 or f.getsampwidth() != SAMPLE_WIDTH or f.getframerate() != SAMPLE_RATE:
+            raise ValueError("{} must be mono s16 at {} Hz".format(path, SAMPLE_RATE))
+        return f.readframes(f.getnframes())
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def bench_numpy(audio, block_frames, repeat):
+    block_bytes = block_frames * SAMPLE_WIDTH
+    latencies = []
+    total = 0.0
+    for _ in range(repeat):
+        chain = VoiceFXChain()
+        start = time.perf_counter()
+        for i in range(0, len(audio), block_bytes):
+            t = time.perf_counter()
+            chain.process(audio[i:i + block_bytes])
+            latencies.append(time.perf_counter() - t)
+        chain.flush()
+        total += time.perf_counter() - start
+    return total / repeat, latencies
+
+def bench_ffmpeg(audio, repeat):
+    '''Throughput: the whole fixture through a fresh ffmpeg as fast as it goes'''
+    totals = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        proc = Popen(FFMPEG_ARGS, stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+        proc.communicate(audio)
+        totals.append(time.perf_counter() - start)
+    return totals
+
+def bench_ffmpeg_blocks(audio, block_frames, repeat):
+    '''Per block latency, feeding blocks in real time from a writer thread so the pipes never fill up both ways'''
+    block_bytes = block_frames * SAMPLE_WIDTH
+    block_secs = block_frames / SAMPLE_RATE
+    first_outputs = []
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        proc = Popen(FFMPEG_ARGS, stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+        written = []
+        def feed():
+            for i in range(0, len(audio), block_bytes):
+                written.append(time.perf_counter())
+                proc.stdin.write(audio[i:i + block_bytes])
+                proc.stdin.flush()
+                time.sleep(max(start + len(written) * block_secs - time.perf_counter(), 0))
+            proc.stdin.close()
+        writer = threading.Thread(target=feed, daemon=True)
+        writer.start()
+        read = 0
+        block = 0
+        while True:
+            data = proc.stdout.read1(65536)
+            if not data:
+                break
+            now = time.perf_counter()
+            if not read:
+                first_outputs.append(now - start)
+            read += len(data)
+            #atempo stretches the audio, so a block has come out once its stretched length has
+            while block < len(written) and read >= int(min((block + 1) * block_bytes, len(audio)) / VOICE_FILTER_TEMPO) // SAMPLE_WIDTH * SAMPLE_WIDTH:
+                latencies.append(now - written[block])
+                block += 1
+        writer.join()
+        proc.wait()
+    return first_outputs, latencies
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the voice effects chain')
+    parser.add_argument('--wav', default=DEFAULT_WAV, help='mono s16 WAV fixture at 22050 Hz')
+    parser.add_argument('--block', type=int, default=1024, help='block size in frames')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    audio = read_wav(args.wav)
+    audio_secs = len(audio) / SAMPLE_WIDTH / SAMPLE_RATE
+    block_ms = 1000 * args.block / SAMPLE_RATE
+    print("Fixture: {} ({:.2f}s), block {} frames ({:.1f}ms)".format(args.wav, audio_secs, args.block, block_ms))
+
+    total, latencies = bench_numpy(audio, args.block, args.repeat)
+    print("numpy:  {:.1f}x realtime, per block p50 {:.2f}ms p95 {:.2f}ms max {:.2f}ms".format(
+        audio_secs / total, 1000 * statistics.median(latencies), 1000 * percentile(latencies, 95), 1000 * max(latencies)))
+
+    if not shutil.which("ffmpeg"):
+        print("ffmpeg: not found on PATH, skipped")
+        return
+    totals = bench_ffmpeg(audio, args.repeat)
+    first_outputs, latencies = bench_ffmpeg_blocks(audio, args.block, args.repeat)
+    print("ffmpeg: {:.1f}x realtime, per block p50 {:.2f}ms p95 {:.2f}ms max {:.2f}ms, start to first output p50 {:.2f}ms".format(
+        audio_secs / statistics.median(totals), 1000 * statistics.median(latencies), 1000 * percentile(latencies, 95), 1000 * max(latencies),
+        1000 * statistics.median(first_outputs)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+'''Local stand-in for the OpenAI chat completions API.
+
+    python bench/fake_openai_server.py --port 8765
+    python boneGPT.py --openai-key fake --openai-api-base http://127.0.0.1:8765/v1
+
+Serves canned replies on /v1/chat/completions, streamed as server-sent events in the same shape as
+OpenAI's, with configurable time to first token and time between chunks. Replies can also be recorded
+token streams (see fixtures/token_streams.jsonl), which are sent one recorded delta per chunk.
+It can also misbehave: answer the first requests with 503s, or stall every so often before the first
+token. /v1/audio/transcriptions stands in for Whisper. GET /stats reports how many requests it has answered.
+'''
+
+import json
+import time
+import asyncio
+import argparse
+import itertools
+import threading
+
+from aiohttp import web
+
+DEFAULT_REPLIES = [
+    "Trick or treat, dear mortal! Why don't skeletons fight each other? They don't have the guts! Now off to the door for some candy!",
+    "Oh, you think you're fearless, do you? {blackout} BOO! Ha ha ha! Off you go to the door, little one.",
+    "Happy Halloween! I'm as real as the bones rattling in your closet. The candy is at the door!",
+]
+
+class FakeOpenAIServer:
+    def __init__(self, replies=None, first_token_secs=0.3, chunk_secs=0.03, chunk_chars=4, streams=None,
+                 fail_first=0, stall_every=0, stall_secs=5.0, transcript="trick or treat"):
+        '''streams, if given, is a list of recorded replies, each a list of content deltas, used instead of replies.
+        The first fail_first requests get a 503, and every stall_every'th waits stall_secs for its first token.'''
+        self.replies = itertools.cycle(streams or replies or DEFAULT_REPLIES)
+        self.first_token_secs = first_token_secs
+        self.chunk_secs = chunk_secs
+        self.chunk_chars = chunk_chars
+        self.fail_first = fail_first
+        self.stall_every = stall_every
+        self.stall_secs = stall_secs
+        self.transcript = transcript
+        self.requests = 0
+        self.app = web.Application()
+        self.app.router.add_post('/v1/chat/completions', self.chat_completions)
+        self.app.router.add_post('/v1/audio/transcriptions', self.transcriptions)
+        self.app.router.add_get('/stats', self.stats)
+        self._runner = None
+
+    def chunks(self, reply):
+        '''The deltas of one streamed reply'''
+        yield {"role": "assistant"}, None
+        deltas = reply if isinstance(reply, list) else [reply[i:i + self.chunk_chars] for i in range(0, len(reply), self.chunk_chars)]
+        for delta in deltas:
+            yield {"content": delta}, None
+        yield {}, "stop"
+
+    async def chat_completions(self, request):
+        body = await request.json()
+        self.requests += 1
+        if self.requests <= self.fail_first:
+            return web.json_response({"error": {"message": "The server is overloaded"}}, status=503)
+        reply = next(self.replies)
+        stalled = self.stall_every and self.requests % self.stall_every == 0
+        await asyncio.sleep(self.stall_secs if stalled else self.first_token_secs)
+        created = int(time.time())
+        if not body.get("stream"):
+            reply = reply if isinstance(reply, str) else "".join(reply)
+            return web.json_response({"id": "chatcmpl-fake", "object": "chat.completion", "created": created, "model": body.get("model"),
+                                      "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}]})
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        try:
+            await response.prepare(request)
+            for i, (delta, finish_reason) in enumerate(self.chunks(reply)):
+                if i > 0:
+                    await asyncio.sleep(self.chunk_secs)
+                chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": created, "model": body.get("model"),
+                         "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+                await response.write("data: {}\n\n".format(json.dumps(chunk)).encode())
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+        except ConnectionResetError:
+            pass #the client stopped reading, e.g. a barge-in or a hedged request that lost
+        return response
+
+    async def transcriptions(self, request):
+        form = await request.post()
+        self.requests += 1
+        if "file" not in form:
+            return web.json_response({"error": {"message": "No file"}}, status=400)
+        return web.json_response({"text": self.transcript})
+
+    async def stats(self, request):
+        return web.json_response({"requests": self.requests})
+
+    def start_in_thread(self, host='127.0.0.1', port=0):
+        '''Serve from a background thread. Returns the API base URL.'''
+        started = threading.Event()
+        def serve():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            self._runner = web.AppRunner(self.app)
+            loop.run_until_complete(self._runner.setup())
+            site = web.TCPSite(self._runner, host, port)
+            loop.run_until_complete(site.start())
+            self.port = self._runner.addresses[0][1]
+            started.set()
+            loop.run_forever()
+        threading.Thread(target=serve, name="fake-openai", daemon=True).start()
+        started.wait()
+        return "http://{}:{}/v1".format(host, self.port)
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the OpenAI chat API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--replies', help='JSON file with a list of replies to cycle through')
+    parser.add_argument('--streams', help='JSONL file of recorded token streams to cycle through instead, like fixtures/token_streams.jsonl')
+    parser.add_argument('--first-token-ms', type=float, default=300)
+    parser.add_argument('--chunk-ms', type=float, default=30)
+    args = parser.parse_args()
+
+    replies = None
+    if args.replies:
+        with open(args.replies) as f:
+            replies = json.load(f)
+    streams = None
+    if args.streams:
+        with open(args.streams) as f:
+            streams = [json.loads(line)["deltas"] for line in f if line.strip()]
+    server = FakeOpenAIServer(replies, args.first_token_ms / 1000, args.chunk_ms / 1000, streams=streams)
+    web.run_app(server.app, host=args.host, port=args.port)
+
+if __name__ == "__main__":
+    main()
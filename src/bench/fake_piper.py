@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+'''Stand-in for the piper binary, for running the pipeline on a box without piper or a voice model.
+
+Speaks the same protocol as `piper --model <model> --output_raw`: reads lines on stdin, writes
+s16le audio for each line on stdout and logs a "Real-time factor" line on stderr when the line is done.
+The audio is a tone whose length is proportional to the length of the line.
+
+Environment:
+    FAKE_PIPER_SECS_PER_CHAR  seconds of audio per character of text (default 0.06)
+    FAKE_PIPER_RTF            synthesis time as a fraction of the audio length (default 0.1)
+    FAKE_PIPER_LOAD_SECS      pretend model load time at startup (default 0)
+    FAKE_PIPER_PAUSE_SECS     extra time taken before each sentence of a line after the first (default 0)
+'''
+
+import os
+import re
+import sys
+import time
+import math
+import array
+
+SAMPLE_RATE = 22050
+
+def main():
+    secs_per_char = float(os.getenv('FAKE_PIPER_SECS_PER_CHAR', '0.06'))
+    rtf = float(os.getenv('FAKE_PIPER_RTF', '0.1'))
+    pause_secs = float(os.getenv('FAKE_PIPER_PAUSE_SECS', '0'))
+    time.sleep(float(os.getenv('FAKE_PIPER_LOAD_SECS', '0')))
+
+    tone = array.array('h', (int(8000 * math.sin(2 * math.pi * 180 * n / SAMPLE_RATE)) for n in range(SAMPLE_RATE)))
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        audio_secs = len(line) * secs_per_char
+        #Like piper, each sentence is synthesized and written before the next one is started
+        for i, sentence in enumerate(re.findall(r'.+?(?:[.!?]\s+|$)', line)):
+            time.sleep(len(sentence) * secs_per_char * rtf + (pause_secs if i else 0))
+            samples = int(len(sentence) * secs_per_char * SAMPLE_RATE)
+            while samples > 0:
+                n = min(samples, len(tone))
+                sys.stdout.buffer.write(tone[:n].tobytes())
+                samples -= n
+            sys.stdout.buffer.flush()
+        sys.stderr.write("[piper] [info] Real-time factor: {} (infer={} sec(s), audio={} sec(s))\n".format(rtf, audio_secs * rtf, audio_secs))
+        sys.stderr.flush()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+'''Local stand-ins for the microphone, the audio player and OpenAI, so the pipeline can run headless and offline.'''
+
+import time
+import itertools
+
+from tts_worker import NullSink, SAMPLE_WIDTH
+from response_cache import ChunkDict, stream_chunk
+
+class FakeAudio:
+    '''Recorded "audio" which already knows what was said'''
+    def __init__(self, text):
+        self.text = text
+
+def fake_recognize(audio):
+    return audio.text
+
+class FakeSpeechSource:
+    '''Plays back a script of (seconds from start, text) as if visitors were talking into the microphone.
+    Calls on_speech_start when each line starts and returns it once the visitor has finished saying it.'''
+    def __init__(self, script, listen_timeout=0.5, secs_per_char=0.03):
+        self.script = list(script)
+        self.listen_timeout = listen_timeout
+        self.secs_per_char = secs_per_char
+        self.on_speech_start = None
+        self.start = None
+
+    def listen(self):
+        if self.start is None:
+            self.start = time.monotonic()
+        if not self.script:
+            time.sleep(self.listen_timeout)
+            return None
+        at, text = self.script[0]
+        wait = self.start + at - time.monotonic()
+        if wait > self.listen_timeout:
+            time.sleep(self.listen_timeout)
+            return None
+        time.sleep(max(wait, 0))
+        self.script.pop(0)
+        if self.on_speech_start:
+            self.on_speech_start()
+        time.sleep(len(text) * self.secs_per_char)
+        return FakeAudio(text)
+
+    def close(self):
+        pass
+
+class FakeLLM:
+    '''Replaces OpenAIController.create_completion with canned replies streamed a few characters at a time'''
+    def __init__(self, replies, first_token_secs=0.2, chunk_chars=4, chunk_secs=0.02):
+        self.replies = itertools.cycle(replies)
+        self.first_token_secs = first_token_secs
+        self.chunk_chars = chunk_chars
+        self.chunk_secs = chunk_secs
+        self.requests = 0
+        self.closed = 0
+
+    def __call__(self, stream=False, **kwargs):
+        self.requests += 1
+        reply = next(self.replies)
+        if not stream:
+            time.sleep(self.first_token_secs)
+            return ChunkDict(choices=[ChunkDict(message=ChunkDict(role="assistant", content=reply))])
+        return FakeStream(self, reply)
+
+class FakeStream:
+    '''A streamed reply from FakeLLM which, like openai_client.ChatStream, can be closed from another thread'''
+    def __init__(self, llm, reply):
+        self.llm = llm
+        self.closed = False
+        self.chunks = self._chunks(reply)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.closed:
+            raise StopIteration
+        try:
+            return next(self.chunks)
+        except StopIteration:
+            self.closed = True
+            raise
+
+    def close(self):
+        '''FakeLLM.closed counts the streams closed before the end of their reply'''
+        if not self.closed:
+            self.closed = True
+            self.llm.closed += 1
+
+    def _chunks(self, reply):
+        time.sleep(self.llm.first_token_secs)
+        yield stream_chunk({"role": "assistant"})
+        for i in range(0, len(reply), self.llm.chunk_chars):
+            time.sleep(self.llm.chunk_secs)
+            yield stream_chunk({"content": reply[i:i + self.llm.chunk_chars]})
+        yield stream_chunk({}, "stop")
+
+class CountingSink(NullSink):
+    '''Plays in real time into nowhere, counting what happens to it'''
+    def __init__(self, realtime=True):
+        super().__init__(realtime=realtime)
+        self.cancels = 0
+
+    def cancel(self):
+        super().cancel()
+        self.cancels += 1
+
+class PipeSink(NullSink):
+    '''Plays in real time through a pipe into a player which buffers buffer_secs of audio.
+    Like a pipe, a write blocks until everything but what fits in the buffer has been played.
+    heard_at(frame) is when a frame written so far really is heard.'''
+    def __init__(self, buffer_secs=0.5, tempo=1.0):
+        super().__init__(tempo=tempo, realtime=True)
+        self.buffer_secs = buffer_secs
+        self.blocked_secs = 0.0
+        self._heard = [] #(first frame of a write, when it's heard)
+        self._frames = 0
+        self._device_until = 0.0
+
+    def _write(self, data):
+        now = time.monotonic()
+        start = max(self._device_until, now)
+        self._heard.append((self._frames, start))
+        frames = len(data) // SAMPLE_WIDTH
+        self._frames += frames
+        self._device_until = start + frames / self.sample_rate / self.tempo
+        delay = self._device_until - self.buffer_secs - now
+        if delay > 0:
+            self.blocked_secs += delay
+            time.sleep(delay)
+
+    def heard_at(self, frame):
+        for first, start in reversed(self._heard):
+            if first <= frame:
+                return start + (frame - first) / self.sample_rate / self.tempo
+        return None
+
+    def cancel(self):
+        super().cancel()
+        self._device_until = 0.0
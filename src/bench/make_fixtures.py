@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+'''Regenerates the synthetic audio fixtures used by the benchmarks.
+
+The fixtures are speech-like (a gliding harmonic voice with syllable-rate envelope and some breath noise)
+so they exercise the effects chain and voice activity detection without shipping recordings of anyone.
+'''
+
+import os
+import re
+import sys
+import json
+import wave
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tts_worker import SAMPLE_RATE
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def synth_voice(seconds, pitch=120, syllables_per_sec=4, seed=0, sample_rate=SAMPLE_RATE):
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    f0 = pitch * (1 + 0.15 * np.sin(2 * np.pi * 0.7 * t))
+    phase = 2 * np.pi * np.cumsum(f0) / sample_rate
+    voice = sum(np.sin(k * phase) / k for k in range(1, 12))
+    envelope = np.clip(np.sin(np.pi * syllables_per_sec * t), 0, None) ** 0.5
+    signal = 0.25 * voice * envelope + 0.01 * rng.standard_normal(len(t))
+    return (np.clip(signal, -1, 1) * 32767).astype('<i2')
+
+def write_wav(path, samples, sample_rate=SAMPLE_RATE):
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(samples.tobytes())
+
+#Replies in the style Bonejangles actually gives, including the effects and asterisks he isn't supposed to use
+REPLIES = [
+    "Trick or treat, dear mortal! Ah, the perfect time for a bone-chilling joke! Why don't skeletons fight each other? They don't have the guts! Now, off you go to the door, where candy awaits you in the shadows!",
+    "Oh, you think you're fearless, do you? Well, let's put your courage to the test, shall we? Legend has it that a mischievous ghost haunts these very streets, waiting to scare unsuspecting trick-or-treaters. Beware, for if you feel a sudden chill and a feather-like touch on your neck, it may just be the ghostly presence paying you a visit... {blackout} BOOOO!",
+    "Oh, a brave attempt, but let me show you how it's done! {lightning} ... BOOM! Ha ha ha! Now, off you go to the door and let the candy magic begin! Happy haunting!",
+    "*rattles bones* Mwahaha! I'm as real as the 206 bones in your body, little one. Well, 205.5 after that last fright! Off to the door with you!",
+    "Happy Halloween! I'm Bonejangles, the skeleton who loves to give frights and delights.\nAre you brave enough to talk to me?",
+]
+
+def token_stream(text):
+    '''Split text roughly the way the OpenAI tokenizer streams it: words with their leading space, punctuation on its own'''
+    return re.findall(r"\s?[A-Za-z']+|\s?\d|\s?[^\sA-Za-z\d]|\s+", text)
+
+def main():
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    write_wav(os.path.join(FIXTURES_DIR, 'utterance.wav'), synth_voice(3.0))
+    with open(os.path.join(FIXTURES_DIR, 'token_streams.jsonl'), 'w') as f:
+        for reply in REPLIES:
+            f.write(json.dumps({"deltas": token_stream(reply)}) + '\n')
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,36 @@
 #!/usr/bin/env python3
 
+import time
+STARTED = time.monotonic() #before the imports below, so startup can say how long they took
+
 import os
 import sys
 import argparse
 import configparser
-import openai
-import speech_recognition as sr
 import json
-from subprocess import Popen, PIPE, DEVNULL
-
-validSttProviders = ['google', 'openai', 'sphinx']
+import functools
+import threading
+from tts_worker import TTSWorker, PiperPool, FfplaySink, VOICE_FILTER, VOICE_FILTER_TEMPO
+from voice_fx import fx_chain_from_config
+from tts_cache import phrase_cache_from_config
+from response_cache import response_cache_from_config, replay_stream, normalize
+from stream_segmenter import StreamSegmenter, Speak, Sfx, segment
+from sfx import EffectRegistry, LogEffect, effects_from_config
+from async_pipeline import AsyncRepl
+from audio_capture import StreamingCapture, MicrophoneInput, capture_from_config
+from streaming_stt import SphinxStreamingRecognizer, streaming_stt_from_config
+from turn_trace import TurnTracer
+from filler import filler_scheduler_from_config
+from openai_client import OpenAIClient, openai_client_from_config
+from startup import Startup, ReadinessSocket
+
+validSttProviders = ['google', 'openai', 'sphinx', 'sphinx-stream']
+
+DEFAULT_MODEL = "en-us-ryan-high.onnx"
+INTRO_LINE = "Happy Halloween! I'm Bonejangles, the skeleton who loves to give frights and delights. Are you brave enough to talk to me?"
 
 def main():
+    main_started = time.monotonic()
     parser = argparse.ArgumentParser(
                         prog='Bone-GPT', 
                         description='AI Voice Assistant Pipeline for Halloween Decorations')
@@ -23,8 +42,26 @@ def main():
                         help='An API Key for OpenAI. May alternatively be provided in the .config file or in the environment as OPENAI_APIKEY')
     parser.add_argument('--openai-organization', dest='openaiOrganization',
                         help='An Organization for the OpenAI API. If omitted, the default Organization for your OpenAI account will be used. May alternatively be provided in the .config file or in the environment as OPENAI_ORGANIZATION')
+    parser.add_argument('--openai-api-base', dest='openaiApiBase',
+                        help='Base URL for the OpenAI API, e.g. to point at a local stand-in server. May alternatively be provided in the .config file')
     parser.add_argument('--stt-provider', dest='sttProvider', choices=validSttProviders,
                         help='Select Speech-to-Text provider.')
+    parser.add_argument('--async', action='store_true', dest='asyncMode',
+                        help='Listen, recognize and respond concurrently so visitors can talk over the skeleton.')
+    parser.add_argument('--no-barge-in', action='store_false', dest='bargeIn',
+                        help='In --async mode, keep talking when a visitor speaks during a response.')
+    parser.add_argument('--prewarm', action='store_true', dest='prewarmOnly',
+                        help='Synthesize the intro, the prompt replies and the phrase list into the TTS cache, then exit.')
+    parser.add_argument('--input-file', dest='inputFile',
+                        help='Read visitors from a mono 16 bit WAV file instead of the microphone.')
+    parser.add_argument('--trace', dest='traceFile',
+                        help='Append the timing of every turn to this JSONL file. Summarize it with turn_trace.py. May alternatively be provided in the .config file')
+    parser.add_argument('--stations', nargs='*', metavar='NAME',
+                        help='Serve several animatronics from one process, as described by the [Station:<name>] sections of the .config file. Runs them all unless some are named.')
+    parser.add_argument('--daemon', action='store_true', dest='daemon',
+                        help='Start up as fast as possible, loading and calibrating everything in parallel, and report readiness on a unix socket.')
+    parser.add_argument('--ready-socket', dest='readySocket',
+                        help='Unix socket to report readiness on. Defaults to Daemon.Socket in the .config file with --daemon.')
     
     args = parser.parse_args()
 
@@ -37,6 +74,9 @@ def main():
     if not args.openaiOrganization:
         args.openaiOrganization = config['OpenAI']['OpenAIOrganization']
 
+    if not args.openaiApiBase:
+        args.openaiApiBase = config['OpenAI'].get('OpenAIApiBase')
+
     if not args.openaiApiKey:
         args.openaiApiKey = os.getenv('OPENAI_APIKEY')
     if not args.openaiOrganization:
@@ -59,20 +99,32 @@ def main():
     
     print("Using STT Provider '{}'".format(args.sttProvider))
 
-    controller = OpenAIController(args.openaiApiKey, args.openaiOrganization)
-    prompt_conversation = Conversation()
-    with open(args.promptFilePath) as f:
-        prompt_conversation = Conversation(json.load(f))
-    controller.set_prompt(prompt_conversation)
+    if not args.traceFile:
+        args.traceFile = config.get('Trace', 'File', fallback=None)
 
-    voice_pipeline = VoicePipeline(config['Paths']['PiperPath'],"en-us-ryan-high.onnx", args.sttProvider, args.openaiApiKey)
-    voice_pipeline.adjust_input_ambient_level()
+    if not args.readySocket and args.daemon:
+        args.readySocket = config.get('Daemon', 'Socket', fallback='/tmp/boneGPT.sock')
 
-    motd()
-    intro_line = "Happy Halloween! I'm Bonejangles, the skeleton who loves to give frights and delights. Are you brave enough to talk to me?"
-    voice_pipeline.vocalize(intro_line)
+    manager = StationManager(config, config['Paths']['PiperPath'], args.openaiApiKey, args.openaiOrganization, args.openaiApiBase, args.traceFile)
+    if args.stations is None:
+        manager.add("bonejangles", args.promptFilePath, args.sttProvider, input_file=args.inputFile)
+    else:
+        manager.add_from_config(args.stations, args.sttProvider)
+        if not manager.stations:
+            print('\n\nError: No [Station:<name>] sections to run in the .config file.\n\n', file=sys.stderr)
+            exit(-1)
 
-    repl(controller, voice_pipeline)
+    if args.prewarmOnly:
+        manager.prewarm()
+        print("Prewarmed TTS cache: {}".format(manager.phrase_cache.stats() if manager.phrase_cache else "disabled"))
+        manager.shutdown()
+        return
+
+    startup = Startup(parallel=args.daemon, started=STARTED)
+    startup.record("imports", STARTED, main_started)
+    startup.record("setup", main_started)
+    motd()
+    manager.run(args.asyncMode, args.bargeIn, startup, args.readySocket)
 
 def repl(controller, voice_pipeline):
     consecutive_idles = 0
@@ -94,81 +146,382 @@ def repl(controller, voice_pipeline):
 
             if user_input == "clear":
                 controller.reset()
+                voice_pipeline.end_turn('command')
                 print("Cleared conversation.")
                 continue
 
             if user_input in ('quit', 'exit'):
+                voice_pipeline.end_turn('command')
                 print("\n>>> Goodbye!")
                 break
 
             controller.conversation.add_user_message(user_input)
-            controller.stream_completion(voice_pipeline)
+            controller.stream_completion(voice_pipeline, speech_end=voice_pipeline.speech_end)
+            voice_pipeline.end_turn('spoken')
             print()
             
     except KeyboardInterrupt:
         print('\n>>> Goodbye!')
 
+class Station:
+    '''One animatronic: its own microphone, speaker, prompt and conversation'''
+    def __init__(self, name, controller, voice_pipeline, tracer, prewarm_phrases):
+        self.name = name
+        self.controller = controller
+        self.voice_pipeline = voice_pipeline
+        self.tracer = tracer
+        self.prewarm_phrases = prewarm_phrases
+        self.thread = None
+
+    def prepare(self, startup):
+        '''Add the phases that get this station ready for its first visitor to startup'''
+        phases = [("calibrate", self.voice_pipeline.adjust_input_ambient_level), ("stt", self.voice_pipeline.load_stt), ("render", self.render)]
+        if startup.parallel:
+            #Loading pocketsphinx holds the GIL, so piper gets its work first and renders while that happens.
+            #One after another, piper loads its model while the others run.
+            phases.insert(0, phases.pop())
+        for name, step in phases:
+            startup.phase(self.name + "." + name, step)
+
+    def render(self):
+        '''Render the fillers and the first sentence of the intro, which also waits for piper to load its model.
+        The rest of the intro is synthesized while the first sentence plays.'''
+        self.voice_pipeline.prepare_fillers()
+        self.voice_pipeline.prewarm(self.voice_pipeline.speakable_sentences(INTRO_LINE)[:1], wait=True)
+
+    def run(self, async_mode=False, barge_in=True):
+        self.voice_pipeline.vocalize(INTRO_LINE)
+        self.voice_pipeline.prewarm(self.prewarm_phrases)
+        if async_mode:
+            AsyncRepl(self.controller, self.voice_pipeline, self.voice_pipeline.open_capture(), barge_in=barge_in).run()
+        else:
+            repl(self.controller, self.voice_pipeline)
+
+    def start(self, async_mode=False, barge_in=True):
+        self.thread = threading.Thread(target=self.run, args=(async_mode, barge_in), name="station-" + self.name, daemon=True)
+        self.thread.start()
+
+    def shutdown(self):
+        self.voice_pipeline.shutdown()
+        print("Latency ({}): {}".format(self.name, self.tracer.summary()))
+        self.tracer.close()
+
+class StationManager:
+    '''Serves one or more stations from a single process.
+
+    Each station has its own capture, speech recognizer, voice effects, sink and conversation.
+    The heavy parts are shared between them: the piper processes for each voice model (a PiperPool,
+    which takes lines from the stations in turn), the TTS phrase cache, one response cache per prompt
+    and the OpenAIClient with its pool of connections. Each station runs in its own thread.
+    '''
+    def __init__(self, config, piper_path, openai_key, openai_organization=None, openai_api_base=None, trace_path=None):
+        self.config = config
+        self.piper_path = piper_path
+        self.openai_key = openai_key
+        self.openai_organization = openai_organization
+        self.openai_api_base = openai_api_base
+        self.trace_path = trace_path
+        stations_config = config['Stations'] if config.has_section('Stations') else {}
+        self.model = stations_config.get('Model', DEFAULT_MODEL)
+        self.piper_workers = int(stations_config.get('PiperWorkers', 1))
+        self.phrase_cache = phrase_cache_from_config(config)
+        self.pipers = {} #model -> PiperPool
+        self.prompts = {} #prompt file -> (Conversation, ResponseCache)
+        self.stations = []
+        self.openai_client = openai_client_from_config(config, openai_key, openai_organization, openai_api_base)
+
+    def piper(self, model):
+        if model not in self.pipers:
+            self.pipers[model] = PiperPool(self.piper_path, model, self.piper_workers)
+        return self.pipers[model]
+
+    def prompt(self, path):
+        '''The prompt in path and the response cache for it. Replies depend on the prompt, so stations only share
+        a response cache with stations using the same one.'''
+        if path not in self.prompts:
+            with open(path) as f:
+                prompt_conversation = Conversation(json.load(f))
+            response_cache = response_cache_from_config(self.config)
+            if response_cache:
+                response_cache.seed(prompt_conversation.messages)
+            self.prompts[path] = (prompt_conversation, response_cache)
+        return self.prompts[path]
+
+    def add(self, name, prompt_path, stt_provider, model=None, input_device=None, output_device=None, input_file=None, sink=None):
+        config = self.config
+        model = model or self.model
+        prompt_conversation, response_cache = self.prompt(prompt_path)
+        controller = OpenAIController(self.openai_key, self.openai_organization, self.openai_api_base, response_cache,
+                                      int(config['OpenAI'].get('TokenBudget', 2000)), client=self.openai_client)
+        controller.set_prompt(prompt_conversation)
+
+        fx_chain = fx_chain_from_config(config)
+        if sink is None:
+            sink = FfplaySink(device=output_device) if fx_chain else FfplaySink(VOICE_FILTER, tempo=VOICE_FILTER_TEMPO, device=output_device)
+        segmenter_config = config['Segmenter'] if config.has_section('Segmenter') else {}
+        voice_pipeline = VoicePipeline(self.piper_path, model, stt_provider, self.openai_key, fx_chain, sink=sink,
+                                       cache=self.phrase_cache,
+                                       comma_flush=segmenter_config.get('CommaFlush', 'first'),
+                                       min_clause_words=int(segmenter_config.get('MinClauseWords', 4)),
+                                       effects=effects_from_config(config, device=output_device),
+                                       capture=capture_from_config(config, input_file, input_device),
+                                       streaming_stt=streaming_stt_from_config(config, stt_provider),
+                                       piper=self.piper(model),
+                                       openai_client=self.openai_client,
+                                       fillers=filler_scheduler_from_config(config))
+        tracer = TurnTracer(self.trace_path, name)
+        controller.tracer = tracer
+        voice_pipeline.set_tracer(tracer)
+        if voice_pipeline.streaming_stt and config.getboolean('StreamingSTT', 'Speculate', fallback=True):
+            #Ask OpenAI as soon as the transcript settles, without waiting for the end of the utterance
+            voice_pipeline.streaming_stt.on_stable = lambda transcript, text: controller.speculate(text)
+
+        prewarm_phrases = [INTRO_LINE] + [m["content"] for m in prompt_conversation.messages if m["role"] == "assistant"]
+        if config.has_option('TTSCache', 'PrewarmFile') and os.path.exists(config['TTSCache']['PrewarmFile']):
+            with open(config['TTSCache']['PrewarmFile']) as f:
+                prewarm_phrases += [line for line in f.read().splitlines() if line.strip()]
+
+        station = Station(name, controller, voice_pipeline, tracer, prewarm_phrases)
+        self.stations.append(station)
+        return station
+
+    def add_from_config(self, names=None, stt_provider=None):
+        '''Add the stations described by [Station:<name>] sections, only the ones in names if any are given'''
+        for section in self.config.sections():
+            kind, _, name = section.partition(':')
+            if kind != 'Station' or (names and name not in names):
+                continue
+            station_config = self.config[section]
+            station_stt_provider = station_config.get('STTProvider') or stt_provider
+            if station_stt_provider not in validSttProviders:
+                raise ValueError("Station {} has no valid STTProvider".format(name))
+            print("Station '{}' using STT Provider '{}'".format(name, station_stt_provider))
+            self.add(name, station_config.get('PromptFile') or self.config['OpenAI']['OpenAIPromptFile'], station_stt_provider,
+                     model=station_config.get('Model') or None,
+                     input_device=station_config.get('InputDevice', '').strip() or None,
+                     output_device=station_config.get('OutputDevice', '').strip() or None,
+                     input_file=station_config.get('InputFile') or None)
+
+    def prewarm(self):
+        for station in self.stations:
+            station.voice_pipeline.prewarm(station.prewarm_phrases, wait=True)
+
+    def start_up(self, startup):
+        '''Get every station ready for its first visitor, and connect to OpenAI'''
+        startup.phase("openai", self.openai_client.warm)
+        for station in self.stations:
+            station.prepare(startup)
+        startup.wait()
+        startup.ready()
+        print("Startup: " + startup.summary())
+
+    def run(self, async_mode=False, barge_in=True, startup=None, ready_socket=None):
+        '''Start up, then run every station until they have all quit or there's a KeyboardInterrupt.
+        If ready_socket is given, readiness is reported on it (see startup.py).'''
+        startup = startup or Startup(parallel=False)
+        ready_socket = ReadinessSocket(ready_socket, startup) if ready_socket else None
+        try:
+            if ready_socket:
+                ready_socket.start()
+            self.start_up(startup)
+            if len(self.stations) == 1:
+                self.stations[0].run(async_mode, barge_in)
+            else:
+                for station in self.stations:
+                    station.start(async_mode, barge_in)
+                #Join with a timeout, otherwise Ctrl-C isn't delivered until every station has finished
+                for station in self.stations:
+                    while station.thread.is_alive():
+                        station.thread.join(0.5)
+        except KeyboardInterrupt:
+            print('\n>>> Goodbye!')
+        finally:
+            if ready_socket:
+                ready_socket.close()
+            self.shutdown()
+
+    def shutdown(self):
+        for station in self.stations:
+            station.shutdown()
+        for piper in self.pipers.values():
+            piper.stop()
+        for path, (_, response_cache) in self.prompts.items():
+            if response_cache:
+                print("Response cache ({}): {}".format(path, response_cache.stats()))
+        print("OpenAI: {}".format(self.openai_client.stats()))
+        self.openai_client.close()
+
+def estimate_tokens(message):
+    #Roughly 4 characters per token, plus the per-message overhead of the chat format
+    return len(message["content"]) // 4 + 4
+
 class Conversation:
-    def __init__(self, messages=[]):
-        self.messages = messages
+    '''A prompt prefix, shared and never modified, followed by the messages of the current visit'''
+    def __init__(self, messages=None, prefix=()):
+        self.prefix = tuple(prefix)
+        self.tail = list(messages) if messages else []
+        self.trimmed_messages = 0
     def __repr__(self):
         return 'Conversation()'
     def __str__(self):
         return str(self.messages)
+    @property
+    def messages(self):
+        return list(self.prefix) + self.tail
     def clear(self):
-        self.messages = []
+        self.tail = []
     def current_role(self):
-        try:
-            return self.messages[-1]["role"]
-        except:
-            return "none"
+        #Called for every streamed delta, so don't build the whole list of messages
+        if self.tail:
+            return self.tail[-1]["role"]
+        return self.prefix[-1]["role"] if self.prefix else "none"
     def add_message(self, role, message):
-        self.messages.append({"role": role, "content": message})
+        self.tail.append({"role": role, "content": message})
     def add_system_message(self, message):
-        self.messages.append({"role": "system", "content": message})
+        self.tail.append({"role": "system", "content": message})
     def add_user_message(self, message):
-        self.messages.append({"role": "user", "content": message})
+        self.tail.append({"role": "user", "content": message})
     def add_assistant_message(self, message):
-        self.messages.append({"role": "assistant", "content": message})
+        self.tail.append({"role": "assistant", "content": message})
     def last_message(self):
-        return self.messages[-1]["content"]
+        return (self.tail or self.prefix)[-1]["content"]
     def append_stream_content(self, content):
         #inserts streaming content into the last message
-        self.messages[-1]["content"] += content
+        self.tail[-1]["content"] += content
+    def estimate_tokens(self):
+        return sum(estimate_tokens(m) for m in self.prefix) + sum(estimate_tokens(m) for m in self.tail)
+    def trim_to(self, token_budget):
+        '''Drop the oldest turns of the visit until the conversation fits the budget.
+        The prefix and the visitor's latest message are always kept.'''
+        tokens = self.estimate_tokens()
+        while tokens > token_budget and len(self.tail) > 1:
+            tokens -= estimate_tokens(self.tail.pop(0))
+            self.trimmed_messages += 1
+            #Don't leave an assistant reply at the front with the question it answered gone
+            while len(self.tail) > 1 and self.tail[0]["role"] == "assistant":
+                tokens -= estimate_tokens(self.tail.pop(0))
+                self.trimmed_messages += 1
+        return tokens
 
 class OpenAIController:
-    def __init__(self, apiKey, organization):
+    def __init__(self, apiKey, organization, apiBase=None, response_cache=None, token_budget=2000, client=None):
         self.prompt_conversation = Conversation()
+        self.prompt_prefix = ()
         self.conversation = Conversation()
         self.model = "gpt-3.5-turbo"
-        openai.api_key = apiKey
-        openai.organization = organization
+        self.token_budget = token_budget
+        #Deadlines, retries, hedging and the canned fallback are all up to the client
+        self.client = client or OpenAIClient(apiKey, organization, apiBase)
+        self.response_cache = response_cache
+        self.speculation = None
+        self.responding = False
+        self.speculation_lock = threading.Lock()
+        self.tracer = None
 
         self.stream_current_role = "assistant"
         self.stream_current_content = ""
     
     def set_prompt(self, prompt_conversation):
         self.prompt_conversation = prompt_conversation
+        self.prompt_prefix = tuple(prompt_conversation.messages)
         self.reset()
     
     def reset(self):
-        self.conversation = self.prompt_conversation
+        #Every visitor shares the prompt, only their own messages are new
+        self.conversation = Conversation(prefix=self.prompt_prefix)
+        self.cancel_speculation()
     
+    def create_completion(self, messages=None, stream=False, **kwargs):
+        if messages is None:
+            messages = self.request_messages()
+        if stream:
+            return self.client.chat_stream(messages, self.model, **kwargs)
+        return self.client.chat(messages, self.model, **kwargs)
+
+    def request_messages(self):
+        '''The messages to send, trimmed to the token budget'''
+        tokens = self.conversation.trim_to(self.token_budget)
+        messages = self.conversation.messages
+        print("Request: {} messages, ~{} tokens, {} bytes, {} trimmed this visit".format(len(messages), tokens, len(json.dumps(messages)),
+                                                                                     self.conversation.trimmed_messages))
+        return messages
+
+    def speculate(self, user_text):
+        '''Start streaming the reply to user_text before it's certain that's what the visitor said.
+        stream_completion uses it if the final transcript matches, otherwise it is cancelled.'''
+        if normalize(user_text) in ('clear', 'quit', 'exit'):
+            return
+        conversation = Conversation(self.conversation.tail + [{"role": "user", "content": user_text}], self.conversation.prefix)
+        conversation.trim_to(self.token_budget)
+        messages = conversation.messages
+        if self.response_cache and self.response_cache.lookup(messages, count=False):
+            return #it'll be answered from the cache anyway
+        with self.speculation_lock:
+            if self.responding:
+                return #the skeleton hearing itself, or a visitor talking over it
+            if self.speculation and self.speculation.messages == messages:
+                return #already asked
+            if self.speculation:
+                self.speculation.cancel()
+            print("(speculating on '{}')".format(user_text))
+            self.speculation = Speculation(messages, functools.partial(self.create_completion, messages=messages, stream=True))
+
+    def cancel_speculation(self):
+        with self.speculation_lock:
+            if self.speculation:
+                self.speculation.cancel()
+                self.speculation = None
+
     def fetch_completion(self):
-        completion = openai.ChatCompletion.create(model=self.model, messages=self.conversation.messages)
-        #TODO check errors
+        completion = self.create_completion()
         self.conversation.add_assistant_message(completion.choices[0].message.content)
 
-    def stream_completion(self, voice_pipeline):
-        stream = openai.ChatCompletion.create(model=self.model, messages=self.conversation.messages, stream=True)
-        #TODO check errors
+    def stream_completion(self, voice_pipeline, cancel_event=None, speech_end=None):
+        '''Stream the reply to the conversation into voice_pipeline. speech_end is when the visitor stopped talking,
+        which a filler's deadline is counted from.'''
+        with self.speculation_lock:
+            speculation, self.speculation = self.speculation, None
+            self.responding = True
+        try:
+            self._stream_completion(voice_pipeline, cancel_event, speculation, speech_end)
+        finally:
+            self.responding = False
+            if speculation:
+                speculation.cancel()
+
+    def _stream_completion(self, voice_pipeline, cancel_event, speculation, speech_end):
+        #Common utterances get a remembered reply instead of a round trip to OpenAI
+        cached_reply = self.response_cache.lookup(self.conversation.messages) if self.response_cache else None
+        source = 'cache'
+        if cached_reply:
+            stream = replay_stream(cached_reply)
+        else:
+            messages = self.request_messages()
+            if speculation and speculation.messages == messages:
+                #The visitor said what we guessed they were saying, and the reply is already on its way
+                stream = speculation.stream()
+                source = 'speculation'
+            else:
+                stream = self.create_completion(messages=messages, stream=True)
+                source = 'openai'
+        if self.tracer:
+            self.tracer.note('reply', source)
+        voice_pipeline.handle_stream_start(speech_end)
+        asked = list(self.conversation.messages)
+        completed = False
+        #Errors and deadlines end the stream with a finish_reason other than stop, so it isn't cached
         for chunk in stream:
+            if cancel_event and cancel_event.is_set():
+                #Barged in on, the visitor is talking again so stop reading the response
+                break
             if 'choices' in chunk and 'delta' in chunk.choices[0]:
                 if 'role' in chunk.choices[0].delta:
                     #new role means start a new message in the Conversation
                     self.conversation.add_message(chunk.choices[0].delta.role, "")
                     #if role is assistant and tokens sufficient or stop, open voice pipeline
                 if 'content' in chunk.choices[0].delta:
+                    if self.tracer:
+                        self.tracer.mark('first_token')
                     #content delta gets appended into the current message, and also the voice pipeline
                     self.conversation.append_stream_content(chunk.choices[0].delta.content)
                     if self.conversation.current_role() == "assistant":
@@ -178,194 +531,319 @@ class OpenAIController:
                     if chunk.choices[0].finish_reason != None:
                         voice_pipeline.handle_stream_stop()
                         print("")
+                        completed = chunk.choices[0].finish_reason == "stop"
+        if hasattr(stream, 'close'):
+            stream.close()
+        if completed and not cached_reply and self.response_cache:
+            self.response_cache.store(asked, self.conversation.last_message())
         
+class Speculation:
+    '''A streamed completion requested before the visitor finished talking.
+    Its chunks are read on a thread and kept until stream_completion decides whether to use them.'''
+    def __init__(self, messages, request):
+        self.messages = messages
+        self.chunks = []
+        self.finished = False
+        self.cancelled = False
+        self.condition = threading.Condition()
+        self._stream = None
+        threading.Thread(target=self._read, args=(request,), name="speculation", daemon=True).start()
+
+    def _read(self, request):
+        stream = None
+        try:
+            stream = request()
+            with self.condition:
+                self._stream = stream
+                if self.cancelled:
+                    return
+            for chunk in stream:
+                if self.cancelled:
+                    break
+                with self.condition:
+                    self.chunks.append(chunk)
+                    self.condition.notify_all()
+        except Exception as e:
+            print("Speculative request failed: {}".format(e))
+        finally:
+            if hasattr(stream, 'close'):
+                stream.close()
+            with self.condition:
+                self.finished = True
+                self.condition.notify_all()
+
+    def stream(self):
+        '''The chunks read so far, then the rest as they arrive'''
+        i = 0
+        while True:
+            with self.condition:
+                while i >= len(self.chunks) and not self.finished:
+                    self.condition.wait()
+                if i >= len(self.chunks):
+                    return
+                chunk = self.chunks[i]
+            i += 1
+            yield chunk
+
+    def cancel(self):
+        #Close the request now rather than when its next chunk arrives, or it goes on to hedge and fall back
+        #for a reply nobody wants
+        with self.condition:
+            self.cancelled = True
+            stream = self._stream
+        if hasattr(stream, 'close'):
+            stream.close()
+
 class VoicePipeline:
-    def __init__(self, piper_path, model_path, stt_provider, openai_key = None):
+    def __init__(self, piper_path, model_path, stt_provider, openai_key = None, fx_chain = None, sink = None, cache = None,
+                 comma_flush = 'first', min_clause_words = 4, effects = None, capture = None, streaming_stt = None, piper = None,
+                 openai_client = None, fillers = None):
         self.piper_path = piper_path
         self.model_path = model_path
         self.stt_provider = stt_provider
         self.openai_key = openai_key
-        self.voice_cmd = "echo '{line}' | {piper} --model {model} --output_raw | ffmpeg -hide_banner -loglevel error -nostats -f s16le -ar 22050 -i - -filter_complex 'asplit [out1][out2];[out1]afreqshift=shift=-450[shifted];[shifted]aecho=0.8:0.88:80:0.5[echo];[echo]asubboost[sub];[sub]aphaser[final1];[out2]afreqshift=shift=-350[s2];[s2]asubboost[final2];[final1] [final2] amix[mixed];[mixed]volume=volume=10dB[vol];[vol]atempo=0.85' -f s16le pipe:1 | ffplay -hide_banner -loglevel error -nostats -autoexit -nodisp -f s16le -ar 22050 -i -".format(line='{line}',piper=self.piper_path, model=self.model_path)
-        self.voice_cmd_delayed = "sleep {delay}; echo '{line}' | {piper} --model {model} --output_raw | ffmpeg -hide_banner -loglevel error -nostats -f s16le -ar 22050 -i - -f s16le pipe:1 | ffplay -hide_banner -loglevel error -nostats -autoexit -nodisp -f s16le -ar 22050 -i -".format(delay='{delay}', line='{line}',piper=self.piper_path, model=self.model_path)
-        self.speech_recognizer = sr.Recognizer()
-        self.speech_recognizer.energy_threshold = 4000
-        self.speech_recognizer.dynamic_energy_threshold = True
-        self.stream_content_queue = []
-        self.stream_content_buffer = []
-        self.ffplay_proc = None
-        self.ffmpeg_proc = None
-        self.piper_proc = None
-        self.sfx_window_active = False
-        self.sfx_buffer = ""
-        self.void_window_active = False
-        self.supported_sfx = ["blackout", "lightning"]
+        if stt_provider == 'openai' and not openai_client:
+            openai_client = OpenAIClient(openai_key)
+        self.openai_client = openai_client
+        #Piper stays loaded for the life of the pipeline and streams into a single persistent player
+        #The voice effects run in-process if we have a chain, otherwise through ffmpeg in front of the player
+        #piper may be a PiperPool shared with other stations
+        if fx_chain:
+            self.tts = TTSWorker(self.piper_path, self.model_path, sink or FfplaySink(), fx=fx_chain, cache=cache, piper=piper)
+        elif sink:
+            self.tts = TTSWorker(self.piper_path, self.model_path, sink, cache=cache, piper=piper)
+        else:
+            self.tts = TTSWorker(self.piper_path, self.model_path, FfplaySink(VOICE_FILTER, tempo=VOICE_FILTER_TEMPO), cache=cache, piper=piper)
+        self.tts.start()
+        #Only the selected STT backend gets imported, by load_stt() or on first use
+        self.speech_recognizer = None
+        #The microphone stays open and is read continuously. Utterances are picked out of it by its VAD.
+        self.capture = capture
+        self.capture_started = False
+        if stt_provider == 'sphinx-stream' and not streaming_stt:
+            streaming_stt = SphinxStreamingRecognizer()
+        self.streaming_stt = streaming_stt
+        self.tracer = None
+        self.segmenter = StreamSegmenter(comma_flush, min_clause_words)
+        self.pending_sfx = []
+        self.utterance_open = False
+        if effects is None:
+            effects = EffectRegistry()
+            for name in ["blackout", "lightning"]:
+                effects.register(name, LogEffect(name))
+        self.effects = effects
+        #Played if a reply is slow to start, see filler.py
+        self.fillers = fillers
+        #When the visitor stopped saying what take_input() last returned
+        self.speech_end = None
 
     def open_pipeline(self):
-        '''Open the pipeline for streaming data'''
-        piper_args = [self.piper_path, "--model", self.model_path, "--output_raw"]
-        ffmpeg_args = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-nostats", "-f", "s16le", "-ar", "22050", "-i", "-", "-filter_complex", "asplit [out1][out2];[out1]afreqshift=shift=-450[shifted];[shifted]aecho=0.8:0.88:80:0.5[echo];[echo]asubboost[sub];[sub]aphaser[final1];[out2]afreqshift=shift=-350[s2];[s2]asubboost[final2];[final1] [final2] amix[mixed];[mixed]volume=volume=10dB[vol];[vol]atempo=0.85", "-f", "s16le", "pipe:1"]
-        ffplay_args = ["ffplay", "-hide_banner", "-loglevel", "error", "-nostats", "-autoexit", "-nodisp", "-f", "s16le", "-ar", "22050", "-i", "-"]
-        self.piper_proc = Popen(piper_args, text=True, stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
-        self.ffmpeg_proc = Popen(ffmpeg_args, stdin=self.piper_proc.stdout, stdout=PIPE)
-        self.ffplay_proc = Popen(ffplay_args, stdin=self.ffmpeg_proc.stdout, stdout=None)
+        '''Start an utterance on the TTS worker'''
+        self.tts.begin_utterance()
+        self.utterance_open = True
 
     def close_pipeline(self):
-        '''Close the pipeline'''
-        self.piper_proc.stdin.close()
-        self.piper_proc.wait()
-        self.ffmpeg_proc.wait()
-        self.ffplay_proc.wait()
-        self.ffplay_proc = None
-        self.ffmpeg_proc = None
-        self.piper_proc = None
+        '''End the current utterance and wait for it to finish playing'''
+        self.tts.end_utterance(wait=True)
+        self.utterance_open = False
+        if self.tracer:
+            self.tracer.mark('playback_end')
+
+    def set_tracer(self, tracer):
+        self.tracer = tracer
+        self.tts.tracer = tracer
+
+    def begin_turn(self, audio):
+        '''Start timing a turn from when the visitor stopped talking. Returns None if not tracing.'''
+        if self.tracer:
+            return self.tracer.begin(getattr(audio, 'speech_end', None), getattr(audio, 'ended_at', None))
+
+    def respond_to(self, turn):
+        '''Marks from the reply and its playback go to turn from now on'''
+        if self.tracer:
+            self.tracer.respond(turn)
+
+    def end_turn(self, outcome, turn=None):
+        if self.tracer:
+            self.tracer.end(turn or self.tracer.current, outcome)
+
+    def shutdown(self):
+        if self.fillers:
+            self.fillers.disarm()
+        self.tts.stop()
+        self.effects.close()
+        if self.capture_started:
+            self.capture.close()
+        if self.streaming_stt:
+            self.streaming_stt.close()
 
     def reset(self):
-        self.sfx_window_active = False
-        self.sfx_buffer = ""
-        self.void_window_active = False
-
-    def vocalize(self, line, delay_secs=0):
-        #For now, dump to the TTS pipeline as a system call
-        line = line.replace('\n', '. ') #Some characters the TTS model pronounces but we don't want
-        line = line.replace(':', '. ') #Some characters the TTS model pronounces but we don't want
-        line = line.replace('\'', '\'\\\'\'') #Because we're dumping to shell currently
-        if delay_secs:
-            os.system(self.voice_cmd_delayed.format(line=line, delay=delay_secs))
-        else:
-            os.system(self.voice_cmd.format(line=line))
+        self.segmenter.reset()
+        self.pending_sfx = []
+
+    def cancel(self):
+        '''Stop talking right away and drop anything not yet spoken'''
+        if self.fillers:
+            self.fillers.disarm()
+        self.tts.cancel()
+        if self.utterance_open:
+            self.tts.end_utterance(wait=False)
+            self.utterance_open = False
+        self.reset()
+
+    def vocalize(self, line):
+        self.open_pipeline()
+        for sentence in self.speakable_sentences(line):
+            self.tts.say(sentence)
+        self.close_pipeline()
+
+    def speakable_sentences(self, text):
+        '''Split text into sanitized sentences the same way a streamed response is, so they share cache entries'''
+        events = segment(text, comma_flush=self.segmenter.comma_flush, min_clause_words=self.segmenter.min_clause_words)
+        return [self.piper_token_sanitize(e.text) for e in events if isinstance(e, Speak)]
+
+    def prepare_fillers(self):
+        '''Render the filler clips, so they're ready before the first visitor shows up'''
+        if self.fillers:
+            self.fillers.render(self.tts)
+
+    def prewarm(self, phrases, wait=False):
+        '''Render phrases into the TTS cache so they play without synthesis later'''
+        self.tts.prewarm([s for phrase in phrases for s in self.speakable_sentences(phrase)], wait)
+
+    def open_capture(self):
+        '''Start capturing, from the microphone unless another input was configured'''
+        if not self.capture:
+            self.capture = StreamingCapture(MicrophoneInput())
+        if self.streaming_stt:
+            self.capture.recognizer = self.streaming_stt
+        #So it can tell the skeleton (and its thunder) apart from the visitor
+        self.capture.playing_until = self.playing_until
+        if not self.capture_started:
+            self.capture.start()
+            self.capture_started = True
+        return self.capture
+
+    def playing_until(self):
+        '''When everything played so far, the voice and fillers and any effect clips, will have been heard'''
+        return max(self.tts.sink.playing_until(), self.effects.playing_until())
+
     def adjust_input_ambient_level(self):
-        with sr.Microphone() as source:
-            self.speech_recognizer.adjust_for_ambient_noise(source, 0.1)
+        self.open_capture().calibrate(0.5)
+
+    def load_stt(self):
+        '''Load the selected STT backend now, instead of when the first visitor speaks'''
+        if self.stt_provider in ('google', 'sphinx') and not self.speech_recognizer:
+            import speech_recognition as sr
+            self.speech_recognizer = sr.Recognizer()
+        if self.stt_provider == 'sphinx':
+            import pocketsphinx #recognize_sphinx imports it when it's first used
+        elif self.stt_provider == 'sphinx-stream':
+            input = self.capture.input if self.capture else None
+            self.streaming_stt.load(getattr(input, 'sample_rate', 16000))
+        elif self.stt_provider == 'openai':
+            self.openai_client.start()
+
+    def listen(self):
+        '''Wait for one utterance. Returns None if nobody spoke.'''
+        print("Listening...")
+        return self.open_capture().listen(3)
+
+    def recognize(self, audio):
+        '''Convert recorded audio to text. Returns None if it couldn't be recognized.'''
+        try:
+            print("Recognizing...")   
+            #TODO Try Sphinx vs Google vs OpenAI Whisper
+            if self.stt_provider in ('google', 'sphinx'):
+                self.load_stt()
+            r = self.speech_recognizer
+            if self.stt_provider == 'google':
+                query = r.recognize_google(audio.audio_data(), language='en-US')
+            elif self.stt_provider == 'openai':
+                query = self.openai_client.transcribe(audio.get_wav_data(), language="en")
+            elif self.stt_provider == 'sphinx':
+                query = r.recognize_sphinx(audio.audio_data(), language="en-US")
+            elif self.stt_provider == 'sphinx-stream':
+                #Usually already recognized while it was being captured
+                transcript = getattr(audio, 'transcript', None)
+                query = transcript.wait(5) if transcript else self.streaming_stt.transcribe(audio)
+                if not query:
+                    raise ValueError("Nothing recognized")
+            print(f"User said: {query}\n")
+        except Exception as e:
+            print(e)   
+            print("Unable to Recognize your voice.") 
+            return None
+        return query
 
     def take_input(self):
-        r = sr.Recognizer()
-        with sr.Microphone() as source:
-            print("Listening...")
-            r.pause_threshold = 0.6
-            try:
-                audio = r.listen(source, 3, 5)
-            except sr.WaitTimeoutError as e:
-                return None
-
-            try:
-                print("Recognizing...")   
-                #TODO Try Sphinx vs Google vs OpenAI Whisper
-                if self.stt_provider == 'google':
-                    query = r.recognize_google(audio, language='en-US')
-                elif self.stt_provider == 'openai':
-                    query = r.recognize_whisper_api(audio, api_key=self.openai_key)
-                elif self.stt_provider == 'sphinx':
-                    query = r.recognize_sphinx(audio, language="en-US")
-                print(f"User said: {query}\n")
-            except Exception as e:
-                print(e)   
-                print("Unable to Recognize your voice.") 
-                return None
-        
-        return query
+        #Anything heard while the skeleton was talking was most likely the skeleton
+        self.open_capture().discard()
+        audio = self.listen()
+        if audio is None:
+            return None
+        self.speech_end = audio.speech_end
+        turn = self.begin_turn(audio)
+        text = self.recognize(audio)
+        if turn:
+            turn.mark('stt_result')
+            if text is None:
+                self.end_turn('unrecognized', turn)
+            else:
+                self.respond_to(turn)
+        return text
+
+    def handle_stream_start(self, speech_end=None):
+        '''A reply has been asked for. If its first sentence is slow to arrive (counting from speech_end, by default now),
+        a filler covers the silence.'''
+        if self.fillers:
+            self.fillers.arm(speech_end)
 
     def handle_stream_content(self, stream_content):
-        # print("stream content {}".format(stream_content))
-        #The TTS model needs complete lines to operate on, so split on punctuation and sent it to the pipeline in chunks.
+        #The TTS model needs complete lines to operate on, so the segmenter splits the stream into sentences
+        #and each one goes to the TTS worker as soon as it's complete.
         #This speeds up the time to first data coming out of the pipeline
-        #TODO If initial response takes more than 1s, queue a "Hmm", "Sure", "Okay", etc with a short pause after
-
-        #Capture content between braces which are "special effects"
-        sfx_trigger = None
-        sfx_window_next = self.sfx_window_active
-        if "{" in stream_content:
-            split = stream_content.split("{")
-            stream_content = split[0] #everything before the brace
-            self.sfx_buffer = split[1]
-            sfx_window_next = True
-        if "}" in stream_content:
-            split = stream_content.split("}")
-            self.sfx_buffer += split[0] #everything before the brace
-            stream_content = split[1]
-            sfx_trigger_token = len(self.stream_content_buffer[0][0].split(' ')) + len(stream_content.split(' '))
-            sfx_trigger = (self.sfx_buffer.strip(), sfx_trigger_token)
-            sfx_window_next = False
-            print(" (TRIGGER:" + self.sfx_buffer + ") ", end="") #TODO Action Triggers
-            self.sfx_buffer = ""
-
-        if self.sfx_window_active:
-            #We're between two braces, so put everything in the sfx buffer instead
-            self.sfx_buffer += stream_content
-            stream_content = ""
-        
-        #throw everything between *asterisks* into the void because Bonejangles uses too much lolspeak
-        void_window_next = self.void_window_active
-        if "*" in stream_content:
-            void_window_next = not void_window_next
-            split = stream_content.split("*")
-            if void_window_next: #First asterisk, take left side only
-                stream_content = split[0] #everything before the *
-            else: #Second asterisk, take right side only
-                stream_content = split[1]
-        if self.void_window_active:
-            stream_content = " "
-
-        self.sfx_window_active = sfx_window_next
-        self.void_window_active = void_window_next
-        '''stream_content_buffer includes a series of tuples with structure
-        (verbal_message, None) where verbal_message is the message to be spoken, or 
-        (verbal_message, (sfx_name, sfx_token_trigger)) where verbal_message is the message to be spoken, sfx_name is a special effect to trigger, and sfx_trigger_token is an integer value for which space-delimited token in verbal message should trigger the effect, immediately after the token is verbalized.
-        '''
-        self.stream_content_buffer.insert(0, (stream_content, sfx_trigger))
-
-        #queue data until a terminator
-        if any(p in stream_content for p in ".!?}"):
-            #We found some punctuation. Start the TTS!
-            #First, } is a special character that denotes a special effect was used
-            #If we see this, we will start a second vocalization stream which ends at the time of the special effect
-            #which is used to trigger the special effect at the right time
-            content = ""
-            sfx_trigger = None
-            while len(self.stream_content_buffer) > 0:
-                data_tuple = self.stream_content_buffer.pop()
-                content += data_tuple[0]
-                if data_tuple[1]:
-                    sfx_trigger = data_tuple[1]
-                    sfx_trigger = (sfx_trigger[0], sfx_trigger[1] + len(content.split(' '))) #trigger token for the sfx is at the end of content
-            self.stream_content_queue.insert(0, (self.piper_token_sanitize(content) + '\n', sfx_trigger))
-
-            if not self.piper_proc:
-                self.open_pipeline()
-
-            #provide TTS with all data up until the last punctuation found
-            while len(self.stream_content_queue) > 0:
-                content, sfx_trigger = self.stream_content_queue.pop()
-                self.piper_proc.stdin.write(content)
-                if sfx_trigger and sfx_trigger[0] in self.supported_sfx:
-                    #For now, provide a dumb hard delay for sfx and hope it times out close to right
-                    delay_secs = 0.85 * sfx_trigger[1]
-                    self.vocalize(sfx_trigger[0], delay_secs)
-                #TODO: Find a way to know when the sfx_trigger happens
-            self.piper_proc.stdin.flush()
-            
+        for event in self.segmenter.feed(stream_content):
+            self.handle_segment(event)
 
     def handle_stream_stop(self):
-        if len(self.stream_content_buffer) > 0:
-            content = ""
-            sfx_trigger = None
-            while len(self.stream_content_buffer) > 0:
-                data_tuple = self.stream_content_buffer.pop()
-                content += data_tuple[0]
-                if data_tuple[1]:
-                    sfx_trigger = data_tuple[1]
-                    sfx_trigger = (sfx_trigger[0], sfx_trigger[1] + len(content.split(' '))) #trigger token for the sfx is at the end of content
-            self.stream_content_queue.insert(0, (self.piper_token_sanitize(content) + '\n', sfx_trigger))
-
-        if len(self.stream_content_queue) > 0:
-            self.open_pipeline()
-            #provide TTS with all data up until the last punctuation found
-            while len(self.stream_content_queue) > 0:
-                content, sfx_trigger = self.stream_content_queue.pop()
-                self.piper_proc.stdin.write(content)
-                if sfx_trigger and sfx_trigger[0] in self.supported_sfx:
-                    delay_secs = 0.85 * sfx_trigger[1]
-                    self.vocalize(sfx_trigger[0], delay_secs)
-        self.close_pipeline()
+        if self.fillers:
+            self.fillers.disarm()
+        for event in self.segmenter.finish():
+            self.handle_segment(event)
+        #Effects with nothing said after them happen when the speech ends
+        for sfx in self.pending_sfx:
+            self.tts.mark(functools.partial(self.effects.trigger, sfx.name))
+        self.pending_sfx = []
+        if self.utterance_open:
+            self.close_pipeline()
+
+    def handle_segment(self, event):
+        if isinstance(event, Sfx):
+            print(" (TRIGGER:" + event.name + ") ", end="")
+            if event.name in self.effects:
+                self.pending_sfx.append(event)
+        elif isinstance(event, Speak):
+            if self.fillers:
+                self.fillers.disarm()
+            if not self.utterance_open:
+                self.open_pipeline()
+            if self.tracer:
+                self.tracer.mark('first_sentence')
+            #Split the sentence where each effect goes. The playback clock fires the effect when
+            #the audio before the split has been heard.
+            words = event.text.split()
+            said = 0
+            for sfx in sorted(self.pending_sfx, key=lambda sfx: sfx.word_offset):
+                offset = min(sfx.word_offset, len(words))
+                if offset > said:
+                    self.tts.say(self.piper_token_sanitize(' '.join(words[said:offset])))
+                    said = offset
+                self.tts.mark(functools.partial(self.effects.trigger, sfx.name))
+            if said < len(words):
+                self.tts.say(self.piper_token_sanitize(' '.join(words[said:])))
+            self.pending_sfx = []
+        #Discarded text is simply not spoken
     
     def piper_token_sanitize(self, input_string):
         '''Strip away or change certain tokens which piper has trouble pronouncing'''
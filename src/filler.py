@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+'''Filler utterances, to cover a reply that is slow to start.
+
+A visitor who hears nothing for a couple of seconds assumes the skeleton didn't hear them. The
+FillerScheduler is armed when a reply is asked for, and if no sentence of it has gone to piper by
+deadline_secs after the visitor stopped talking, it plays a short filler clip ("Hmmm...", a creaky
+laugh) while the reply is on its way.
+
+The clips are rendered once at startup, through piper and the voice effects, and kept in memory, so
+playing one is just a write to the sink. They go through the TTS worker's queue like everything else,
+so the reply is spliced in after the filler (and a short gap) instead of on top of it.
+'''
+
+import time
+import random
+import threading
+
+from tts_worker import SAMPLE_WIDTH
+
+DEFAULT_PHRASES = ["Hmmm...", "Heh heh heh.", "Ooh, let me think."]
+
+class FillerScheduler:
+    def __init__(self, phrases=None, deadline_secs=1.0, gap_ms=150):
+        self.phrases = phrases or DEFAULT_PHRASES
+        self.deadline_secs = deadline_secs
+        self.gap_ms = gap_ms
+        self.tts = None
+        self.clips = []
+        self.played = 0
+        self._last = None
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def render(self, tts):
+        '''Render the clips for tts to play. Blocks until they're ready.'''
+        self.tts = tts
+        gap = bytes(int(tts.sink.sample_rate * self.gap_ms / 1000) * SAMPLE_WIDTH)
+        self.clips = [clip + gap for clip in (tts.render(phrase) for phrase in self.phrases) if clip]
+
+    def arm(self, since=None):
+        '''A reply has been asked for. Play a filler deadline_secs after since (a time.monotonic(), by default now),
+        unless disarmed first.'''
+        if not self.clips:
+            return
+        delay = max((since or time.monotonic()) + self.deadline_secs - time.monotonic(), 0)
+        with self._lock:
+            self._cancel()
+            #A filler for an utterance that has since been cancelled is dropped by the worker
+            self._timer = threading.Timer(delay, self._fire, (self.tts.generation,))
+            self._timer.daemon = True
+            self._timer.start()
+
+    def disarm(self):
+        '''The reply has started (or there won't be one), so no filler is needed'''
+        with self._lock:
+            self._cancel()
+
+    def _cancel(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+    def _fire(self, generation):
+        with self._lock:
+            #Disarmed, or armed again, while this was waiting for the lock
+            if self._timer is not threading.current_thread():
+                return
+            self._timer = None
+            clip = random.choice([c for c in self.clips if c is not self._last] or self.clips)
+            self._last = clip
+            self.played += 1
+            self.tts.play_clip(clip, generation)
+
+def filler_scheduler_from_config(config):
+    '''Build the scheduler from the [Filler] section of .config. Returns None if it's disabled.'''
+    section = config['Filler'] if config.has_section('Filler') else {}
+    if not config.getboolean('Filler', 'Enabled', fallback=True):
+        return None
+    phrases = [p.strip() for p in section.get('Phrases', '').split('|') if p.strip()]
+    return FillerScheduler(phrases, deadline_secs=float(section.get('DeadlineMs', 1000)) / 1000, gap_ms=float(section.get('GapMs', 150)))
@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+'''Pooled, retrying client for the OpenAI chat completions and Whisper transcription APIs.
+
+A single aiohttp session runs on its own event loop thread and is shared by everything that talks to
+OpenAI: every station, speculative requests and Whisper. Its connections are kept alive and reused.
+Callers on ordinary threads get blocking results, or an iterator of stream chunks shaped like the
+ones the openai package returns, so they don't need to know about asyncio.
+
+A streamed reply has two deadlines:
+
+    first_token_secs   the first words have to arrive by then. If they haven't, an identical request is
+                       raced against the first one (hedging) and whichever answers first is used.
+    total_secs         the whole reply. Past it the reply is cut off where it is.
+
+Connection errors, timeouts, 429s and 5xx responses are retried after a random wait of up to
+backoff_secs, doubling each time, as long as nothing of the reply has been used yet. If no reply can
+be had in time, one of the canned fallback replies is streamed instead, so the skeleton always says
+something. Cut off and canned replies finish with a finish_reason other than "stop".
+
+aiohttp is slow to import, so it's only imported when the client starts. warm() starts it and opens a
+connection ahead of the first request.
+'''
+
+import json
+import queue
+import random
+import asyncio
+import threading
+
+from response_cache import ChunkDict, stream_chunk
+
+DEFAULT_API_BASE = "https://api.openai.com/v1"
+FALLBACK_REPLIES = [
+    "Hmm, my bones are rattling too loudly to think. Ask me again, mortal!",
+    "Ooooh, the spirits have gone quiet. Say that once more?",
+]
+
+END = object() #an attempt's reply is complete
+
+aiohttp = None #imported by OpenAIClient.start()
+
+class RetryableError(Exception):
+    '''A response worth asking again for, like a 429 or a 5xx'''
+
+class RequestError(Exception):
+    '''A response that won't get any better by asking again'''
+
+def describe(error):
+    return str(error) or type(error).__name__
+
+def to_chunk(value):
+    '''Parsed JSON with attribute access all the way down, like the openai package's objects'''
+    if isinstance(value, dict):
+        return ChunkDict({key: to_chunk(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return [to_chunk(item) for item in value]
+    return value
+
+def fallback_stream(reply):
+    yield stream_chunk({"role": "assistant"})
+    yield stream_chunk({"content": reply})
+    yield stream_chunk({}, "fallback")
+
+class Attempt:
+    '''One request for a streamed reply, read into a queue until it's either used or cancelled'''
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.answered = asyncio.Event() #the first words arrived, or it failed trying
+        self.failed = False
+        self.task = None
+
+    def cancel(self):
+        if self.task:
+            self.task.cancel()
+
+class ChatStream:
+    '''The chunks of a streamed reply as they arrive, for a caller on an ordinary thread'''
+    def __init__(self, client, body):
+        self.queue = queue.Queue()
+        self.future = asyncio.run_coroutine_threadsafe(client._chat_stream(body, self.queue), client.loop)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = self.queue.get()
+        if chunk is None:
+            raise StopIteration
+        return chunk
+
+    def close(self):
+        '''Stop reading the reply, closing its request'''
+        self.future.cancel()
+
+class OpenAIClient:
+    def __init__(self, api_key, organization=None, api_base=None, max_connections=8, connect_secs=3.0,
+                 first_token_secs=2.5, total_secs=20.0, retries=2, backoff_secs=0.25, hedge=True, fallback_replies=None):
+        self.api_key = api_key
+        self.organization = organization
+        self.api_base = (api_base or DEFAULT_API_BASE).rstrip('/')
+        self.max_connections = max_connections
+        self.connect_secs = connect_secs
+        self.first_token_secs = first_token_secs
+        self.total_secs = total_secs
+        self.retries = retries
+        self.backoff_secs = backoff_secs
+        self.hedge = hedge
+        self.fallback_replies = fallback_replies or FALLBACK_REPLIES
+        self.loop = None
+        self.session = None
+        self.counters = dict.fromkeys(["requests", "connections_opened", "connections_reused", "retries", "first_token_timeouts",
+                                       "hedges", "hedge_wins", "fallbacks", "cut_off", "errors"], 0)
+        self._lock = threading.Lock()
+
+    def start(self):
+        global aiohttp
+        with self._lock:
+            if self.loop:
+                return
+            import aiohttp
+            self.loop = asyncio.new_event_loop()
+            threading.Thread(target=self.loop.run_forever, name="openai-client", daemon=True).start()
+            asyncio.run_coroutine_threadsafe(self._open(), self.loop).result()
+
+    def close(self):
+        with self._lock:
+            if not self.loop:
+                return
+            asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result(5)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop = None
+
+    def warm(self):
+        '''Start the client and connect to OpenAI, so the first request doesn't wait for either'''
+        self.start()
+        asyncio.run_coroutine_threadsafe(self._connect(), self.loop).result()
+
+    def stats(self):
+        return dict(self.counters)
+
+    def chat(self, messages, model, **params):
+        '''A whole reply, shaped like ChatCompletion.create's. A canned one if OpenAI can't be reached in time.'''
+        self.start()
+        body = dict(params, model=model, messages=messages)
+        return asyncio.run_coroutine_threadsafe(self._chat(body), self.loop).result()
+
+    def chat_stream(self, messages, model, **params):
+        '''A streamed reply, shaped like ChatCompletion.create(stream=True)'s. Close it to stop reading early.'''
+        self.start()
+        return ChatStream(self, dict(params, model=model, messages=messages, stream=True))
+
+    def transcribe(self, wav_data, model="whisper-1", language=None):
+        '''The text of a WAV file, from Whisper. Raises if it can't be had in time.'''
+        self.start()
+        future = asyncio.run_coroutine_threadsafe(asyncio.wait_for(self._transcribe(wav_data, model, language), self.total_secs), self.loop)
+        return future.result()
+
+    async def _open(self):
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(self._count("connections_opened"))
+        trace.on_connection_reuseconn.append(self._count("connections_reused"))
+        headers = {"Authorization": "Bearer " + self.api_key}
+        if self.organization:
+            headers["OpenAI-Organization"] = self.organization
+        #Deadlines are enforced per request, only connecting gets a timeout of its own
+        self.session = aiohttp.ClientSession(headers=headers, trace_configs=[trace],
+                                             connector=aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60),
+                                             timeout=aiohttp.ClientTimeout(total=None, connect=self.connect_secs))
+
+    async def _connect(self):
+        #Any response will do, it's the connection that's kept
+        try:
+            response = await self.session.get(self.api_base + "/models", timeout=aiohttp.ClientTimeout(total=self.connect_secs))
+            response.release()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print("Couldn't connect to OpenAI ahead of time ({})".format(describe(e)))
+
+    def _count(self, name):
+        async def count(session, context, params):
+            self.counters[name] += 1
+        return count
+
+    async def _with_retries(self, request, deadline):
+        '''Await request() until it succeeds, it fails for good or there's no time left to try again'''
+        for tries in range(self.retries + 1):
+            try:
+                return await request()
+            except (aiohttp.ClientError, asyncio.TimeoutError, RetryableError) as e:
+                delay = random.uniform(0, self.backoff_secs * 2 ** tries)
+                if tries == self.retries or self.loop.time() + delay >= deadline:
+                    raise
+                self.counters["retries"] += 1
+                print("OpenAI request failed ({}), retrying in {:.2f}s".format(describe(e), delay))
+                await asyncio.sleep(delay)
+
+    async def _post(self, path, **kwargs):
+        self.counters["requests"] += 1
+        response = await self.session.post(self.api_base + path, **kwargs)
+        if response.status == 429 or response.status >= 500:
+            response.release()
+            raise RetryableError("HTTP {}".format(response.status))
+        if response.status != 200:
+            message = await response.text()
+            response.release()
+            raise RequestError("HTTP {}: {}".format(response.status, message[:200]))
+        return response
+
+    async def _chat(self, body):
+        deadline = self.loop.time() + self.total_secs
+        async def request():
+            response = await self._post("/chat/completions", json=body)
+            try:
+                return to_chunk(await response.json())
+            finally:
+                response.release()
+        try:
+            return await asyncio.wait_for(self._with_retries(request, deadline), self.total_secs)
+        except Exception as e:
+            print("OpenAI request failed ({}), falling back to a canned reply".format(describe(e)))
+            self.counters["errors"] += 1
+            self.counters["fallbacks"] += 1
+            message = ChunkDict(role="assistant", content=random.choice(self.fallback_replies))
+            return ChunkDict(choices=[ChunkDict(index=0, message=message, finish_reason="fallback")])
+
+    async def _transcribe(self, wav_data, model, language):
+        async def request():
+            form = aiohttp.FormData()
+            form.add_field("model", model)
+            if language:
+                form.add_field("language", language)
+            form.add_field("file", wav_data, filename="speech.wav", content_type="audio/wav")
+            response = await self._post("/audio/transcriptions", data=form)
+            try:
+                return (await response.json())["text"]
+            finally:
+                response.release()
+        return await self._with_retries(request, self.loop.time() + self.total_secs)
+
+    async def _chat_stream(self, body, out):
+        '''Puts the chunks of the reply on out, then None'''
+        deadline = self.loop.time() + self.total_secs
+        attempts = [self._start(body, deadline)]
+        try:
+            winner = await self._first_to_answer(attempts, deadline)
+            if not winner and not attempts[0].failed:
+                self.counters["first_token_timeouts"] += 1
+                if self.hedge and self.loop.time() < deadline:
+                    self.counters["hedges"] += 1
+                    attempts.append(self._start(body, deadline))
+                    winner = await self._first_to_answer(attempts, deadline)
+                    if winner is attempts[-1]:
+                        self.counters["hedge_wins"] += 1
+            if not winner:
+                self.counters["fallbacks"] += 1
+                print("No reply from OpenAI in time, falling back to a canned reply")
+                for chunk in fallback_stream(random.choice(self.fallback_replies)):
+                    out.put(chunk)
+                return
+            for attempt in attempts:
+                if attempt is not winner:
+                    attempt.cancel()
+            while True:
+                try:
+                    item = await asyncio.wait_for(winner.queue.get(), deadline - self.loop.time())
+                except asyncio.TimeoutError:
+                    self.counters["cut_off"] += 1
+                    out.put(stream_chunk({}, "length"))
+                    return
+                if item is END:
+                    return
+                if isinstance(item, Exception):
+                    print("OpenAI reply broke off ({})".format(describe(item)))
+                    self.counters["errors"] += 1
+                    out.put(stream_chunk({}, "error"))
+                    return
+                out.put(item)
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+            out.put(None)
+
+    def _start(self, body, deadline):
+        attempt = Attempt()
+        attempt.task = asyncio.ensure_future(self._read_stream(attempt, body, deadline))
+        return attempt
+
+    async def _first_to_answer(self, attempts, deadline):
+        '''The first of attempts to get its first words within first_token_secs, or None'''
+        until = min(self.loop.time() + self.first_token_secs, deadline)
+        while True:
+            for attempt in attempts:
+                if attempt.answered.is_set() and not attempt.failed:
+                    return attempt
+            remaining = until - self.loop.time()
+            if remaining <= 0 or all(attempt.failed for attempt in attempts):
+                return None
+            waiters = [asyncio.ensure_future(attempt.answered.wait()) for attempt in attempts if not attempt.answered.is_set()]
+            _, pending = await asyncio.wait(waiters, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            for waiter in pending:
+                waiter.cancel()
+
+    async def _read_stream(self, attempt, body, deadline):
+        try:
+            await self._with_retries(lambda: self._read_reply(attempt, body), deadline)
+            attempt.queue.put_nowait(END)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            attempt.failed = not attempt.answered.is_set()
+            if attempt.failed:
+                print("OpenAI request failed ({})".format(describe(e)))
+                self.counters["errors"] += 1
+            attempt.queue.put_nowait(e)
+        finally:
+            attempt.answered.set()
+
+    async def _read_reply(self, attempt, body):
+        response = await self._post("/chat/completions", json=body)
+        #Chunks before the first words are held back, so a failed request can be retried from scratch
+        held = []
+        try:
+            async for line in response.content:
+                line = line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    break
+                chunk = to_chunk(json.loads(data))
+                if attempt.answered.is_set():
+                    attempt.queue.put_nowait(chunk)
+                    continue
+                held.append(chunk)
+                choice = chunk.choices[0] if chunk.get("choices") else {}
+                if choice.get("delta", {}).get("content") or choice.get("finish_reason"):
+                    for chunk in held:
+                        attempt.queue.put_nowait(chunk)
+                    attempt.answered.set()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt.answered.is_set():
+                raise RequestError("reply broke off: {}".format(describe(e)))
+            raise
+        finally:
+            response.release()
+        if not attempt.answered.is_set():
+            for chunk in held:
+                attempt.queue.put_nowait(chunk)
+
+def openai_client_from_config(config, api_key, organization=None, api_base=None):
+    '''Build the client from the [OpenAI] section of .config'''
+    section = config['OpenAI'] if config.has_section('OpenAI') else {}
+    def get(key, default):
+        return float(section.get(key, default))
+    fallback_replies = [r.strip() for r in section.get('FallbackReplies', '').split('|') if r.strip()]
+    return OpenAIClient(api_key, organization, api_base,
+                        max_connections=int(get('MaxConnections', 8)),
+                        connect_secs=get('ConnectSecs', 3.0),
+                        first_token_secs=get('FirstTokenSecs', 2.5),
+                        total_secs=get('TotalSecs', 20),
+                        retries=int(get('Retries', 2)),
+                        backoff_secs=get('BackoffSecs', 0.25),
+                        hedge=config.getboolean('OpenAI', 'Hedge', fallback=True),
+                        fallback_replies=fallback_replies)
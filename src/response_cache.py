@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+'''Cache of OpenAI responses.
+
+Most of what visitors say is some version of "trick or treat", "happy halloween" or "are you real".
+Responses are remembered by what the visitor recently said, and a new utterance that is close enough
+to a remembered one (character trigram similarity, which shrugs off small recognition errors) gets the
+remembered reply, replayed as if it were streaming from OpenAI. "Yes!" means something different after
+"Shall I tell you a secret?" than after "Are you scared?", so a reply is only reused after the same
+skeleton line it was given after, or as the opening of a visit.
+'''
+
+import re
+import time
+import threading
+from collections import OrderedDict
+
+class ChunkDict(dict):
+    '''Dict with attribute access, shaped like the stream chunks the openai package returns'''
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+def stream_chunk(delta, finish_reason=None):
+    return ChunkDict(choices=[ChunkDict(delta=ChunkDict(delta), finish_reason=finish_reason)])
+
+def replay_stream(reply):
+    '''Yield a reply the way ChatCompletion.create(stream=True) would, a word at a time'''
+    yield stream_chunk({"role": "assistant"})
+    for word in re.findall(r'\S+\s*', reply):
+        yield stream_chunk({"content": word})
+    yield stream_chunk({}, "stop")
+
+def normalize(text):
+    text = re.sub(r"[^a-z0-9' ]+", ' ', text.lower())
+    return ' '.join(text.split())
+
+def trigrams(text):
+    padded = ' {} '.format(text)
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+class ResponseCache:
+    def __init__(self, threshold=0.7, ttl_secs=3600, context_turns=1, max_entries=512):
+        self.threshold = threshold
+        self.ttl_secs = ttl_secs
+        self.context_turns = context_turns
+        self.max_entries = max_entries
+        self.entries = OrderedDict() #(previous, context) -> (trigrams, reply, stored at)
+        self.prompt_length = 0
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self._lock = threading.Lock()
+
+    def context(self, messages):
+        '''The part of the conversation a reply is remembered by: what the skeleton said last in this visit
+        ("" at the start of one), and the visitor's most recent utterances'''
+        said = [m["content"] for m in messages if m["role"] == "user"]
+        previous = [m["content"] for m in messages[self.prompt_length:-1] if m["role"] == "assistant"]
+        return normalize(previous[-1] if previous else ""), normalize(' | '.join(said[-self.context_turns:]))
+
+    def lookup(self, messages, count=True):
+        '''Returns a remembered reply for the conversation, or None.
+        count=False checks without counting it as a hit or a miss.'''
+        previous, context = self.context(messages)
+        grams = trigrams(context)
+        now = time.monotonic()
+        with self._lock:
+            best, best_score = None, self.threshold
+            for key, (entry_grams, reply, stored_at) in list(self.entries.items()):
+                if now - stored_at > self.ttl_secs:
+                    del self.entries[key]
+                    self.expired += 1
+                    continue
+                if key[0] != previous:
+                    continue
+                score = len(grams & entry_grams) / len(grams | entry_grams)
+                if score >= best_score:
+                    best, best_score = key, score
+            if best is None:
+                self.misses += count
+                return None
+            self.hits += count
+            self.entries.move_to_end(best)
+            return self.entries[best][1]
+
+    def store(self, messages, reply):
+        '''Remember reply as the response to messages, which should end with the visitor's utterance'''
+        previous, context = self.context(messages)
+        if not context or not reply.strip():
+            return
+        with self._lock:
+            self.entries[previous, context] = (trigrams(context), reply, time.monotonic())
+            self.entries.move_to_end((previous, context))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def seed(self, messages):
+        '''Remember the example exchanges in a prompt as openings, without letting them expire.
+        Every conversation the cache is asked about should start with the prompt.'''
+        for i in range(1, len(messages)):
+            if messages[i]["role"] == "assistant" and messages[i - 1]["role"] == "user":
+                self.prompt_length = i - 1 #so only the example itself counts
+                self.store(messages[:i], messages[i]["content"])
+        self.prompt_length = len(messages)
+        with self._lock:
+            for key, (grams, reply, _) in self.entries.items():
+                self.entries[key] = (grams, reply, float('inf'))
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "expired": self.expired, "entries": len(self.entries)}
+
+def response_cache_from_config(config):
+    '''Build the cache from the [ResponseCache] section of .config. Returns None if it's disabled.'''
+    section = config['ResponseCache'] if config.has_section('ResponseCache') else {}
+    if not config.getboolean('ResponseCache', 'Enabled', fallback=True):
+        return None
+    return ResponseCache(threshold=float(section.get('Threshold', 0.7)),
+                         ttl_secs=float(section.get('TTLSecs', 3600)),
+                         context_turns=int(section.get('ContextTurns', 1)),
+                         max_entries=int(section.get('MaxEntries', 512)))
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+'''Special effects.
+
+Bonejangles asks for an effect by putting its name in braces, like {blackout}. Each name maps to a
+list of callbacks which run the moment the word the effect follows is heard. The usual callbacks are
+a pre-loaded sound clip, an external command (the stand-in for GPIO or DMX hardware, e.g. a script that
+flips a relay) and a log line. Any callable taking no arguments can be registered.
+
+Effects are configured in the [Effects] section of .config, one line per effect:
+
+    lightning = clip:sounds/thunder.wav, command:./lights.sh flash
+    blackout = command:./lights.sh off 5
+'''
+
+import os
+import time
+import wave
+import threading
+from subprocess import Popen, DEVNULL
+
+import numpy as np
+
+from tts_worker import SAMPLE_RATE, SAMPLE_WIDTH, FfplaySink
+
+class ClipEffect:
+    '''Plays a sound clip, loaded into memory ahead of time, on its own sink'''
+    def __init__(self, path, sink):
+        self.path = path
+        self.sink = sink
+        self.audio = load_clip(path, sink.sample_rate)
+
+    def __call__(self):
+        #Writing a long clip into a pipe can block, and the playback clock shouldn't wait on it
+        threading.Thread(target=self.sink.write, args=(self.audio,), daemon=True).start()
+
+class CommandEffect:
+    '''Runs an external command without waiting for it'''
+    def __init__(self, command):
+        self.command = command
+
+    def __call__(self):
+        Popen(self.command, shell=True, stdout=DEVNULL, stderr=DEVNULL)
+
+class LogEffect:
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self):
+        print(" (SFX:{} at {:.3f}) ".format(self.name, time.monotonic()), end="")
+
+class EffectRegistry:
+    def __init__(self):
+        self.effects = {}
+
+    def register(self, name, callback):
+        self.effects.setdefault(name.lower(), []).append(callback)
+
+    def names(self):
+        return list(self.effects)
+
+    def __contains__(self, name):
+        return name in self.effects
+
+    def trigger(self, name):
+        for callback in self.effects.get(name, []):
+            try:
+                callback()
+            except Exception as e:
+                print("Effect {} failed: {}".format(name, e))
+
+    def sinks(self):
+        '''The sinks clips are played on'''
+        sinks = {id(c.sink): c.sink for callbacks in self.effects.values() for c in callbacks if isinstance(c, ClipEffect)}
+        return list(sinks.values())
+
+    def playing_until(self):
+        '''The time.monotonic() by which every clip played so far will have been heard'''
+        return max((sink.playing_until() for sink in self.sinks()), default=0.0)
+
+    def close(self):
+        for sink in self.sinks():
+            sink.close()
+
+def load_clip(path, sample_rate=SAMPLE_RATE):
+    '''Load a WAV file as mono s16le at sample_rate'''
+    with wave.open(path, 'rb') as f:
+        channels, width, rate = f.getnchannels(), f.getsampwidth(), f.getframerate()
+        frames = f.readframes(f.getnframes())
+    if width != SAMPLE_WIDTH:
+        raise ValueError("{} must be 16 bit".format(path))
+    samples = np.frombuffer(frames, dtype='<i2').astype(np.float64)
+    samples = samples.reshape(-1, channels).mean(axis=1)
+    if rate != sample_rate:
+        positions = np.arange(int(len(samples) * sample_rate / rate)) * rate / sample_rate
+        samples = np.interp(positions, np.arange(len(samples)), samples)
+    return samples.astype('<i2').tobytes()
+
+def effects_from_config(config, names=("blackout", "lightning"), device=None):
+    '''Build the registry from the [Effects] section of .config.
+    Effects without any configuration just log when they fire. Clips play on device, the default output if None.'''
+    registry = EffectRegistry()
+    section = config['Effects'] if config.has_section('Effects') else {}
+    clip_sink = None
+    for name in set(names) | set(section.keys()):
+        spec = section.get(name, '').strip()
+        if not spec:
+            registry.register(name, LogEffect(name))
+            continue
+        for part in spec.split(','):
+            kind, _, argument = part.strip().partition(':')
+            if kind == 'clip':
+                clip_sink = clip_sink or FfplaySink(device=device)
+                path = os.path.expanduser(argument.strip())
+                registry.register(name, ClipEffect(path, clip_sink))
+            elif kind == 'command':
+                registry.register(name, CommandEffect(argument.strip()))
+            elif kind == 'log':
+                registry.register(name, LogEffect(name))
+            else:
+                print("Unknown effect '{}' for {}".format(kind, name))
+    return registry
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+'''Timed startup, and a readiness socket for running as a daemon.
+
+Before the first visitor can talk, every station has to calibrate its microphone against the room,
+load its STT backend and render its fillers and intro through piper, and the connection to OpenAI has
+to be opened. None of these depend on each other, so Startup can run them as parallel phases:
+
+    startup = Startup(parallel=True)
+    startup.phase("calibrate", voice_pipeline.adjust_input_ambient_level)
+    startup.phase("openai", client.warm)
+    startup.wait()      #re-raises the first phase that failed
+    startup.ready()
+
+Each phase is timed from when the process started, so the summary shows what the boot is waiting on.
+With parallel=False the phases run one after another as they're added.
+
+A ReadinessSocket answers every connection on a unix socket with one line of JSON, the startup
+status, and closes it. A supervisor, or the script lighting the prop's eyes, can wait for readiness with
+
+    python startup.py /tmp/boneGPT.sock --wait 60
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+
+class Startup:
+    def __init__(self, parallel=True, started=None):
+        self.parallel = parallel
+        self.started = started or time.monotonic()
+        self.phases = {} #name -> (start, end), seconds since started
+        self.ready_at = None
+        self._threads = []
+        self._errors = []
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+
+    def record(self, name, start, end=None):
+        '''Note a phase that has already happened, from time.monotonic() start to end (by default now)'''
+        with self._lock:
+            self.phases[name] = (start - self.started, (end or time.monotonic()) - self.started)
+
+    def phase(self, name, step, *args):
+        '''Run step(*args) as the phase name, in a thread of its own if parallel'''
+        if not self.parallel:
+            self._run(name, step, args)
+            return
+        thread = threading.Thread(target=self._run, args=(name, step, args), name="startup-" + name, daemon=True)
+        self._threads.append(thread)
+        thread.start()
+
+    def wait(self):
+        '''Wait for every phase to finish. Raises the error of the first one that failed.'''
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self._errors:
+            raise self._errors[0]
+
+    def ready(self):
+        self.ready_at = time.monotonic() - self.started
+        self._ready.set()
+
+    def is_ready(self):
+        return self._ready.is_set()
+
+    def status(self):
+        with self._lock:
+            phases = {name: {"start_ms": round(1000 * start, 1), "ms": round(1000 * (end - start), 1)}
+                      for name, (start, end) in sorted(self.phases.items(), key=lambda item: item[1])}
+        return {"ready": self.is_ready(), "pid": os.getpid(),
+                "ready_ms": round(1000 * self.ready_at, 1) if self.ready_at is not None else None, "phases": phases}
+
+    def summary(self):
+        status = self.status()
+        phases = ", ".join("{} {:.0f}ms".format(name, phase["ms"]) for name, phase in status["phases"].items())
+        return "ready in {:.0f}ms ({})".format(status["ready_ms"] or 0, phases)
+
+    def _run(self, name, step, args):
+        start = time.monotonic()
+        try:
+            step(*args)
+        except Exception as e:
+            if not self.parallel:
+                raise
+            print("Startup phase {} failed: {}".format(name, e))
+            self._errors.append(e)
+        finally:
+            self.record(name, start)
+
+class ReadinessSocket:
+    '''Answers every connection to a unix socket at path with the startup status as a line of JSON'''
+    def __init__(self, path, startup):
+        self.path = path
+        self.startup = startup
+        self.server = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path) #left behind by a power cut
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen(8)
+        threading.Thread(target=self._serve, name="ready-socket", daemon=True).start()
+
+    def close(self):
+        if not self.server:
+            return
+        self.server.close()
+        self.server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _serve(self):
+        server = self.server
+        while True:
+            try:
+                connection, _ = server.accept()
+            except OSError:
+                return #closed
+            with connection:
+                try:
+                    connection.sendall((json.dumps(self.startup.status()) + "\n").encode())
+                except OSError:
+                    pass
+
+def query(path):
+    '''The status from the readiness socket at path, or None if nothing is listening there yet'''
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(path)
+            data = b""
+            while not data.endswith(b"\n"):
+                chunk = s.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+    except (FileNotFoundError, ConnectionRefusedError):
+        return None
+    return json.loads(data)
+
+def wait_until_ready(path, timeout, interval=0.05):
+    '''Poll the readiness socket at path. Returns the status once ready, or the last one seen (or None) at timeout.'''
+    deadline = time.monotonic() + timeout
+    status = None
+    while time.monotonic() < deadline:
+        status = query(path)
+        if status and status["ready"]:
+            break
+        time.sleep(interval)
+    return status
+
+def main():
+    parser = argparse.ArgumentParser(description='Ask a running boneGPT whether it is ready')
+    parser.add_argument('socket', help='its readiness socket, Daemon.Socket in .config')
+    parser.add_argument('--wait', type=float, default=0, help='seconds to wait for it to be ready')
+    args = parser.parse_args()
+    status = wait_until_ready(args.socket, args.wait) if args.wait else query(args.socket)
+    print(json.dumps(status, indent=2) if status else "Nothing listening on {}".format(args.socket))
+    sys.exit(0 if status and status["ready"] else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+'''Incremental segmenter for streamed responses.
+
+Deltas from the OpenAI stream are consumed once, left to right, by a small state machine which emits:
+
+    Speak(text)              a sentence (or early clause) ready for TTS
+    Sfx(name, word_offset)   a {special effect}, to fire after word_offset words of the next Speak
+    Discard(text)            *asterisk lolspeak* and other text that should not be spoken
+
+A sentence ends at . ! or ? once the next character shows it really is the end (so "3.5" and "..."
+don't split), or at a newline. To get audio started sooner, the first clause of a response can also be
+flushed at a comma once it is long enough to be worth saying on its own.
+The events don't depend on how the text was split into deltas.
+'''
+
+import re
+from collections import namedtuple
+
+Speak = namedtuple('Speak', 'text')
+Sfx = namedtuple('Sfx', 'name word_offset')
+Discard = namedtuple('Discard', 'text')
+
+_SPECIAL = re.compile(r'[{}*.!?,;:\n]')
+_WORD_START = re.compile(r'\s\S')
+
+class StreamSegmenter:
+    def __init__(self, comma_flush='first', min_clause_words=4):
+        '''comma_flush is "first" to flush at a comma only until the first Speak, "always", or "never"'''
+        self.comma_flush = comma_flush
+        self.min_clause_words = min_clause_words
+        self.reset()
+
+    def reset(self):
+        self.mode = 'text' #or 'sfx' between braces, 'void' between asterisks
+        self.buffer = []
+        self.words = 0
+        self.in_word = False
+        self.pending_end = False
+        self.pending_clause = False
+        self.special = []
+        self.spoken = 0
+
+    def feed(self, delta):
+        events = []
+        pos = 0
+        for match in _SPECIAL.finditer(delta):
+            if match.start() > pos:
+                self._plain(delta[pos:match.start()], events)
+            self._special(match.group(), events)
+            pos = match.end()
+        if pos < len(delta):
+            self._plain(delta[pos:], events)
+        return events
+
+    def finish(self):
+        '''End of the stream. Flushes what's left and discards unclosed effects or asterisks.'''
+        events = []
+        if self.mode != 'text' and self.special:
+            events.append(Discard(''.join(self.special)))
+        self.mode = 'text'
+        self.special = []
+        self._flush(events)
+        self.spoken = 0
+        return events
+
+    def _plain(self, text, events):
+        if self.mode != 'text':
+            self.special.append(text)
+            return
+        if self.pending_end or self.pending_clause:
+            closers = len(text) - len(text.lstrip('"\')]'))
+            if closers:
+                #Closing quotes and brackets belong to the sentence they end
+                self._append(text[:closers])
+                text = text[closers:]
+                if not text:
+                    return
+            if text[0].isspace():
+                if self.pending_end or self._clause_ready():
+                    self._flush(events)
+            self.pending_end = False
+            self.pending_clause = False
+        self._append(text)
+
+    def _special(self, char, events):
+        if self.mode == 'sfx':
+            if char == '}':
+                events.append(Sfx(''.join(self.special).strip().lower(), self.words))
+                self.special = []
+                self.mode = 'text'
+            else:
+                self.special.append(char)
+            return
+        if self.mode == 'void':
+            if char == '*':
+                events.append(Discard(''.join(self.special)))
+                self.special = []
+                self.mode = 'text'
+                self._append(' ')
+            else:
+                self.special.append(char)
+            return
+
+        if char in '{*\n':
+            #These separate words, so a sentence waiting on its next character is over
+            if self.pending_end or char == '\n':
+                self._flush(events)
+            self.pending_end = False
+            self.pending_clause = False
+            if char == '{':
+                self.mode = 'sfx'
+            elif char == '*':
+                self.mode = 'void'
+            else:
+                self._append(' ')
+        elif char == '}':
+            pass #stray closing brace
+        elif char in '.!?':
+            self._append(char)
+            self.pending_end = True
+            self.pending_clause = False
+        else: # , ; :
+            self._append(char)
+            self.pending_clause = not self.pending_end
+
+    def _clause_ready(self):
+        if self.comma_flush == 'never':
+            return False
+        if self.comma_flush == 'first' and self.spoken:
+            return False
+        return self.words >= self.min_clause_words
+
+    def _append(self, text):
+        self.words += len(_WORD_START.findall(text))
+        if not self.in_word and not text[0].isspace():
+            self.words += 1
+        self.in_word = not text[-1].isspace()
+        self.buffer.append(text)
+
+    def _flush(self, events):
+        text = ''.join(self.buffer).strip()
+        if any(c.isalnum() for c in text):
+            events.append(Speak(text))
+            self.spoken += 1
+        elif text:
+            events.append(Discard(text))
+        self.buffer = []
+        self.words = 0
+        self.in_word = False
+        self.pending_end = False
+        self.pending_clause = False
+
+def segment(text, **kwargs):
+    '''Segment a complete piece of text'''
+    segmenter = StreamSegmenter(**kwargs)
+    return segmenter.feed(text) + segmenter.finish()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+'''Streaming speech recognition.
+
+The capture feeds each frame of an utterance to a StreamingRecognizer as it is recorded. A worker thread
+decodes incrementally, so by the time the visitor stops talking the transcript is nearly done:
+
+    begin() -> feed(frame) ... -> end()          from the capture thread
+    Transcript.partial                           the hypothesis so far
+    on_stable(transcript, text)                  the hypothesis hasn't changed for stable_ms of audio
+    Transcript.wait()                            the final transcript
+
+A stable hypothesis is usually the final one, which is what makes it worth sending to OpenAI before
+the visitor's pause has been long enough to end the utterance.
+'''
+
+import queue
+import threading
+
+class Transcript:
+    '''Recognition of a single utterance, filled in as it happens'''
+    def __init__(self):
+        self.partial = ''
+        self.stable = None
+        self.final = None
+        self.done = threading.Event()
+
+    def wait(self, timeout=None):
+        '''The final transcript, or None if it didn't arrive in time'''
+        self.done.wait(timeout)
+        return self.final
+
+class StreamingRecognizer:
+    '''Runs an incremental decoder on a worker thread. Subclasses provide the decoder by implementing
+    _start_utterance(sample_rate), _process(frame) which returns the hypothesis so far, and
+    _end_utterance() which returns the final one.'''
+    def __init__(self, stable_ms=250, on_partial=None, on_stable=None):
+        self.stable_ms = stable_ms
+        self.on_partial = on_partial
+        self.on_stable = on_stable
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def begin(self, sample_rate, frame_samples):
+        '''Start an utterance. Returns its Transcript.'''
+        if not self.thread:
+            self.thread = threading.Thread(target=self._run, name="stt", daemon=True)
+            self.thread.start()
+        transcript = Transcript()
+        self.queue.put(("begin", (transcript, sample_rate, frame_samples)))
+        return transcript
+
+    def feed(self, frame):
+        self.queue.put(("frame", frame))
+
+    def end(self):
+        self.queue.put(("end", None))
+
+    def transcribe(self, audio, frame_ms=30, timeout=5):
+        '''Recognize already recorded audio, an audio_capture.Utterance'''
+        data = audio.get_raw_data(convert_width=2)
+        step = int(audio.sample_rate * frame_ms / 1000) * 2
+        transcript = self.begin(audio.sample_rate, step // 2)
+        for i in range(0, len(data), step):
+            self.feed(data[i:i + step])
+        self.end()
+        return transcript.wait(timeout)
+
+    def load(self, sample_rate=16000):
+        '''Load the model now instead of at the first utterance'''
+
+    def close(self):
+        if self.thread:
+            self.queue.put(("stop", None))
+            self.thread.join(1.0)
+            self.thread = None
+
+    def _run(self):
+        transcript = None
+        while True:
+            kind, item = self.queue.get()
+            if kind == "stop":
+                return
+            try:
+                if kind == "begin":
+                    transcript, sample_rate, frame_samples = item
+                    stable_frames = max(int(self.stable_ms / 1000 * sample_rate / frame_samples), 1)
+                    unchanged = 0
+                    self._start_utterance(sample_rate)
+                elif kind == "frame" and transcript:
+                    hypothesis = self._process(item) or ''
+                    if hypothesis != transcript.partial:
+                        transcript.partial = hypothesis
+                        unchanged = 0
+                        if self.on_partial:
+                            self.on_partial(transcript, hypothesis)
+                        continue
+                    unchanged += 1
+                    if unchanged == stable_frames and hypothesis and hypothesis != transcript.stable:
+                        transcript.stable = hypothesis
+                        if self.on_stable:
+                            self.on_stable(transcript, hypothesis)
+                elif kind == "end" and transcript:
+                    transcript.final = self._end_utterance() or ''
+                    transcript.done.set()
+                    transcript = None
+            except Exception as e:
+                print("Streaming STT failed: {}".format(e))
+                if transcript:
+                    transcript.done.set()
+                    transcript = None
+
+    def _start_utterance(self, sample_rate):
+        raise NotImplementedError
+
+    def _process(self, frame):
+        raise NotImplementedError
+
+    def _end_utterance(self):
+        raise NotImplementedError
+
+class SphinxStreamingRecognizer(StreamingRecognizer):
+    '''Local, incremental recognition with pocketsphinx and its bundled US English model'''
+    def __init__(self, stable_ms=250, on_partial=None, on_stable=None, **decoder_config):
+        super().__init__(stable_ms, on_partial, on_stable)
+        self.decoder_config = decoder_config
+        self.decoder = None
+        self.sample_rate = None
+
+    def load(self, sample_rate=16000):
+        if not self.decoder or sample_rate != self.sample_rate:
+            #Imported here, so only the STT provider that's used gets loaded
+            from pocketsphinx import Decoder
+            self.decoder = Decoder(samprate=sample_rate, **self.decoder_config)
+            self.sample_rate = sample_rate
+
+    def _start_utterance(self, sample_rate):
+        self.load(sample_rate)
+        self.decoder.start_utt()
+
+    def _process(self, frame):
+        self.decoder.process_raw(frame, False, False)
+        hypothesis = self.decoder.hyp()
+        return hypothesis.hypstr if hypothesis else ''
+
+    def _end_utterance(self):
+        self.decoder.end_utt()
+        hypothesis = self.decoder.hyp()
+        return hypothesis.hypstr if hypothesis else ''
+
+def streaming_stt_from_config(config, stt_provider):
+    '''Build the streaming recognizer for stt_provider from the [StreamingSTT] section of .config.
+    Returns None if the provider doesn't stream.'''
+    if stt_provider != 'sphinx-stream':
+        return None
+    section = config['StreamingSTT'] if config.has_section('StreamingSTT') else {}
+    return SphinxStreamingRecognizer(stable_ms=float(section.get('StableMs', 250)))
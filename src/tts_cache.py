@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+'''Cache of synthesized phrases.
+
+Bonejangles says the same lines over and over, so the TTS worker keeps the audio piper produced
+for each line, keyed by the sanitized text and the voice model. Recent entries are held in memory and
+everything is written to a directory on disk, each tier trimmed least recently used first to stay under
+its size cap. The cached audio is piper's output before the voice effects; it still goes through the
+live effects chain when it's played so it blends with the lines around it.
+'''
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+class PhraseCache:
+    def __init__(self, directory=None, max_disk_bytes=256 * 1024 * 1024, max_memory_bytes=32 * 1024 * 1024):
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.disk = OrderedDict() #key -> size, least recently used first
+        self.disk_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._scan()
+
+    @staticmethod
+    def key(line, *voice_settings):
+        '''Content address for a line spoken with the given voice model and settings'''
+        text = ' '.join(line.split())
+        parts = [text] + [str(setting) for setting in voice_settings]
+        return hashlib.sha256('\x1f'.join(parts).encode()).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            audio = self.memory.get(key)
+            if audio is not None:
+                self.memory.move_to_end(key)
+            elif key in self.disk:
+                try:
+                    with open(self._path(key), 'rb') as f:
+                        audio = f.read()
+                    os.utime(self._path(key))
+                    self.disk.move_to_end(key)
+                    self._remember(key, audio)
+                except OSError:
+                    self._forget_disk(key)
+            if audio is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return audio
+
+    def put(self, key, audio):
+        if not audio:
+            return
+        with self._lock:
+            self._remember(key, audio)
+            if self.directory and key not in self.disk:
+                path = self._path(key)
+                tmp_path = path + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(audio)
+                os.replace(tmp_path, path)
+                self.disk[key] = len(audio)
+                self.disk_bytes += len(audio)
+                while self.disk_bytes > self.max_disk_bytes and len(self.disk) > 1:
+                    oldest = next(iter(self.disk))
+                    self._forget_disk(oldest)
+                    try:
+                        os.remove(self._path(oldest))
+                    except OSError:
+                        pass
+
+    def __contains__(self, key):
+        return key in self.memory or key in self.disk
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "memory_entries": len(self.memory), "memory_bytes": self.memory_bytes,
+                "disk_entries": len(self.disk), "disk_bytes": self.disk_bytes}
+
+    def _remember(self, key, audio):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return
+        self.memory[key] = audio
+        self.memory_bytes += len(audio)
+        while self.memory_bytes > self.max_memory_bytes and len(self.memory) > 1:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+
+    def _forget_disk(self, key):
+        size = self.disk.pop(key, None)
+        if size is not None:
+            self.disk_bytes -= size
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.raw')
+
+    def _scan(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.raw'):
+                continue
+            st = os.stat(os.path.join(self.directory, name))
+            entries.append((st.st_mtime, name[:-len('.raw')], st.st_size))
+        for _, key, size in sorted(entries):
+            self.disk[key] = size
+            self.disk_bytes += size
+
+def phrase_cache_from_config(config):
+    '''Build the cache from the [TTSCache] section of .config. Returns None if it's disabled.'''
+    section = config['TTSCache'] if config.has_section('TTSCache') else {}
+    if not config.getboolean('TTSCache', 'Enabled', fallback=True):
+        return None
+    return PhraseCache(section.get('Directory', '.tts_cache') or None,
+                       max_disk_bytes=int(float(section.get('MaxDiskMB', 256)) * 1024 * 1024),
+                       max_memory_bytes=int(float(section.get('MaxMemoryMB', 32)) * 1024 * 1024))
@@ -0,0 +1,636 @@
+#!/usr/bin/env python3
+'''Long-lived TTS worker.
+
+Piper is started once and kept running, so the voice model is only loaded at startup.
+Lines are handed to the worker over a queue and the raw s16le audio piper produces is
+streamed into a persistent audio sink, so starting and ending an utterance is cheap.
+The audio can optionally be run through an in-process effects chain (see voice_fx) on the way.
+A PlaybackClock follows how much of the written audio has actually been played, so callbacks can be
+fired at the moment a given point in the audio is heard.
+Several workers, each with its own sink, can share the piper processes in one PiperPool.
+'''
+
+import os
+import time
+import heapq
+import queue
+import wave
+import select
+import threading
+from collections import deque
+from subprocess import Popen, PIPE, DEVNULL
+
+SAMPLE_RATE = 22050
+SAMPLE_WIDTH = 2
+
+#The "Bonejangles voice" as an ffmpeg filter graph
+VOICE_FILTER = "asplit [out1][out2];[out1]afreqshift=shift=-450[shifted];[shifted]aecho=0.8:0.88:80:0.5[echo];[echo]asubboost[sub];[sub]aphaser[final1];[out2]afreqshift=shift=-350[s2];[s2]asubboost[final2];[final1] [final2] amix[mixed];[mixed]volume=volume=10dB[vol];[vol]atempo=0.85"
+VOICE_FILTER_TEMPO = 0.85
+
+class AudioSink:
+    '''Destination for s16le audio.
+    Keeps track of how much audio has been written so callers can tell when playback will end.
+    latency is how long audio takes to get from a write to the speaker.'''
+    def __init__(self, sample_rate=SAMPLE_RATE, tempo=1.0, realtime=True, latency=0.0):
+        self.sample_rate = sample_rate
+        self.tempo = tempo
+        self.realtime = realtime
+        self.latency = latency
+        self.frames_written = 0
+        self._play_until = 0.0
+
+    def write(self, data):
+        if not data:
+            return
+        #Playback of this audio starts when it's handed over, however long the write then blocks for,
+        #and anyone asking while it blocks should know it's coming
+        frames = len(data) // SAMPLE_WIDTH
+        self.frames_written += frames
+        self._play_until = max(self._play_until, time.monotonic()) + frames / self.sample_rate / self.tempo
+        self._write(data)
+
+    def played_frames(self):
+        '''How many of the frames written so far have been heard'''
+        if not self.realtime:
+            return self.frames_written
+        queued_secs = self._play_until + self.latency - time.monotonic()
+        if queued_secs <= 0:
+            return self.frames_written
+        return max(0, self.frames_written - int(queued_secs * self.sample_rate * self.tempo))
+
+    def playing_until(self):
+        '''The time.monotonic() by which everything written so far will have been heard'''
+        if not self.realtime:
+            return 0.0
+        return self._play_until + self.latency
+
+    def flush(self):
+        '''Push any audio held back by the sink out to the device'''
+        pass
+
+    def drain(self):
+        '''Block until everything written so far has been played'''
+        if not self.realtime:
+            return
+        #Sleep in short steps so a cancel from another thread ends the wait
+        while True:
+            delay = self._play_until - time.monotonic()
+            if delay <= 0:
+                break
+            time.sleep(min(delay, 0.05))
+
+    def cancel(self):
+        '''Stop playing as soon as possible and forget anything written so far'''
+        self._play_until = 0.0
+
+    def close(self):
+        pass
+
+    def _write(self, data):
+        raise NotImplementedError
+
+class NullSink(AudioSink):
+    '''Discards audio. Useful for headless runs.'''
+    def __init__(self, sample_rate=SAMPLE_RATE, tempo=1.0, realtime=False):
+        super().__init__(sample_rate, tempo, realtime)
+
+    def _write(self, data):
+        pass
+
+class WavFileSink(AudioSink):
+    '''Writes what would have been played to a WAV file'''
+    def __init__(self, path, sample_rate=SAMPLE_RATE, tempo=1.0, realtime=False):
+        super().__init__(sample_rate, tempo, realtime)
+        self.file = wave.open(path, 'wb')
+        self.file.setnchannels(1)
+        self.file.setsampwidth(SAMPLE_WIDTH)
+        self.file.setframerate(sample_rate)
+
+    def _write(self, data):
+        self.file.writeframes(data)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+class FfplaySink(AudioSink):
+    '''Plays audio through a single persistent ffplay process, optionally through an ffmpeg filter graph first.
+    device picks the output, e.g. an ALSA device such as "plughw:1,0", instead of the default one.'''
+    def __init__(self, filter_graph=None, sample_rate=SAMPLE_RATE, tempo=1.0, flush_secs=0.3, latency=0.05, device=None):
+        super().__init__(sample_rate, tempo, latency=latency)
+        self.filter_graph = filter_graph
+        self.device = device
+        self.flush_secs = flush_secs
+        self.ffmpeg_proc = None
+        self.ffplay_proc = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        rate = str(self.sample_rate)
+        #ffplay plays through SDL, which takes its device from the environment
+        env = dict(os.environ, AUDIODEV=self.device) if self.device else None
+        ffplay_args = ["ffplay", "-hide_banner", "-loglevel", "error", "-nostats", "-autoexit", "-nodisp", "-fflags", "nobuffer", "-probesize", "32", "-analyzeduration", "0", "-f", "s16le", "-ar", rate, "-i", "-"]
+        if self.filter_graph:
+            ffmpeg_args = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-nostats", "-fflags", "nobuffer", "-f", "s16le", "-ar", rate, "-i", "-", "-filter_complex", self.filter_graph, "-flush_packets", "1", "-f", "s16le", "pipe:1"]
+            self.ffmpeg_proc = Popen(ffmpeg_args, stdin=PIPE, stdout=PIPE)
+            self.ffplay_proc = Popen(ffplay_args, stdin=self.ffmpeg_proc.stdout, stdout=DEVNULL, env=env)
+            self.ffmpeg_proc.stdout.close() #ffplay owns the read end now
+        else:
+            self.ffplay_proc = Popen(ffplay_args, stdin=PIPE, stdout=DEVNULL, env=env)
+
+    def _stdin(self):
+        if self.ffplay_proc and any(proc.poll() is not None for proc in (self.ffmpeg_proc, self.ffplay_proc) if proc):
+            #The player died (or was killed by cancel), so start a fresh one
+            for proc in (self.ffmpeg_proc, self.ffplay_proc):
+                if proc:
+                    proc.kill()
+            self.close()
+        if not self.ffplay_proc:
+            self.open()
+        return self.ffmpeg_proc.stdin if self.ffmpeg_proc else self.ffplay_proc.stdin
+
+    def _write(self, data):
+        with self._lock:
+            stdin = self._stdin()
+            stdin.write(data)
+            stdin.flush()
+
+    def flush(self):
+        #ffmpeg's filters hold back the tail of the audio until more input arrives, so push some silence through
+        if self.filter_graph and self.ffmpeg_proc:
+            self.write(bytes(int(self.sample_rate * self.flush_secs) * SAMPLE_WIDTH))
+
+    def cancel(self):
+        #Audio already in the pipes can't be taken back, so kill the player and start a fresh one on the next write
+        super().cancel()
+        #Kill them before taking the lock: a writer blocked on a full pipe holds it, and the kill wakes it
+        #with a BrokenPipeError. Waiting for the lock first would mean waiting for the pipe to drain.
+        for proc in (self.ffmpeg_proc, self.ffplay_proc):
+            if proc:
+                proc.kill()
+        with self._lock:
+            self.close()
+
+    def close(self):
+        for proc in (self.ffmpeg_proc, self.ffplay_proc):
+            #ffplay reads from ffmpeg when there's a filter graph, so it has no stdin of ours
+            if proc and proc.stdin:
+                try:
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+        for proc in (self.ffmpeg_proc, self.ffplay_proc):
+            if proc:
+                proc.wait()
+        self.ffmpeg_proc = None
+        self.ffplay_proc = None
+
+class PlaybackClock:
+    '''Calls callbacks when a sink has played up to a given frame'''
+    def __init__(self, sink):
+        self.sink = sink
+        self._marks = []
+        self._sequence = 0
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def position(self):
+        return self.sink.played_frames()
+
+    def at(self, frame, callback):
+        with self._condition:
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run, name="playback-clock", daemon=True)
+                self._thread.start()
+            self._sequence += 1
+            heapq.heappush(self._marks, (frame, self._sequence, callback))
+            self._condition.notify()
+
+    def cancel(self):
+        '''Forget every callback that hasn't fired yet'''
+        with self._condition:
+            self._marks = []
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._marks = []
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._marks and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                frame, _, callback = self._marks[0]
+                remaining = frame - self.position()
+                if remaining > 0:
+                    #Wake up right when the frame should be heard, or sooner if something changes
+                    self._condition.wait(remaining / self.sink.sample_rate / self.sink.tempo)
+                    continue
+                heapq.heappop(self._marks)
+            try:
+                callback()
+            except Exception as e:
+                print("Playback callback failed: {}".format(e))
+
+class PiperProcess:
+    '''A running piper, which synthesizes one line at a time.
+
+    Piper logs a "Real-time factor" line on stderr once it has written all of the audio for a line,
+    which tells us exactly where each line's audio ends. If it goes quiet for longer than idle_timeout
+    in the middle of a line without that, it's restarted, so the rest of the line can't end up in the next one.
+    '''
+    def __init__(self, piper_path, model_path, idle_timeout=5.0, start_timeout=10.0):
+        self.piper_path = piper_path
+        self.model_path = model_path
+        self.idle_timeout = idle_timeout
+        self.start_timeout = start_timeout
+        self.proc = None
+        self._stderr_buffer = b""
+        self._remainder = b""
+
+    def start(self):
+        piper_args = [self.piper_path, "--model", self.model_path, "--output_raw"]
+        self.proc = Popen(piper_args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        self._stderr_buffer = b""
+        self._remainder = b""
+
+    def stop(self):
+        if not self.proc:
+            return
+        self.proc.stdin.close()
+        self.proc.wait()
+        self.proc.stdout.close()
+        self.proc.stderr.close()
+        self.proc = None
+
+    def restart(self):
+        if self.proc:
+            self.proc.kill()
+        self.stop()
+        self.start()
+
+    def synthesize(self, line, on_audio=None):
+        '''Synthesize a line, passing its audio to on_audio as it arrives.
+        Returns the line's audio, or None if piper never confirmed it finished the line.'''
+        try:
+            return self._synthesize(line, on_audio)
+        except (BrokenPipeError, EOFError) as e:
+            print("TTS worker lost piper ({}), restarting".format(e))
+            self.restart()
+            return None
+
+    def _synthesize(self, line, on_audio):
+        self.proc.stdin.write(line.encode() + b'\n')
+        self.proc.stdin.flush()
+        stdout = self.proc.stdout.fileno()
+        stderr = self.proc.stderr.fileno()
+
+        acked = False
+        chunks = []
+        deadline = time.monotonic() + self.start_timeout
+        while True:
+            #Once piper has acknowledged the line, its audio is already in the pipe, so just drain it
+            ready, _, _ = select.select([stdout, stderr], [], [], 0 if acked else 0.05)
+            if stdout in ready:
+                data = os.read(stdout, 65536)
+                if not data:
+                    raise EOFError("piper closed its output")
+                data = self._align(data)
+                chunks.append(data)
+                if on_audio:
+                    on_audio(data)
+                deadline = time.monotonic() + self.idle_timeout
+            if stderr in ready:
+                acked = self._read_stderr(stderr) or acked
+            if acked and stdout not in ready:
+                break
+            if not ready and time.monotonic() > deadline:
+                #Whatever it says next could still be this line, which would be taken for the start of the next one
+                print("TTS worker timed out waiting for piper on '{}', restarting it".format(line))
+                self.restart()
+                return None
+        return b"".join(chunks)
+
+    def _read_stderr(self, fd):
+        '''Returns True if piper reported that it finished a line'''
+        data = os.read(fd, 4096)
+        if not data:
+            raise EOFError("piper closed its log")
+        self._stderr_buffer += data
+        *lines, self._stderr_buffer = self._stderr_buffer.split(b'\n')
+        return any(b"Real-time factor" in l for l in lines)
+
+    def _align(self, data):
+        #Keep audio aligned to whole samples
+        data = self._remainder + data
+        cut = len(data) - (len(data) % SAMPLE_WIDTH)
+        self._remainder = data[cut:]
+        return data[:cut]
+
+class PiperPool:
+    '''Piper processes for one voice model, shared by any number of TTS workers.
+    Each line goes to whichever process is free. Workers waiting for one are served in the order they
+    asked, and a worker only ever waits on one line at a time, so a chatty station gets a line in
+    and then goes to the back of the line behind the others. Urgent lines, ones a visitor is already
+    waiting in silence for, go ahead of lines for stations which still have audio left to play.'''
+    def __init__(self, piper_path, model_path, size=1, idle_timeout=5.0, start_timeout=10.0):
+        self.piper_path = piper_path
+        self.model_path = model_path
+        self.processes = [PiperProcess(piper_path, model_path, idle_timeout, start_timeout) for _ in range(max(size, 1))]
+        self.started = False
+        self._free = deque()
+        self._waiting = deque()
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self.started:
+                return
+            for process in self.processes:
+                process.start()
+            self._free.extend(self.processes)
+            self.started = True
+
+    def stop(self):
+        with self._lock:
+            self.started = False
+            self._free.clear()
+        for process in self.processes:
+            process.stop()
+
+    def pids(self):
+        return [p.proc.pid for p in self.processes if p.proc]
+
+    def synthesize(self, line, on_audio=None, urgent=False):
+        process = self._acquire(urgent)
+        try:
+            return process.synthesize(line, on_audio)
+        finally:
+            self._release(process)
+
+    def _acquire(self, urgent=False):
+        with self._lock:
+            if self._free and not self._waiting:
+                return self._free.popleft()
+            turn = [threading.Event(), None, urgent]
+            if urgent:
+                #Behind the other urgent ones, ahead of the rest
+                position = next((i for i, waiting in enumerate(self._waiting) if not waiting[2]), len(self._waiting))
+                self._waiting.insert(position, turn)
+            else:
+                self._waiting.append(turn)
+        turn[0].wait()
+        return turn[1]
+
+    def _release(self, process):
+        #Hand the process straight to the longest waiting worker, so the one releasing it can't take it back first
+        with self._lock:
+            if self._waiting:
+                turn = self._waiting.popleft()
+                turn[1] = process
+                turn[0].set()
+            else:
+                self._free.append(process)
+
+class TTSWorker:
+    '''Synthesizes lines handed to it over a queue with piper, and plays them through its sink.
+
+    Lines are synthesized one at a time, by a PiperPool of its own or one shared with other workers.
+    If there is a PhraseCache, lines found in it are played without going through piper at all,
+    and lines handed to prewarm() are synthesized into it whenever the worker has nothing else to do.
+    render() makes a finished clip, effects and all, which play_clip() can play later without any work.
+    mark() schedules a callback for the moment the audio of everything said before it has been heard.
+    '''
+    def __init__(self, piper_path, model_path, sink, fx=None, cache=None, idle_timeout=5.0, start_timeout=10.0, piper=None):
+        self.piper_path = piper_path
+        self.model_path = model_path
+        self.sink = sink
+        self.fx = fx
+        self.cache = cache
+        self.clock = PlaybackClock(sink)
+        self.tracer = None
+        #A shared pool is started here but only stopped by whoever made it
+        self.owns_piper = piper is None
+        self.piper = piper or PiperPool(piper_path, model_path, idle_timeout=idle_timeout, start_timeout=start_timeout)
+        self._queue = queue.Queue()
+        self._thread = None
+        self._generation = 0
+        self._current_generation = 0
+        self._prewarm = deque()
+        self._prewarm_done = threading.Event()
+        self._prewarm_done.set()
+
+    def start(self):
+        if self._thread:
+            return
+        self.piper.start()
+        self._thread = threading.Thread(target=self._run, name="tts-worker", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self._thread:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self.clock.stop()
+        if self.owns_piper:
+            self.piper.stop()
+        self.sink.close()
+
+    def begin_utterance(self):
+        '''Start an utterance. The worker is always warm, so this only makes sure it is running.'''
+        self.start()
+
+    def say(self, line):
+        '''Queue a line of text for synthesis'''
+        line = line.replace('\n', ' ').strip()
+        if line:
+            self._queue.put(("line", self._generation, line))
+
+    def mark(self, callback):
+        '''Call callback once everything queued so far has been played'''
+        self._queue.put(("mark", self._generation, callback))
+
+    def end_utterance(self, wait=True):
+        '''Mark the end of an utterance. If wait is set, block until it has finished playing.'''
+        done = threading.Event()
+        self._queue.put(("end", self._generation, done))
+        if wait:
+            done.wait()
+        return done
+
+    def prewarm(self, lines, wait=False):
+        '''Synthesize lines into the cache in the background, without playing them'''
+        if not self.cache:
+            return
+        for line in lines:
+            line = line.replace('\n', ' ').strip()
+            if line:
+                self._prewarm_done.clear()
+                self._prewarm.append(line)
+        self._queue.put(("wake", self._generation, None))
+        if wait:
+            self._prewarm_done.wait()
+
+    def render(self, line):
+        '''Synthesize a line and run it through the voice effects, without playing it. Blocks until it's done.'''
+        line = line.replace('\n', ' ').strip()
+        result = []
+        done = threading.Event()
+        self.start()
+        self._queue.put(("render", self._generation, (line, result, done)))
+        done.wait()
+        return result[0] if result else None
+
+    def play_clip(self, audio, generation=None):
+        '''Play audio from render() once everything queued before it has been played.
+        It's dropped if the utterance of generation (by default the current one) has been cancelled.'''
+        self._queue.put(("clip", self._generation if generation is None else generation, audio))
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def cancel(self):
+        '''Drop everything queued or playing for the current utterance'''
+        self._generation += 1
+        self.clock.cancel()
+        self.sink.cancel()
+
+    def _run(self):
+        while True:
+            #Prewarming only happens when there's nothing to say
+            try:
+                item = self._queue.get_nowait() if self._prewarm else self._queue.get()
+            except queue.Empty:
+                line = self._prewarm.popleft()
+                try:
+                    self._render(line)
+                except Exception as e:
+                    print("TTS worker failed to prewarm '{}': {}".format(line, e))
+                finally:
+                    if not self._prewarm:
+                        self._prewarm_done.set()
+                continue
+            if item is None:
+                break
+            kind, generation, payload = item
+            #One bad item mustn't take the worker down, or whoever waits on an end or a render waits forever
+            try:
+                self._handle(kind, generation, payload)
+            except Exception as e:
+                print("TTS worker failed handling a '{}': {}".format(kind, e))
+            finally:
+                if kind == "end":
+                    payload.set()
+                elif kind == "render":
+                    payload[2].set()
+
+    def _handle(self, kind, generation, payload):
+        if generation != self._current_generation:
+            #First item after a cancel, so don't let the effects tail of the cancelled audio leak into it
+            self._current_generation = generation
+            if self.fx:
+                self.fx.reset()
+        if kind == "line":
+            if generation != self._generation:
+                return
+            self._speak(payload, generation)
+        elif kind == "clip":
+            if generation == self._generation:
+                if self.tracer:
+                    self.tracer.mark('filler')
+                    self.tracer.mark('first_sound')
+                self._write(payload, generation)
+        elif kind == "render":
+            line, result, done = payload
+            result.append(self._render_clip(line))
+        elif kind == "mark":
+            if generation == self._generation:
+                #Audio still inside the effects chain hasn't reached the sink yet
+                latency = self.fx.latency_frames if self.fx else 0
+                self.clock.at(self.sink.frames_written + latency, payload)
+        elif kind == "end":
+            if generation == self._generation:
+                if self.fx:
+                    self._write(self.fx.flush(), generation)
+                self.sink.flush()
+                self.sink.drain()
+
+    def _speak(self, line, generation):
+        key = self.cache.key(line, self.model_path) if self.cache else None
+        audio = self.cache.get(key) if key else None
+        if audio:
+            self._play(audio, generation)
+            return
+        #The audio comes back over a queue, so the piper process goes back to the pool as soon as the line
+        #is synthesized instead of waiting on a sink which blocks like a pipe, with other stations behind it
+        chunks = queue.Queue()
+        outcome = []
+        #With nothing left to play the visitor is already hearing silence, otherwise there's time to spare
+        urgent = self.sink.playing_until() <= time.monotonic()
+        def synthesize():
+            try:
+                outcome.append(self.piper.synthesize(line, chunks.put, urgent))
+            except Exception as e:
+                outcome.append(e)
+            finally:
+                chunks.put(None)
+        threading.Thread(target=synthesize, name="tts-synthesize", daemon=True).start()
+        for data in iter(chunks.get, None):
+            self._play(data, generation)
+        audio = outcome[0] if outcome else None
+        if isinstance(audio, Exception):
+            raise audio
+        if key and audio:
+            self.cache.put(key, audio)
+
+    def _render(self, line):
+        key = self.cache.key(line, self.model_path)
+        if key not in self.cache:
+            audio = self.piper.synthesize(line)
+            if audio:
+                self.cache.put(key, audio)
+
+    def _render_clip(self, line):
+        key = self.cache.key(line, self.model_path) if self.cache else None
+        audio = self.cache.get(key) if key else None
+        if not audio:
+            audio = self.piper.synthesize(line)
+            if key and audio:
+                self.cache.put(key, audio)
+        if not audio or not self.fx:
+            return audio
+        #A clean run through the effects, which leaves them as they were for the next utterance
+        self.fx.reset()
+        audio = self.fx.process(audio) + self.fx.flush()
+        self.fx.reset()
+        return audio
+
+    def _play(self, data, generation):
+        if generation != self._generation:
+            return #cancelled while piper was working on it
+        if not data:
+            return #a read of less than one sample
+        if self.fx:
+            data = self.fx.process(data)
+        if self.tracer:
+            self.tracer.mark('first_audio')
+            self.tracer.mark('first_sound')
+        self._write(data, generation)
+
+    def _write(self, data, generation):
+        #A dead player mustn't take down the line, or look like a dead piper
+        try:
+            self.sink.write(data)
+        except (OSError, ValueError) as e:
+            if generation == self._generation:
+                print("TTS worker lost the audio player ({}), dropping audio until it's back".format(e))
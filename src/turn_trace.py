@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+'''Per-turn latency tracing.
+
+Each turn is timed from the moment the visitor stopped talking, with time.monotonic() marks at:
+
+    speech_end        the last frame of speech
+    utterance_end     the capture decided the utterance was over
+    stt_result        the transcript came back
+    first_token       the first words of the reply arrived from OpenAI (or the response cache)
+    first_sentence    the first sentence went to piper
+    first_audio       the first audio of the reply was written to the sink
+    filler            a filler clip started playing, because the reply was slow (see filler.py)
+    first_sound       the first audio of any kind, filler or reply
+    playback_end      the reply finished playing
+
+Only the first time each point is reached counts, so marking from a hot loop costs a dict lookup.
+Finished turns are appended to a JSONL file, one record per turn. Summarize them with
+
+    python turn_trace.py traces.jsonl
+'''
+
+import sys
+import json
+import math
+import time
+import argparse
+import threading
+
+#Stage name -> the marks it runs between
+STAGES = [
+    ("endpointing", "speech_end", "utterance_end"),
+    ("stt", "utterance_end", "stt_result"),
+    ("llm_first_token", "stt_result", "first_token"),
+    ("first_sentence", "first_token", "first_sentence"),
+    ("tts_first_audio", "first_sentence", "first_audio"),
+    ("time_to_first_audio", "speech_end", "first_audio"),
+    ("time_to_first_sound", "speech_end", "first_sound"),
+    ("playback", "first_audio", "playback_end"),
+    ("turn", "speech_end", "playback_end"),
+]
+
+class Turn:
+    def __init__(self, number, speech_end=None, utterance_end=None):
+        now = time.monotonic()
+        self.number = number
+        self.wall_time = time.time()
+        self.marks = {"speech_end": speech_end or now, "utterance_end": utterance_end or now}
+        self.notes = {}
+
+    def mark(self, name):
+        if name not in self.marks:
+            self.marks[name] = time.monotonic()
+
+    def record(self, outcome):
+        start = self.marks["speech_end"]
+        stages = {name: round(1000 * (self.marks[b] - self.marks[a]), 1) for name, a, b in STAGES if a in self.marks and b in self.marks}
+        return {"turn": self.number, "time": round(self.wall_time, 3), "outcome": outcome, "notes": self.notes,
+                "marks": {name: round(1000 * (at - start), 1) for name, at in self.marks.items()}, "stages": stages}
+
+class TurnTracer:
+    '''Hands out Turns and writes them to path when they end.
+    Marks made through the tracer go to the turn currently being responded to, if any.
+    Tracers for several stations can append to the same file, each record names its station.'''
+    def __init__(self, path=None, station=None):
+        self.path = path
+        self.station = station
+        self.file = open(path, 'a') if path else None
+        self.current = None
+        self.turns = 0
+        self.records = [] #the most recent, for summary()
+        self._lock = threading.Lock()
+
+    def begin(self, speech_end=None, utterance_end=None):
+        with self._lock:
+            self.turns += 1
+            return Turn(self.turns, speech_end, utterance_end)
+
+    def respond(self, turn):
+        '''Start responding to turn. Marks from the LLM, TTS and playback go to it from now on.'''
+        self.current = turn
+
+    def mark(self, name):
+        turn = self.current
+        if turn:
+            turn.mark(name)
+
+    def note(self, key, value):
+        turn = self.current
+        if turn:
+            turn.notes[key] = value
+
+    def end(self, turn, outcome):
+        if turn is None:
+            return
+        if self.current is turn:
+            self.current = None
+        record = turn.record(outcome)
+        if self.station:
+            record["station"] = self.station
+        with self._lock:
+            self.records.append(record)
+            del self.records[:-1000]
+            if self.file:
+                self.file.write(json.dumps(record) + "\n")
+                self.file.flush()
+
+    def summary(self):
+        '''One line with the percentiles of the time to first audio so far'''
+        values = [r["stages"]["time_to_first_audio"] for r in self.records if "time_to_first_audio" in r["stages"]]
+        if not values:
+            return "no turns"
+        p50, p95, p99 = percentiles(values)
+        return "{} turns, time to first audio p50 {:.0f}ms, p95 {:.0f}ms, p99 {:.0f}ms".format(len(values), p50, p95, p99)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+def percentiles(values, points=(50, 95, 99)):
+    '''Nearest rank percentiles'''
+    ordered = sorted(values)
+    return [ordered[max(math.ceil(p / 100 * len(ordered)), 1) - 1] for p in points]
+
+def load(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def summarize(records, out=sys.stdout):
+    outcomes = {}
+    for record in records:
+        outcomes[record["outcome"]] = outcomes.get(record["outcome"], 0) + 1
+    print("{} turns: {}".format(len(records), ", ".join("{} {}".format(n, outcome) for outcome, n in sorted(outcomes.items()))), file=out)
+    print("{:20} {:>6} {:>8} {:>8} {:>8} {:>8}".format("stage (ms)", "n", "p50", "p95", "p99", "max"), file=out)
+    for name, a, b in STAGES:
+        values = [r["stages"][name] for r in records if name in r["stages"]]
+        if values:
+            p50, p95, p99 = percentiles(values)
+            print("{:20} {:>6} {:>8.0f} {:>8.0f} {:>8.0f} {:>8.0f}".format(name, len(values), p50, p95, p99, max(values)), file=out)
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize per-turn latency traces')
+    parser.add_argument('traces', help='JSONL file written with --trace')
+    parser.add_argument('--outcome', help='only count turns with this outcome, e.g. spoken')
+    parser.add_argument('--station', help='only count turns of this station')
+    args = parser.parse_args()
+
+    records = load(args.traces)
+    if args.outcome:
+        records = [r for r in records if r["outcome"] == args.outcome]
+    if args.station:
+        records = [r for r in records if r.get("station") == args.station]
+    summarize(records)
+
+if __name__ == "__main__":
+    main()
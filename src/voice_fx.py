@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+'''In-process "Bonejangles voice" effects chain.
+
+This is a streaming NumPy version of the ffmpeg filter graph in tts_worker.VOICE_FILTER:
+
+    asplit -> afreqshift -> aecho -> asubboost -> aphaser -+
+           -> afreqshift -> asubboost ---------------------+-> amix -> volume -> atempo
+
+Every stage keeps its own state between blocks, so s16le audio from piper can be pushed
+through block by block for as long as the process runs without gaps at block edges.
+'''
+
+import numpy as np
+
+from tts_worker import SAMPLE_RATE
+
+class Hilbert:
+    '''FIR Hilbert transformer. Returns the delay-matched input and its quadrature component.'''
+    def __init__(self, taps=127):
+        k = np.arange(taps) - (taps - 1) // 2
+        h = np.zeros(taps)
+        odd = k % 2 != 0
+        h[odd] = 2.0 / (np.pi * k[odd])
+        self.h = h * np.blackman(taps)
+        self.delay = (taps - 1) // 2
+        self.history = np.zeros(taps - 1)
+
+    def process(self, x):
+        full = np.concatenate((self.history, x))
+        self.history = full[len(x):]
+        quadrature = np.convolve(full, self.h, 'valid')
+        return full[self.delay:self.delay + len(x)], quadrature
+
+class FreqShift:
+    '''Single sideband frequency shift, like afreqshift'''
+    def __init__(self, shift_hz, sample_rate=SAMPLE_RATE):
+        self.step = 2 * np.pi * shift_hz / sample_rate
+        self.phase = 0.0
+
+    def process(self, analytic):
+        real, quadrature = analytic
+        phase = self.phase + self.step * np.arange(len(real))
+        self.phase = (self.phase + self.step * len(real)) % (2 * np.pi)
+        return real * np.cos(phase) - quadrature * np.sin(phase)
+
+class Echo:
+    '''Single tap echo, like aecho with one delay'''
+    def __init__(self, in_gain=0.8, out_gain=0.88, delay_ms=80, decay=0.5, sample_rate=SAMPLE_RATE):
+        self.in_gain = in_gain
+        self.out_gain = out_gain
+        self.decay = decay
+        self.history = np.zeros(max(int(sample_rate * delay_ms / 1000), 1))
+
+    def process(self, x):
+        full = np.concatenate((self.history, x))
+        self.history = full[len(x):]
+        return (x * self.in_gain + full[:len(x)] * self.decay) * self.out_gain
+
+class SubBoost:
+    '''Low frequency boost through a decaying delay line, like asubboost'''
+    def __init__(self, dry=1.0, wet=1.0, boost=2.0, decay=0.0, feedback=0.9, cutoff=100, delay_ms=20, taps=1023, sample_rate=SAMPLE_RATE):
+        self.dry = dry
+        self.wet = wet
+        self.decay = decay
+        self.gain = boost * feedback
+        #Windowed sinc lowpass so the filter is a single vectorized convolution
+        k = np.arange(taps) - (taps - 1) // 2
+        fc = cutoff / sample_rate
+        self.lowpass = 2 * fc * np.sinc(2 * fc * k) * np.blackman(taps)
+        self.lowpass_history = np.zeros(taps - 1)
+        self.buffer = np.zeros(max(int(sample_rate * delay_ms / 1000), 1))
+
+    def process(self, x):
+        full = np.concatenate((self.lowpass_history, x))
+        self.lowpass_history = full[len(x):]
+        low = np.convolve(full, self.lowpass, 'valid')
+
+        #The delay line only depends on samples one delay back, so it can be filled a delay's worth at a time
+        delay = len(self.buffer)
+        boosted = np.empty(len(x))
+        for i in range(0, len(x), delay):
+            m = min(delay, len(x) - i)
+            current = self.buffer[:m] * self.decay + low[i:i + m] * self.gain
+            boosted[i:i + m] = current
+            self.buffer = np.concatenate((self.buffer[m:], current))
+        return x * self.dry + boosted * self.wet
+
+class Phaser:
+    '''Modulated feedback delay with a triangle LFO, like aphaser.
+    The shortest delay is clamped to min_lag samples so each run of min_lag samples can be computed at once.'''
+    def __init__(self, in_gain=0.4, out_gain=0.74, delay_ms=3.0, decay=0.4, speed=0.5, min_lag=16, sample_rate=SAMPLE_RATE):
+        self.in_gain = in_gain
+        self.out_gain = out_gain
+        self.decay = decay
+        self.max_lag = max(int(sample_rate * delay_ms / 1000 + 0.5), min_lag + 1)
+        self.min_lag = min_lag
+        self.period = sample_rate / speed
+        self.position = 0
+        self.history = np.zeros(self.max_lag)
+
+    def process(self, x):
+        out = np.empty(len(x))
+        for i in range(0, len(x), self.min_lag):
+            m = min(self.min_lag, len(x) - i)
+            j = np.arange(m)
+            lfo = ((self.position + j) / self.period) % 1.0
+            triangle = 1.0 - np.abs(2.0 * lfo - 1.0)
+            lag = (self.min_lag + triangle * (self.max_lag - self.min_lag)).astype(np.int64)
+            current = x[i:i + m] * self.in_gain + self.history[self.max_lag + j - lag] * self.decay
+            out[i:i + m] = current
+            self.history = np.concatenate((self.history[m:], current))
+            self.position += m
+        return out * self.out_gain
+
+class TimeStretch:
+    '''WSOLA time stretch, like atempo. tempo < 1 slows the voice down without changing pitch.'''
+    def __init__(self, tempo=0.85, frame=1024, tolerance=256):
+        self.tempo = tempo
+        self.frame = frame
+        self.hop = frame // 2
+        self.tolerance = tolerance
+        self.window = np.hanning(frame + 1)[:frame] #periodic hann overlaps to unity at 50%
+        self.input = np.zeros(tolerance)
+        self.base = -tolerance #absolute position of self.input[0]
+        self.analysis = 0.0
+        self.natural = None
+        self.overlap = np.zeros(frame)
+
+    def process(self, x):
+        if self.tempo == 1.0:
+            return x
+        self.input = np.concatenate((self.input, x))
+        out = []
+        while True:
+            nominal = int(round(self.analysis)) - self.base
+            if len(self.input) < nominal + self.tolerance + self.frame + self.hop:
+                break
+            if self.natural is None:
+                start = nominal
+            else:
+                #Pick the frame which lines up best with where the last frame would have continued
+                low = nominal - self.tolerance
+                segment = self.input[low:nominal + self.tolerance + self.frame]
+                start = low + int(np.argmax(np.correlate(segment, self.natural, 'valid')))
+            self.natural = self.input[start + self.hop:start + self.hop + self.frame]
+            self.overlap += self.input[start:start + self.frame] * self.window
+            out.append(self.overlap[:self.hop].copy())
+            self.overlap = np.concatenate((self.overlap[self.hop:], np.zeros(self.hop)))
+            self.analysis += self.hop * self.tempo
+
+        keep = int(self.analysis) - self.base - self.tolerance
+        if keep > 0:
+            self.input = self.input[keep:]
+            self.base += keep
+        return np.concatenate(out) if out else np.zeros(0)
+
+class VoiceFXChain:
+    '''The full voice chain. Takes and returns s16le bytes.'''
+    def __init__(self, shift_hz=-450, mix_shift_hz=-350, echo_delay_ms=80, echo_decay=0.5, echo_in_gain=0.8, echo_out_gain=0.88,
+                 sub_boost=2.0, sub_cutoff=100, phaser_speed=0.5, phaser_decay=0.4, volume_db=10, tempo=0.85, sample_rate=SAMPLE_RATE, tail_secs=0.3):
+        self.settings = dict(shift_hz=shift_hz, mix_shift_hz=mix_shift_hz, echo_delay_ms=echo_delay_ms, echo_decay=echo_decay,
+                             echo_in_gain=echo_in_gain, echo_out_gain=echo_out_gain, sub_boost=sub_boost, sub_cutoff=sub_cutoff,
+                             phaser_speed=phaser_speed, phaser_decay=phaser_decay, volume_db=volume_db, tempo=tempo, sample_rate=sample_rate)
+        self.sample_rate = sample_rate
+        self.tempo = tempo
+        self.tail_secs = tail_secs
+        self.reset()
+
+    def reset(self):
+        s = self.settings
+        self.hilbert = Hilbert()
+        self.shift = FreqShift(s['shift_hz'], self.sample_rate)
+        self.echo = Echo(s['echo_in_gain'], s['echo_out_gain'], s['echo_delay_ms'], s['echo_decay'], self.sample_rate)
+        self.sub = SubBoost(boost=s['sub_boost'], cutoff=s['sub_cutoff'], sample_rate=self.sample_rate)
+        self.phaser = Phaser(decay=s['phaser_decay'], speed=s['phaser_speed'], sample_rate=self.sample_rate)
+        self.mix_shift = FreqShift(s['mix_shift_hz'], self.sample_rate)
+        self.mix_sub = SubBoost(boost=s['sub_boost'], cutoff=s['sub_cutoff'], sample_rate=self.sample_rate)
+        self.gain = 10 ** (s['volume_db'] / 20) / 2 #amix averages its two inputs
+        self.stretch = TimeStretch(s['tempo'])
+
+    @property
+    def latency_frames(self):
+        '''Roughly how many output frames the chain holds back'''
+        return int(self.hilbert.delay / self.tempo) + self.stretch.frame + self.stretch.tolerance
+
+    def process(self, data):
+        if not data:
+            return b"" #the Hilbert filter can't take a block shorter than its taps
+        x = np.frombuffer(data, dtype='<i2') / 32768.0
+        analytic = self.hilbert.process(x)
+        voice = self.phaser.process(self.sub.process(self.echo.process(self.shift.process(analytic))))
+        under = self.mix_sub.process(self.mix_shift.process(analytic))
+        y = self.stretch.process((voice + under) * self.gain)
+        return (np.clip(y, -1.0, 32767 / 32768) * 32768).astype('<i2').tobytes()
+
+    def flush(self):
+        '''Run silence through the chain so the echo and time stretch tails come out'''
+        return self.process(bytes(int(self.sample_rate * self.tail_secs) * 2))
+
+def fx_chain_from_config(config):
+    '''Build the chain from the [VoiceFX] section of .config.
+    Returns None if Engine = ffmpeg, in which case the ffmpeg filter graph should be used instead.'''
+    section = config['VoiceFX'] if config.has_section('VoiceFX') else {}
+    def get(key, default):
+        return float(section.get(key, default))
+    if section.get('Engine', 'numpy') == 'ffmpeg':
+        return None
+    return VoiceFXChain(shift_hz=get('ShiftHz', -450),
+                        mix_shift_hz=get('MixShiftHz', -350),
+                        echo_delay_ms=get('EchoDelayMs', 80),
+                        echo_decay=get('EchoDecay', 0.5),
+                        echo_in_gain=get('EchoInGain', 0.8),
+                        echo_out_gain=get('EchoOutGain', 0.88),
+                        sub_boost=get('SubBoost', 2.0),
+                        sub_cutoff=get('SubCutoffHz', 100),
+                        phaser_speed=get('PhaserSpeed', 0.5),
+                        phaser_decay=get('PhaserDecay', 0.4),
+                        volume_db=get('VolumeDb', 10),
+                        tempo=get('Tempo', 0.85))